@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Bytes written and wallclock time of each checkpoint handoff strategy.
+
+Creates a checkpoint-sized file in a source directory and hands it over to a
+destination directory with every strategy the file system supports. Bytes
+written are read from /proc/self/io where available (they include data that
+is still in the page cache). Point --dir at the file system the ensemble runs
+on, e.g. a parallel file system scratch directory.
+
+Run from the repository root after installing the package (``pip install -e .``).
+
+Usage:
+    python benchmarks/bench_handoff.py --size 500 --dir /scratch/me
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from run_brer.handoff import STRATEGIES, CheckpointHandoff
+
+
+def write_bytes():
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=200, help='checkpoint size in MB')
+    parser.add_argument('--dir', default=None, help='directory on the file system to test')
+    parser.add_argument('--no-verify', action='store_true', help='skip the checksum guard')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as top:
+        print('detected: {}'.format(CheckpointHandoff().detect(top, top)))
+        for strategy in STRATEGIES:
+            src_dir = os.path.join(top, strategy, 'convergence')
+            dst_dir = os.path.join(top, strategy, 'production')
+            os.makedirs(src_dir)
+            os.makedirs(dst_dir)
+            src = os.path.join(src_dir, 'state.cpt')
+            with open(src, 'wb') as fh:
+                for _ in range(args.size):
+                    fh.write(os.urandom(1 << 20))
+
+            handoff = CheckpointHandoff(strategy, verify=not args.no_verify)
+            before = write_bytes()
+            start = time.perf_counter()
+            used = handoff.transfer(src, os.path.join(dst_dir, 'state.cpt'))
+            elapsed = time.perf_counter() - start
+            after = write_bytes()
+            written = '{:10.1f} MB'.format((after - before) / 1e6) if before is not None else 'n/a'
+            print('{:8s} (used {:8s}) {:10.4f} s  {} written'.format(strategy, used, elapsed, written))
+
+
+if __name__ == '__main__':
+    main()
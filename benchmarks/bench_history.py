@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Loading and querying the per-iteration history of a whole ensemble.
+
+Writes the history of an ensemble (one record per member, iteration, phase and
+pair) to a temporary directory, then times ``load_history`` and a typical
+analysis: the mean trained alpha of every pair per iteration.
+
+Run from the repository root after installing the package (``pip install -e .``).
+
+Usage:
+    python benchmarks/bench_history.py --members 100 --iterations 50 --pairs 10
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from run_brer.history import HISTORY_FILE, HistoryWriter, load_history
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--pairs', type=int, default=10)
+    args = parser.parse_args()
+
+    names = ['pair_{}'.format(i) for i in range(args.pairs)]
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as ensemble_dir:
+        start = time.perf_counter()
+        for member in range(args.members):
+            member_dir = os.path.join(ensemble_dir, 'mem_{}'.format(member))
+            os.makedirs(member_dir)
+            writer = HistoryWriter(os.path.join(member_dir, HISTORY_FILE), names, member)
+            for iteration in range(args.iterations):
+                values = dict(zip(names, rng.random(args.pairs)))
+                for phase in ('training', 'convergence', 'production'):
+                    writer.append(iteration, phase, values, values)
+        print('write: {:10.4f} s'.format(time.perf_counter() - start))
+
+        start = time.perf_counter()
+        history = load_history(ensemble_dir)
+        print('load:  {:10.4f} s  ({} records)'.format(time.perf_counter() - start, len(history)))
+
+        start = time.perf_counter()
+        targets, alphas, members, iterations = history.trained()
+        mean_alpha = np.zeros((args.iterations, args.pairs))
+        np.add.at(mean_alpha, iterations, alphas)
+        mean_alpha /= np.bincount(iterations, minlength=args.iterations)[:, np.newaxis]
+        print('query: {:10.4f} s'.format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
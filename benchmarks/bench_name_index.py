@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Scaling of restraint name lookups from 10 to 10,000 restraints.
+
+For each size, times a full pass of the lookups a BRER phase performs: name ->
+id for every restraint and plugin name -> restraint name for every plugin. The
+"legacy" column repeats the plugin matching with the nested loop over names
+that RunConfig used to do. With the name index the cost per restraint stays
+flat, i.e. the total cost is linear.
+
+Run from the repository root after installing the package (``pip install -e .``).
+
+Usage:
+    python benchmarks/bench_name_index.py
+"""
+
+import argparse
+import time
+
+from run_brer.pair_data import MultiPair, PairData, plugin_name
+
+
+def build_pairs(num_pairs):
+    pairs = MultiPair()
+    for i in range(num_pairs):
+        pd = PairData('pair_{}'.format(i))
+        pd.set(bins=[0., 1.], distribution=[0.5, 0.5], sites=[2 * i, 2 * i + 1])
+        pairs.add_metadata(pd)
+    return pairs
+
+
+def indexed(pairs, plugin_names):
+    for name in pairs.names:
+        pairs.name_to_id(name)
+    for plugin in plugin_names:
+        pairs.name_from_plugin(plugin)
+
+
+def legacy(pairs, plugin_names):
+    sites = {name: pairs[i].get('sites') for i, name in enumerate(pairs.names)}
+    for plugin in plugin_names:
+        for name in pairs.names:
+            if plugin_name(sites[name]) == plugin:
+                break
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--legacy-limit', type=int, default=2000, help='skip the quadratic loop above this size')
+    args = parser.parse_args()
+
+    print('{:>8s} {:>14s} {:>16s} {:>14s}'.format('pairs', 'indexed (s)', 'per pair (us)', 'legacy (s)'))
+    for size in args.sizes:
+        pairs = build_pairs(size)
+        plugin_names = [plugin_name(pd.get('sites')) for pd in pairs]
+
+        start = time.perf_counter()
+        indexed(pairs, plugin_names)
+        elapsed = time.perf_counter() - start
+
+        legacy_elapsed = float('nan')
+        if size <= args.legacy_limit:
+            start = time.perf_counter()
+            legacy(pairs, plugin_names)
+            legacy_elapsed = time.perf_counter() - start
+        print('{:8d} {:14.6f} {:16.3f} {:14.6f}'.format(size, elapsed, 1e6 * elapsed / size, legacy_elapsed))
+
+
+if __name__ == '__main__':
+    main()
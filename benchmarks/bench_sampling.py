@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Compare the sampling backends of MultiPair on synthetic DEER distributions.
+
+Run from the repository root after installing the package (``pip install -e .``).
+
+Usage:
+    python benchmarks/bench_sampling.py --pairs 100 --bins 5000 --samples 100000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from run_brer.pair_data import MultiPair, PairData, SAMPLERS
+
+
+def synthetic_pairs(num_pairs, num_bins, seed=0):
+    """Builds a MultiPair of Gaussian-mixture distributions on a common grid."""
+    rng = np.random.default_rng(seed)
+    bins = np.linspace(0., 10., num_bins)
+    pairs = MultiPair()
+    for i in range(num_pairs):
+        centers = rng.uniform(2., 8., size=2)
+        widths = rng.uniform(0.2, 1., size=2)
+        distribution = np.exp(-0.5 * ((bins[:, np.newaxis] - centers) / widths)**2).sum(axis=1)
+        pd = PairData('pair_{}'.format(i))
+        pd.set(bins=bins, distribution=distribution, sites=[i, i + 1])
+        pairs.add_metadata(pd)
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', type=int, default=100)
+    parser.add_argument('--bins', type=int, default=5000)
+    parser.add_argument('--samples', type=int, default=100000)
+    args = parser.parse_args()
+
+    pairs = synthetic_pairs(args.pairs, args.bins)
+    rng = np.random.default_rng(1)
+
+    start = time.perf_counter()
+    pairs.compile_sampler()
+    print('compile cdf:   {:10.4f} s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    pairs.compile_alias_tables()
+    print('compile alias: {:10.4f} s'.format(time.perf_counter() - start))
+
+    for sampler in SAMPLERS:
+        start = time.perf_counter()
+        pairs.sample(num_samples=args.samples, random_state=rng, sampler=sampler)
+        elapsed = time.perf_counter() - start
+        print('{:6s} {:10.4f} s  ({:.1f} ns per pair draw)'.format(sampler, elapsed,
+                                                                 1e9 * elapsed / (args.samples * args.pairs)))
+
+
+if __name__ == '__main__':
+    main()
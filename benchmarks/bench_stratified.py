@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Histogram error of random versus stratified target assignment.
+
+Prints, for each BRER iteration, the mean total variation distance between the
+ensemble's target histograms and the DEER distributions.
+
+Run from the repository root after installing the package (``pip install -e .``).
+
+Usage:
+    python benchmarks/bench_stratified.py --pairs run_brer/data/pair_data.json --members 50 --iterations 10
+"""
+
+import argparse
+
+from run_brer.pair_data import MultiPair
+from run_brer.target_schedule import TargetSchedule, METHODS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', default='run_brer/data/pair_data.json')
+    parser.add_argument('--members', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    pairs = MultiPair()
+    pairs.read_from_json(args.pairs)
+
+    errors = {}
+    for method in METHODS:
+        schedule = TargetSchedule.generate(pairs, range(args.members), args.iterations, seed=args.seed, method=method)
+        errors[method] = schedule.histogram_error(pairs).mean(axis=1)
+
+    print('iteration ' + ' '.join('{:>12s}'.format(method) for method in METHODS))
+    for iteration in range(args.iterations):
+        print('{:9d} '.format(iteration) + ' '.join('{:12.4f}'.format(errors[method][iteration]) for method in METHODS))
+
+
+if __name__ == '__main__':
+    main()
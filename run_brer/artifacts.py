@@ -0,0 +1,371 @@
+"""Content-addressed store of the input files of an ensemble.
+
+Every member of an ensemble reads the same tpr and pair data. When hundreds
+of members start at once, each of them reading these files from the shared
+file system is a burst of redundant I/O. An ArtifactStore resolves an input
+path to a copy of the file that is cheap to read:
+
+* the file is hashed once and kept under ``ensemble_dir/.artifacts/<hash>/``
+  on the shared file system. An index keyed by the path and ``stat`` of the
+  original file means it is only hashed again when it changes;
+* every node copies an artifact to a local cache directory the first time one
+  of its members needs it. Later members on the node find it there, with only
+  a ``stat`` of the original on the shared file system. The cache keeps the
+  most recently used artifacts up to a total size and evicts the others.
+  Every process that resolves an artifact holds a lease on it until it exits,
+  and leased artifacts are never evicted.
+
+Artifacts keep the name of the original file (e.g. ``.artifacts/<hash>/topol.tpr``),
+since readers go by the file extension. Files that are read together, such as
+binary pair data and its index, form a single artifact.
+"""
+
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from run_brer.handoff import file_checksum
+from run_brer.shared_pairs import process_alive
+from run_brer.state_store import atomic_write_json
+
+#: Directory of the artifact store in the ensemble directory.
+ARTIFACTS_DIR = '.artifacts'
+
+#: Name of the index file of the store and of each node cache.
+INDEX_FILE = 'index.json'
+
+#: Directory of a node cache with a file ``<hash>/<process id>`` for every process using an artifact.
+LEASES_DIR = '.leases'
+
+
+def node_cache_root():
+    """Default node-local cache directory: ``BRER_NODE_CACHE`` if set, else
+    ``run_brer_artifacts`` in the system temporary directory.
+
+    Returns
+    -------
+    str
+    """
+    return os.environ.get('BRER_NODE_CACHE') or os.path.join(tempfile.gettempdir(), 'run_brer_artifacts')
+
+
+def _stat_key(files):
+    """Identifies the current version of ``files`` without reading them."""
+    keys = []
+    for filename in files:
+        stat = os.stat(filename)
+        keys.append([stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns])
+    return keys
+
+
+def _checksum(files):
+    """Hash of the names and contents of ``files``."""
+    if len(files) == 1:
+        return file_checksum(files[0])
+    digest = hashlib.blake2b()
+    for filename in files:
+        digest.update('{}:{}\n'.format(os.path.basename(filename), file_checksum(filename)).encode())
+    return digest.hexdigest()
+
+
+@contextmanager
+def _locked(directory, shared=False):
+    """Exclusive (or shared) lock on ``directory``, which is created if
+    needed."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+
+def _read_index(directory):
+    filename = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as fh:
+        return json.load(fh)
+
+
+def _copy_entry(files, directory, digest):
+    """Copies ``files`` to ``directory/digest/`` atomically, keeping their
+    names. Returns the path of the copy of the first file."""
+    entry = os.path.join(directory, digest)
+    os.makedirs(entry, exist_ok=True)
+    for source in files:
+        destination = os.path.join(entry, os.path.basename(source))
+        if not os.path.exists(destination):
+            tmp = '{}.tmp'.format(destination)
+            shutil.copyfile(source, tmp)
+            os.replace(tmp, destination)
+    return os.path.join(entry, os.path.basename(files[0]))
+
+
+class NodeCache:
+    """Node-local copies of artifacts with least-recently-used eviction."""
+
+    def __init__(self, directory=None, max_bytes=10 << 30):
+        """
+        Parameters
+        ----------
+        directory : str, optional
+            local cache directory, shared by all the members on the node, by default
+            ``node_cache_root()``
+        max_bytes : int, optional
+            total size of the cached artifacts beyond which the least recently used ones
+            are evicted, by default 10 GiB
+        """
+        self.directory = directory or node_cache_root()
+        self.max_bytes = max_bytes
+
+    def _lease_file(self, digest, pid=None):
+        # Leases are kept apart from the entries, whose modification time is their last use.
+        return os.path.join(self.directory, LEASES_DIR, digest, str(pid or os.getpid()))
+
+    def _lease(self, digest):
+        """Leases an artifact to this process. Must be called with the lock
+        held."""
+        lease = self._lease_file(digest)
+        if not os.path.exists(lease):
+            os.makedirs(os.path.dirname(lease), exist_ok=True)
+            open(lease, 'w').close()
+
+    def leased(self, digest):
+        """Whether a live process holds a lease on an artifact. The leases of
+        processes that have died are removed.
+
+        Parameters
+        ----------
+        digest : str
+            hash of the artifact.
+
+        Returns
+        -------
+        bool
+        """
+        leased = False
+        for lease in glob.glob(self._lease_file(digest, '*')):
+            if process_alive(int(os.path.basename(lease))):
+                leased = True
+            else:
+                os.remove(lease)
+        return leased
+
+    def release(self, cached):
+        """Drops the calling process's lease on a cached copy.
+
+        Parameters
+        ----------
+        cached : str
+            the cached copy, as returned by ``lookup`` or ``insert``.
+        """
+        try:
+            os.remove(self._lease_file(os.path.basename(os.path.dirname(cached))))
+        except FileNotFoundError:
+            pass
+
+    def lookup(self, path, stat):
+        """Cached copy of ``path``, if the cache holds its current version.
+        The calling process takes a lease on it.
+
+        Parameters
+        ----------
+        path : str
+            absolute path of the original file.
+        stat : list
+            the current version of the files of the artifact (see ``ArtifactStore.resolve``).
+
+        Returns
+        -------
+        str or None
+        """
+        # Eviction holds the exclusive lock: the copy cannot disappear between the lookup and the lease.
+        with _locked(self.directory, shared=True):
+            entry = _read_index(self.directory).get(path)
+            if entry is None or entry['stat'] != stat:
+                return None
+            cached = os.path.join(self.directory, entry['digest'], os.path.basename(path))
+            if not os.path.exists(cached):
+                # Evicted since it was indexed.
+                return None
+            self._lease(os.path.basename(os.path.dirname(cached)))
+            # The modification time of the entry directory orders the entries for eviction.
+            os.utime(os.path.dirname(cached))
+        return cached
+
+    def insert(self, path, stat, digest, source):
+        """Copies an artifact into the cache, takes a lease on it for the
+        calling process and evicts the least recently used entries beyond
+        ``max_bytes``.
+
+        Parameters
+        ----------
+        path : str
+            absolute path of the original file.
+        stat : list
+            the version of the files of the artifact when they were hashed.
+        digest : str
+            hash of their contents.
+        source : list
+            the files of the artifact to copy, e.g. in the ArtifactStore.
+
+        Returns
+        -------
+        str
+            the cached copy.
+        """
+        with _locked(self.directory):
+            cached = _copy_entry(source, self.directory, digest)
+            self._lease(os.path.basename(os.path.dirname(cached)))
+            os.utime(os.path.dirname(cached))
+            index = _read_index(self.directory)
+            index[path] = {'stat': stat, 'digest': digest, 'size': sum(os.path.getsize(f) for f in source)}
+            self._evict(index, keep=digest)
+            atomic_write_json(index, os.path.join(self.directory, INDEX_FILE))
+        return cached
+
+    def _sizes(self, index):
+        """Size of every indexed artifact, by hash."""
+        sizes = {}
+        for entry in index.values():
+            if entry['digest'] not in sizes:
+                if 'size' in entry:
+                    sizes[entry['digest']] = entry['size']
+                else:
+                    # Indexed before sizes were.
+                    directory = os.path.join(self.directory, entry['digest'])
+                    sizes[entry['digest']] = sum(os.path.getsize(f.path) for f in os.scandir(directory)
+                                                 if f.is_file())
+        return sizes
+
+    def _entries(self, index):
+        entries = []
+        for digest, size in self._sizes(index).items():
+            try:
+                last_use = os.stat(os.path.join(self.directory, digest)).st_mtime
+            except FileNotFoundError:
+                continue
+            entries.append((digest, size, last_use))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def entries(self):
+        """Cached artifacts, least recently used first.
+
+        Returns
+        -------
+        list
+            ``(digest, size in bytes, last use)`` tuples.
+        """
+        with _locked(self.directory, shared=True):
+            return self._entries(_read_index(self.directory))
+
+    def size(self):
+        """Total size of the cached artifacts in bytes.
+
+        Returns
+        -------
+        int
+        """
+        with _locked(self.directory, shared=True):
+            return sum(self._sizes(_read_index(self.directory)).values())
+
+    def _evict(self, index, keep):
+        # The sizes are indexed: only a cache beyond its size has its entries looked at.
+        total = sum(self._sizes(index).values())
+        if total <= self.max_bytes:
+            return
+        for digest, size, _ in self._entries(index):
+            if total <= self.max_bytes:
+                break
+            if digest == keep or self.leased(digest):
+                continue
+            shutil.rmtree(os.path.join(self.directory, digest), ignore_errors=True)
+            shutil.rmtree(os.path.dirname(self._lease_file(digest)), ignore_errors=True)
+            total -= size
+            for path in [path for path, entry in index.items() if entry['digest'] == digest]:
+                del index[path]
+
+
+class ArtifactStore:
+    """Content-addressed copies of the input files of an ensemble, cached on
+    every node."""
+
+    def __init__(self, ensemble_dir, cache=None):
+        """
+        Parameters
+        ----------
+        ensemble_dir : str
+            path to top directory which contains the full ensemble. The store is kept in
+            its ``ARTIFACTS_DIR``.
+        cache : NodeCache or str, optional
+            the node-local cache, or its directory. If False, inputs resolve to the copies
+            in the store, by default ``NodeCache()``
+        """
+        self.directory = os.path.join(ensemble_dir, ARTIFACTS_DIR)
+        if cache is None or isinstance(cache, str):
+            cache = NodeCache(cache)
+        self.cache = cache or None
+
+    def add(self, path, companions=()):
+        """Adds a file to the store, unless its current version is already in
+        it.
+
+        Parameters
+        ----------
+        path : str
+            the file.
+        companions : tuple, optional
+            files that are read together with ``path``, e.g. the index of binary pair data.
+            They are stored next to it under the same hash, by default ()
+
+        Returns
+        -------
+        tuple
+            the version of the files (see ``resolve``), the hash of their contents and the
+            paths of the stored files.
+        """
+        files = [os.path.abspath(filename) for filename in (path, ) + tuple(companions)]
+        stat = _stat_key(files)
+        with _locked(self.directory):
+            index = _read_index(self.directory)
+            entry = index.get(files[0])
+            if entry is not None and entry['stat'] == stat:
+                digest = entry['digest']
+            else:
+                digest = _checksum(files)
+                index[files[0]] = {'stat': stat, 'digest': digest}
+                atomic_write_json(index, os.path.join(self.directory, INDEX_FILE))
+            _copy_entry(files, self.directory, digest)
+        stored = [os.path.join(self.directory, digest, os.path.basename(filename)) for filename in files]
+        return stat, digest, stored
+
+    def resolve(self, path, companions=()):
+        """Path to read ``path`` from: the node-local copy of its artifact.
+        Only the ``stat`` of the original files is needed when the node
+        already has their current version.
+
+        Parameters
+        ----------
+        path : str
+            an input file, e.g. the tpr.
+        companions : tuple, optional
+            files that are read together with ``path`` (see ``add``). Their copies are next
+            to the returned path, by default ()
+
+        Returns
+        -------
+        str
+        """
+        path = os.path.abspath(path)
+        if self.cache is not None:
+            cached = self.cache.lookup(path, _stat_key((path, ) + tuple(companions)))
+            if cached is not None:
+                return cached
+        stat, digest, stored = self.add(path, companions)
+        if self.cache is None:
+            return stored[0]
+        return self.cache.insert(path, stat, digest, stored)
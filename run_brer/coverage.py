@@ -0,0 +1,307 @@
+"""Monitors how well the targets sampled by an ensemble cover the DEER
+distributions.
+
+The monitor polls the history file of every ensemble member (see
+run_brer.history), adds the targets of each newly completed training phase to
+per-pair histograms and compares the histograms to the DEER distributions.
+The history keeps the targets of every (member, iteration), so no iteration is
+missed however rarely the monitor polls, whatever state store the members use.
+Only the records appended since the last poll are read, so the cost of an
+update does not grow with the length of the run. Once every pair is within a
+threshold, a marker file is written to the ensemble directory that launchers
+can check before scheduling more iterations.
+
+The marker records the criterion it was written for: the divergence, the
+threshold, the minimum number of samples and a fingerprint of the DEER
+distributions. A monitor with a different criterion (e.g. a stricter threshold,
+or distributions that were extended) removes a marker it has not confirmed, so
+that later runs do not stop on a stale one; ``reset_coverage`` removes it
+unconditionally.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+from run_brer.history import HISTORY_FILE, PHASES, RECORD_DTYPE
+from run_brer.pair_data import MultiPair, index_filename
+
+#: Divergences understood by CoverageMonitor.
+DIVERGENCES = ('kl', 'js', 'wasserstein')
+
+#: Name of the marker file written to the ensemble directory once coverage is reached.
+COVERAGE_MARKER = 'coverage_reached.json'
+
+
+def _read_marker(ensemble_dir):
+    """Contents of the coverage marker, or None if there is none."""
+    try:
+        with open(os.path.join(ensemble_dir, COVERAGE_MARKER)) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # Written by hand (or cut short): it still signals coverage, for no known criterion.
+        return {}
+
+
+def coverage_reached(ensemble_dir, monitor=None):
+    """Check whether a CoverageMonitor has signalled that the ensemble covers
+    the DEER distributions.
+
+    Parameters
+    ----------
+    ensemble_dir : str
+        path to top directory which contains the full ensemble.
+    monitor : CoverageMonitor, optional
+        only count a marker written for the criterion of this monitor, by default None
+
+    Returns
+    -------
+    bool
+    """
+    marker = _read_marker(ensemble_dir)
+    if marker is None:
+        return False
+    return monitor is None or marker.get('criterion') == monitor.criterion
+
+
+def reset_coverage(ensemble_dir):
+    """Removes the coverage marker, e.g. before running further iterations
+    towards a new criterion.
+
+    Parameters
+    ----------
+    ensemble_dir : str
+        path to top directory which contains the full ensemble.
+
+    Returns
+    -------
+    bool
+        whether there was a marker.
+    """
+    try:
+        os.remove(os.path.join(ensemble_dir, COVERAGE_MARKER))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+class CoverageMonitor:
+    """Incremental per-pair target histograms for a whole ensemble."""
+
+    def __init__(self, ensemble_dir, pairs: MultiPair, divergence='js', threshold=0.05, min_samples=1):
+        """
+        Parameters
+        ----------
+        ensemble_dir : str
+            path to top directory which contains the full ensemble.
+        pairs : MultiPair
+            pair data the ensemble samples its targets from.
+        divergence : str, optional
+            one of 'kl' (Kullback-Leibler divergence of the histogram from the DEER
+            distribution), 'js' (Jensen-Shannon divergence, in nats) or 'wasserstein'
+            (earth mover's distance, in units of the bins), by default 'js'
+        threshold : float, optional
+            coverage is reached once the divergence of every pair is below this value, by default 0.05
+        min_samples : int, optional
+            minimum number of target sets before coverage can be reached, by default 1
+        """
+        if divergence not in DIVERGENCES:
+            raise ValueError('{} is not a valid divergence. Choose one of {}'.format(divergence, DIVERGENCES))
+        self.ensemble_dir = ensemble_dir
+        self.pairs = pairs
+        self.divergence = divergence
+        self.threshold = threshold
+        self.min_samples = min_samples
+
+        self._probabilities = pairs.probabilities()
+        self._counts = np.zeros(self._probabilities.shape, dtype=np.int64)
+        self._num_samples = 0
+        # (ensemble member, iteration) whose targets have been counted
+        self._seen = set()
+        # history file -> (bytes read so far, pair names)
+        self._read = {}
+
+    @property
+    def criterion(self):
+        """What coverage means for this monitor, as recorded in the marker:
+        the divergence, threshold, minimum number of samples and a fingerprint
+        of the pair names and DEER distributions.
+
+        Returns
+        -------
+        dict
+        """
+        fingerprint = hashlib.sha1(json.dumps(self.pairs.names).encode())
+        fingerprint.update(np.ascontiguousarray(self._probabilities).tobytes())
+        return {
+            'divergence': self.divergence,
+            'threshold': self.threshold,
+            'min_samples': self.min_samples,
+            'distributions': fingerprint.hexdigest()
+        }
+
+    @property
+    def num_samples(self):
+        """Number of target sets added to the histograms so far.
+
+        Returns
+        -------
+        int
+        """
+        return self._num_samples
+
+    def histograms(self):
+        """Normalized target histograms on the bins of each pair.
+
+        Returns
+        -------
+        numpy.ndarray
+            array of shape (number of pairs, maximum number of bins)
+        """
+        return self._counts / max(self._num_samples, 1)
+
+    def add_targets(self, ensemble_num, iteration, targets: dict):
+        """Adds the targets of one member at one iteration. Targets that have
+        already been counted are ignored.
+
+        Parameters
+        ----------
+        ensemble_num : int
+            ensemble member number.
+        iteration : int
+            BRER iteration.
+        targets : dict
+            dictionary of targets, keyed by pair name.
+
+        Returns
+        -------
+        bool
+            whether the targets were new.
+        """
+        if (ensemble_num, iteration) in self._seen:
+            return False
+        row = np.empty(len(self.pairs.names), dtype=np.float64)
+        for name, target in targets.items():
+            row[self.pairs.name_to_id(name)] = target
+        indices = self.pairs.bin_indices(row)
+        self._counts[np.arange(len(row)), indices] += 1
+        self._num_samples += 1
+        self._seen.add((ensemble_num, iteration))
+        return True
+
+    def update(self):
+        """Reads the records appended to every ``mem_*/history.bin`` since the
+        last call and counts the targets of the training phases they record.
+
+        Returns
+        -------
+        int
+            number of new target sets.
+        """
+        new = 0
+        for entry in os.scandir(self.ensemble_dir):
+            if not entry.name.startswith('mem_') or not entry.is_dir():
+                continue
+            filename = os.path.join(entry.path, HISTORY_FILE)
+            try:
+                size = os.path.getsize(filename)
+            except FileNotFoundError:
+                continue
+            if filename not in self._read:
+                with open(index_filename(filename)) as fh:
+                    self._read[filename] = (0, json.load(fh)['names'])
+            start, names = self._read[filename]
+            # A phase still being written is read next time.
+            count = (size - start) // RECORD_DTYPE.itemsize // len(names) * len(names)
+            if count <= 0:
+                continue
+            records = np.fromfile(filename, dtype=RECORD_DTYPE, count=count, offset=start)
+            self._read[filename] = (start + count * RECORD_DTYPE.itemsize, names)
+
+            # Targets are only final once training is over. Every phase is written as one
+            # record per pair in a single write.
+            training = records[records['phase'] == PHASES.index('training')].reshape(-1, len(names))
+            for phase in training:
+                targets = {names[pair]: target for pair, target in zip(phase['pair'], phase['target'])}
+                new += self.add_targets(int(phase['member'][0]), int(phase['iteration'][0]), targets)
+        return new
+
+    def divergences(self):
+        """Divergence of each pair's target histogram from its DEER
+        distribution.
+
+        Returns
+        -------
+        numpy.ndarray
+            one value per pair, in the order of ``pairs.names``.
+        """
+        q = self.histograms()
+        p = self._probabilities
+        if self.divergence == 'wasserstein':
+            widths = np.diff(self.pairs.bin_grid(), axis=1)
+            return np.sum(np.abs(np.cumsum(q - p, axis=1)[:, :-1]) * widths, axis=1)
+
+        def kl(a, b):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                terms = np.where(a > 0, a * np.log(a / b), 0.)
+            return terms.sum(axis=1)
+
+        if self.divergence == 'kl':
+            return kl(q, p)
+        m = 0.5 * (p + q)
+        return 0.5 * kl(p, m) + 0.5 * kl(q, m)
+
+    @property
+    def converged(self):
+        """Whether every pair is covered to within the threshold.
+
+        Returns
+        -------
+        bool
+        """
+        if self._num_samples < max(self.min_samples, 1):
+            return False
+        return bool(np.all(self.divergences() < self.threshold))
+
+    def emit(self):
+        """Writes the coverage marker to the ensemble directory if coverage has
+        been reached. The marker records the criterion (see ``criterion``) and
+        the divergence of every pair. Otherwise, a marker written for another
+        criterion is removed.
+
+        Returns
+        -------
+        bool
+            whether coverage has been reached.
+        """
+        if not self.converged:
+            if not coverage_reached(self.ensemble_dir, self):
+                # Stale: later runs must not stop on it.
+                reset_coverage(self.ensemble_dir)
+            return False
+        marker = os.path.join(self.ensemble_dir, COVERAGE_MARKER)
+        tmp = '{}.tmp'.format(marker)
+        with open(tmp, 'w') as fh:
+            json.dump({
+                'criterion': self.criterion,
+                'divergence': self.divergence,
+                'threshold': self.threshold,
+                'num_samples': self._num_samples,
+                'divergences': dict(zip(self.pairs.names, self.divergences().tolist()))
+            }, fh)
+        os.replace(tmp, marker)
+        return True
+
+    def poll(self):
+        """Update the histograms and emit the coverage marker if appropriate.
+
+        Returns
+        -------
+        bool
+            whether coverage has been reached.
+        """
+        self.update()
+        return self.emit()
@@ -11,9 +11,19 @@ How the directory structure is organized:
       of the members. Future iterations would go in directories
       1,2,...y
 
+On parallel file systems such as Lustre every ``stat``, ``mkdir`` or
+``chdir`` is a round trip to the metadata server. PathPlan computes the paths
+of a member once and creates whole trees with a single ``makedirs``, so a
+phase only costs a handful of metadata operations; a MetadataCounter passed to
+it reports how many.
 """
 
 import os
+from collections import Counter
+from pathlib import Path
+
+#: Phases in the order they run within an iteration.
+PHASE_ORDER = ('training', 'convergence', 'production')
 
 
 class DirectoryHelper:
@@ -93,12 +103,7 @@ class DirectoryHelper:
         """Checks to see if the working directory for current state of BRER
         simulation exists. If it does not, creates the directory.
         """
-        if not os.path.exists(self.get_dir('phase')):
-            tree = [self.get_dir('ensemble_num'), self.get_dir('iteration')]
-            for leaf in tree:
-                if not os.path.exists(leaf):
-                    os.mkdir(leaf)
-            os.mkdir(self.get_dir('phase'))
+        os.makedirs(self.get_dir('phase'), exist_ok=True)
 
     def change_dir(self, level):
         """Change to directory specified by level.
@@ -110,3 +115,169 @@ class DirectoryHelper:
             Can be one of 'top', 'ensemble_num', 'iteration', or 'phase'.
         """
         os.chdir(self.get_dir(level))
+
+
+class MetadataCounter:
+    """Counts the file system metadata operations of a PathPlan, by kind
+    (e.g. 'stat', 'makedirs', 'chdir')."""
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def __call__(self, operation, path):
+        self.counts[operation] += 1
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def reset(self):
+        """Starts counting from zero, e.g. at the start of a phase.
+
+        Returns
+        -------
+        dict
+            the counts until now, by kind of operation.
+        """
+        counts = dict(self.counts)
+        self.counts.clear()
+        return counts
+
+
+class PathPlan:
+    """Paths of one ensemble member, computed once and cached. Metadata
+    operations on them go through the plan, so they can be counted and
+    directories known to exist are not created again."""
+
+    def __init__(self, top_dir, ensemble_num, counter=None):
+        """
+        Parameters
+        ----------
+        top_dir : str
+            the path to the directory containing all the ensemble members.
+        ensemble_num : int
+            the ensemble member.
+        counter : callable, optional
+            called as ``counter(operation, path)`` for every metadata operation, e.g. a
+            MetadataCounter, by default None
+        """
+        self.top_dir = Path(top_dir)
+        self.ensemble_num = ensemble_num
+        self.member_dir = self.top_dir / 'mem_{}'.format(ensemble_num)
+        self.state_json = self.member_dir / 'state.json'
+        self.counter = counter
+        self._phase_dirs = {}
+        self._created = set()
+
+    def _count(self, operation, path):
+        if self.counter is not None:
+            self.counter(operation, path)
+
+    def phase_dir(self, iteration, phase):
+        """Directory of a phase, ``top_dir/mem_N/iteration/phase``.
+
+        Parameters
+        ----------
+        iteration : int
+            BRER iteration.
+        phase : str
+            one of ``PHASE_ORDER``.
+
+        Returns
+        -------
+        pathlib.Path
+        """
+        key = (iteration, phase)
+        if key not in self._phase_dirs:
+            self._phase_dirs[key] = self.member_dir / str(iteration) / phase
+        return self._phase_dirs[key]
+
+    def checkpoint(self, iteration, phase):
+        """Checkpoint of a phase.
+
+        Returns
+        -------
+        pathlib.Path
+        """
+        return self.phase_dir(iteration, phase) / 'state.cpt'
+
+    def source_checkpoint(self, iteration, phase):
+        """Checkpoint a phase starts from: the production checkpoint of the
+        previous iteration for training and convergence, the convergence
+        checkpoint of the same iteration for production.
+
+        Returns
+        -------
+        pathlib.Path or None
+            None for the first training and convergence phases, which start from the tpr.
+        """
+        if phase == 'production':
+            return self.checkpoint(iteration, 'convergence')
+        if iteration > 0:
+            return self.checkpoint(iteration - 1, 'production')
+        return None
+
+    def exists(self, path):
+        """Counted ``os.path.exists``."""
+        self._count('stat', path)
+        return os.path.exists(path)
+
+    def makedirs(self, path):
+        """Creates a directory and its parents with a single
+        ``makedirs(exist_ok=True)``, unless the plan already created it.
+
+        Returns
+        -------
+        pathlib.Path
+            the directory.
+        """
+        path = Path(path)
+        if path not in self._created:
+            self._count('makedirs', path)
+            os.makedirs(path, exist_ok=True)
+            # Its parents exist now as well.
+            self._created.update(path.parents)
+            self._created.add(path)
+        return path
+
+    def make_phase_dir(self, iteration, phase, ahead=0):
+        """Creates the directory of a phase if needed.
+
+        Parameters
+        ----------
+        iteration : int
+            BRER iteration.
+        phase : str
+            one of ``PHASE_ORDER``.
+        ahead : int, optional
+            if the directory has to be created, also create the phase directories of this
+            many following iterations (see ``precreate``), by default 0
+
+        Returns
+        -------
+        pathlib.Path
+        """
+        path = self.phase_dir(iteration, phase)
+        if ahead and path not in self._created:
+            self.precreate(iteration, ahead + 1)
+        return self.makedirs(path)
+
+    def precreate(self, iteration, count):
+        """Creates the phase directories of ``count`` iterations starting at
+        ``iteration`` in one go, so later phases do not need to.
+
+        Parameters
+        ----------
+        iteration : int
+            first iteration.
+        count : int
+            number of iterations.
+        """
+        for i in range(iteration, iteration + count):
+            for phase in PHASE_ORDER:
+                self.make_phase_dir(i, phase)
+
+    def chdir(self, path):
+        """Counted ``os.chdir``."""
+        self._count('chdir', path)
+        os.chdir(path)
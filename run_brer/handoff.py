@@ -0,0 +1,254 @@
+"""Handing a checkpoint from one phase directory to the next.
+
+Every phase starts from the ``state.cpt`` of the previous one. Copying it
+writes the whole file again, which for large systems is hundreds of MB per
+member and phase on a shared file system. A CheckpointHandoff can instead:
+
+* ``'reflink'``: clone the file's extents (``FICLONE``, e.g. on Btrfs, XFS or
+  some parallel file systems). The copy is independent but no data are written.
+* ``'hardlink'``: add a second name for the same file. mdrun never rewrites a
+  checkpoint in place (it renames the old one to ``state_prev.cpt`` and writes a
+  new file), so sharing the inode between the two phase directories is safe.
+* ``'rename'``: move the file. The previous phase loses its checkpoint.
+* ``'symlink'``: point to the previous phase's file. The link dangles once
+  the source is deleted, so this cannot be combined with a retention policy
+  (see run_brer.retention), and 'auto' never picks it.
+* ``'copy'``: copy the data, the fallback that always works.
+
+With ``'auto'`` the cheapest strategy that the file systems of the source and
+destination support is detected once per pair of devices, preferring
+reflink, then hardlink, then copy. A guard checks that the destination holds
+the bytes of the source: by default it compares the sizes and a hash of a few
+sampled blocks, which costs a few reads however large the checkpoint; a full
+checksum of both files can be requested instead.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+
+#: Handoff strategies, see the module documentation.
+STRATEGIES = ('reflink', 'hardlink', 'rename', 'symlink', 'copy')
+
+#: Strategies considered by 'auto', cheapest first.
+AUTO_STRATEGIES = ('reflink', 'hardlink', 'copy')
+
+# ioctl request to clone a whole file on Linux (_IOW(0x94, 9, int)).
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """Clones ``src`` to ``dst`` without copying its data.
+
+    Parameters
+    ----------
+    src : str
+        source file.
+    dst : str
+        destination file, created or truncated.
+
+    Raises
+    ------
+    OSError
+        if the file system does not support cloning.
+    """
+    with open(src, 'rb') as source, open(dst, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            destination.close()
+            os.remove(dst)
+            raise
+
+
+def file_checksum(filename, chunk_size=1 << 22):
+    """BLAKE2b digest of a file's contents.
+
+    Parameters
+    ----------
+    filename : str
+        the file.
+    chunk_size : int, optional
+        bytes read at a time, by default 4 MiB
+
+    Returns
+    -------
+    str
+        hexadecimal digest.
+    """
+    digest = hashlib.blake2b()
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sampled_checksum(filename, samples=8, chunk_size=1 << 16):
+    """BLAKE2b digest of a file's size and of ``samples`` blocks spread
+    evenly over it, including the first and the last.
+
+    Parameters
+    ----------
+    filename : str
+        the file.
+    samples : int, optional
+        number of blocks, by default 8
+    chunk_size : int, optional
+        size of a block, by default 64 KiB
+
+    Returns
+    -------
+    str
+        hexadecimal digest.
+    """
+    digest = hashlib.blake2b()
+    with open(filename, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        digest.update(str(size).encode())
+        last = max(size - chunk_size, 0)
+        for offset in sorted({last * i // max(samples - 1, 1) for i in range(samples)}):
+            fh.seek(offset)
+            digest.update(fh.read(chunk_size))
+    return digest.hexdigest()
+
+
+#: Checks of the destination understood by CheckpointHandoff.
+VERIFY_MODES = ('sample', 'full')
+
+
+class CheckpointHandoff:
+    """Moves checkpoints between phase directories with the cheapest
+    available strategy."""
+
+    def __init__(self, strategy='auto', verify='sample'):
+        """
+        Parameters
+        ----------
+        strategy : str, optional
+            one of ``STRATEGIES`` or 'auto', by default 'auto'
+        verify : str or bool, optional
+            check that the destination has the contents of the source. Links and renames
+            are checked by identity; reflinks and copies by comparing the sizes and sampled
+            blocks ('sample', see ``sampled_checksum``) or full checksums ('full' or True) of
+            the two files. False turns the check off, by default 'sample'
+        """
+        if strategy != 'auto' and strategy not in STRATEGIES:
+            raise ValueError('{} is not a valid strategy. Choose one of {} or auto'.format(strategy, STRATEGIES))
+        if verify is True:
+            verify = 'full'
+        if verify and verify not in VERIFY_MODES:
+            raise ValueError('{} is not a valid check. Choose one of {}, True or False'.format(verify, VERIFY_MODES))
+        self.strategy = strategy
+        self.verify = verify
+        self.bytes_written = 0
+        # (source device, destination device) -> supported strategies
+        self._detected = {}
+
+    def detect(self, src_dir, dst_dir):
+        """Strategies of ``AUTO_STRATEGIES`` that work from ``src_dir`` to
+        ``dst_dir``, found by trying them on a small probe file. The result is
+        cached per pair of devices.
+
+        Parameters
+        ----------
+        src_dir : str
+            directory of the source.
+        dst_dir : str
+            directory of the destination.
+
+        Returns
+        -------
+        list
+            supported strategies, cheapest first.
+        """
+        key = (os.stat(src_dir).st_dev, os.stat(dst_dir).st_dev)
+        if key not in self._detected:
+            supported = []
+            fd, probe = tempfile.mkstemp(prefix='.handoff', dir=src_dir)
+            os.write(fd, b'probe')
+            os.close(fd)
+            target = os.path.join(dst_dir, '{}.probe'.format(os.path.basename(probe)))
+            # Probes do not count towards the bytes written.
+            bytes_written = self.bytes_written
+            try:
+                for strategy in AUTO_STRATEGIES:
+                    try:
+                        self._transfer(strategy, probe, target)
+                    except OSError:
+                        continue
+                    supported.append(strategy)
+                    os.remove(target)
+            finally:
+                os.remove(probe)
+                self.bytes_written = bytes_written
+            self._detected[key] = supported
+        return self._detected[key]
+
+    def _transfer(self, strategy, src, dst):
+        if strategy == 'reflink':
+            reflink(src, dst)
+        elif strategy == 'hardlink':
+            os.link(src, dst)
+        elif strategy == 'rename':
+            os.rename(src, dst)
+        elif strategy == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+        else:
+            shutil.copyfile(src, dst)
+            self.bytes_written += os.path.getsize(dst)
+
+    def transfer(self, src, dst):
+        """Hands ``src`` over to ``dst``.
+
+        Parameters
+        ----------
+        src : str
+            the checkpoint of the previous phase.
+        dst : str
+            path of the checkpoint in the new phase directory, which must not exist.
+
+        Returns
+        -------
+        str
+            the strategy that was used.
+
+        Raises
+        ------
+        IOError
+            if the checksum guard finds that the destination differs from the source.
+        """
+        if self.strategy == 'auto':
+            candidates = self.detect(os.path.dirname(os.path.abspath(src)), os.path.dirname(os.path.abspath(dst)))
+        else:
+            candidates = [self.strategy]
+        # Copying always works and is the last resort.
+        if candidates[-1:] != ['copy']:
+            candidates = list(candidates) + ['copy']
+
+        checksum_of = sampled_checksum if self.verify == 'sample' else file_checksum
+        checksum = checksum_of(src) if self.verify and candidates[0] in ('reflink', 'copy') else None
+        source_stat = os.stat(src)
+        for strategy in candidates:
+            try:
+                self._transfer(strategy, src, dst)
+            except OSError:
+                if strategy == 'copy':
+                    raise
+                continue
+            break
+
+        if self.verify:
+            if strategy in ('reflink', 'copy'):
+                if checksum is None:
+                    checksum = checksum_of(src)
+                same = checksum_of(dst) == checksum
+            else:
+                destination_stat = os.stat(dst)
+                same = (destination_stat.st_ino, destination_stat.st_dev) == (source_stat.st_ino, source_stat.st_dev)
+            if not same:
+                os.remove(dst)
+                raise IOError('Checkpoint handoff from {} to {} ({}) failed the checksum guard'.format(
+                    src, dst, strategy))
+        return strategy
@@ -0,0 +1,249 @@
+"""Per-iteration history of BRER targets, alphas and phase timings.
+
+``RunData`` only holds the current target and alpha of each pair, so the values
+of earlier iterations are overwritten. A HistoryWriter appends one fixed-size
+binary record per pair at the end of every phase to ``mem_N/history.bin``. The
+names of the pairs go to a small JSON index next to it (see
+``run_brer.pair_data.index_filename``). The records of a phase are appended
+with one ``O_APPEND`` write and flushed to disk before the state of the member
+moves on, so a crash can at most leave a partial phase (some of its records,
+the last one possibly cut short) at the end of the file. Readers ignore it, and
+the next HistoryWriter of the member cuts it off before appending, so every
+phase keeps one record per pair, in order.
+
+``load_history`` memory-maps the files of every member and returns the records
+of the whole ensemble as one structured array, so analyses are plain NumPy
+operations on columns.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+from run_brer.pair_data import index_filename
+
+#: Layout of one history record.
+RECORD_DTYPE = np.dtype([
+    ('member', '<i4'),
+    ('iteration', '<i4'),
+    ('pair', '<i4'),
+    ('phase', 'u1'),
+    ('target', '<f8'),
+    ('alpha', '<f8'),
+    ('start_time', '<f8'),
+    ('wall_time', '<f8'),
+    ('timestamp', '<f8'),
+])
+
+#: Phase codes used in the ``phase`` column.
+PHASES = ('training', 'convergence', 'production')
+
+#: Name of the history file in each member directory.
+HISTORY_FILE = 'history.bin'
+
+
+class HistoryWriter:
+    """Appends history records for one ensemble member."""
+
+    def __init__(self, filename, names, ensemble_num):
+        """
+        Parameters
+        ----------
+        filename : str
+            path to the history file, e.g. ``mem_1/history.bin``.
+        names : list
+            pair names; the ``pair`` column holds indices into this list.
+        ensemble_num : int
+            the ensemble member.
+        """
+        self.filename = filename
+        self.names = list(names)
+        self.ensemble_num = ensemble_num
+
+        index = index_filename(filename)
+        if os.path.exists(index):
+            with open(index) as fh:
+                if json.load(fh)['names'] != self.names:
+                    raise ValueError('{} was written for different pairs'.format(filename))
+        else:
+            tmp = '{}.tmp'.format(index)
+            with open(tmp, 'w') as fh:
+                json.dump({'names': self.names, 'dtype': RECORD_DTYPE.descr}, fh)
+            os.replace(tmp, index)
+
+        # Cut off a phase left partial by a crash: appending after it would shift every
+        # later record, and readers expect one record per pair in every phase.
+        if os.path.exists(filename):
+            size = os.path.getsize(filename)
+            phase_size = RECORD_DTYPE.itemsize * len(self.names)
+            if size % phase_size:
+                os.truncate(filename, size - size % phase_size)
+
+    def append(self, iteration, phase, targets: dict, alphas: dict, start_time=0., wall_time=0.):
+        """Appends one record per pair and flushes them to disk.
+
+        Parameters
+        ----------
+        iteration : int
+            BRER iteration.
+        phase : str
+            one of ``PHASES``.
+        targets : dict
+            targets keyed by pair name.
+        alphas : dict
+            alphas keyed by pair name.
+        start_time : float, optional
+            simulation time (in ps) at the end of convergence, by default 0.
+        wall_time : float, optional
+            wallclock duration of the phase in seconds, by default 0.
+        """
+        records = np.zeros(len(self.names), dtype=RECORD_DTYPE)
+        records['member'] = self.ensemble_num
+        records['iteration'] = iteration
+        records['pair'] = np.arange(len(self.names))
+        records['phase'] = PHASES.index(phase)
+        records['target'] = [targets[name] for name in self.names]
+        records['alpha'] = [alphas[name] for name in self.names]
+        records['start_time'] = start_time
+        records['wall_time'] = wall_time
+        records['timestamp'] = time.time()
+
+        data = records.tobytes()
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            written = os.write(fd, data)
+            while written < len(data):
+                written += os.write(fd, data[written:])
+            # The state store moves the phase on next: the records must not be lost in a crash after that.
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def read_history(filename, mmap_mode='r'):
+    """Reads the history file of one member.
+
+    Parameters
+    ----------
+    filename : str
+        path to the history file.
+    mmap_mode : str, optional
+        memory-map the file with this mode, or read it into memory if None, by default 'r'
+
+    Returns
+    -------
+    tuple
+        the records (numpy.ndarray with dtype ``RECORD_DTYPE``) and the pair names.
+    """
+    with open(index_filename(filename)) as fh:
+        names = json.load(fh)['names']
+    # Ignore a phase cut short by a crash.
+    num_records = os.path.getsize(filename) // (RECORD_DTYPE.itemsize * len(names)) * len(names)
+    if num_records == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE), names
+    if mmap_mode is None:
+        records = np.fromfile(filename, dtype=RECORD_DTYPE, count=num_records)
+    else:
+        records = np.memmap(filename, dtype=RECORD_DTYPE, mode=mmap_mode, shape=(num_records, ))
+    return records, names
+
+
+class History:
+    """History records of a whole ensemble."""
+
+    def __init__(self, records, names):
+        """
+        Parameters
+        ----------
+        records : numpy.ndarray
+            structured array with dtype ``RECORD_DTYPE``.
+        names : list
+            pair names; the ``pair`` column holds indices into this list.
+        """
+        self.records = records
+        self.names = list(names)
+
+    def __len__(self):
+        return len(self.records)
+
+    def select(self, ensemble_num=None, pair=None, phase=None):
+        """Records matching all of the given criteria.
+
+        Parameters
+        ----------
+        ensemble_num : int, optional
+            ensemble member, by default None
+        pair : str, optional
+            pair name, by default None
+        phase : str, optional
+            phase, by default None
+
+        Returns
+        -------
+        numpy.ndarray
+            structured array with dtype ``RECORD_DTYPE``.
+        """
+        mask = np.ones(len(self.records), dtype=bool)
+        if ensemble_num is not None:
+            mask &= self.records['member'] == ensemble_num
+        if pair is not None:
+            mask &= self.records['pair'] == self.names.index(pair)
+        if phase is not None:
+            mask &= self.records['phase'] == PHASES.index(phase)
+        return self.records[mask]
+
+    def trained(self):
+        """Targets and alphas at the end of each training phase.
+
+        Returns
+        -------
+        tuple
+            ``(targets, alphas, members, iterations)``, where ``targets`` and ``alphas`` have
+            shape (number of training phases, number of pairs) and ``members`` and
+            ``iterations`` identify the rows.
+        """
+        records = self.select(phase='training')
+        order = np.lexsort((records['pair'], records['iteration'], records['member']))
+        records = records[order]
+        num_pairs = len(self.names)
+        keys = records[['member', 'iteration']][::num_pairs]
+        return (records['target'].reshape(-1, num_pairs), records['alpha'].reshape(-1, num_pairs),
+                keys['member'].copy(), keys['iteration'].copy())
+
+
+def load_history(ensemble_dir, mmap_mode='r'):
+    """Loads the history of every member of an ensemble.
+
+    Parameters
+    ----------
+    ensemble_dir : str
+        path to top directory which contains the full ensemble.
+    mmap_mode : str, optional
+        passed to ``read_history``, by default 'r'
+
+    Returns
+    -------
+    History
+    """
+    names = []
+    parts = []
+    for entry in sorted(os.scandir(ensemble_dir), key=lambda entry: entry.name):
+        filename = os.path.join(entry.path, HISTORY_FILE)
+        if not entry.name.startswith('mem_') or not os.path.exists(filename):
+            continue
+        records, member_names = read_history(filename, mmap_mode=mmap_mode)
+        if not names:
+            names = list(member_names)
+        elif member_names != names:
+            # Map the member's pair indices onto the ensemble-wide list of names.
+            for name in member_names:
+                if name not in names:
+                    names.append(name)
+            mapping = np.array([names.index(name) for name in member_names], dtype=RECORD_DTYPE['pair'])
+            records = np.array(records)
+            records['pair'] = mapping[records['pair']]
+        parts.append(records)
+    if not parts:
+        return History(np.zeros(0, dtype=RECORD_DTYPE), names)
+    return History(np.concatenate(parts), names)
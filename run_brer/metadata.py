@@ -8,6 +8,31 @@ from abc import ABC
 import json
 import warnings
 
+import numpy as np
+
+
+def to_serializable(obj):
+    """``default`` hook for ``json.dump``: converts numpy arrays and scalars
+    (or anything else with a ``tolist`` method) to built-in types.
+
+    Parameters
+    ----------
+    obj :
+        object json does not know how to serialize.
+
+    Returns
+    -------
+    list or scalar
+
+    Raises
+    ------
+    TypeError
+        if the object cannot be converted.
+    """
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
 
 class MetaData(ABC):
     def __init__(self, name):
@@ -92,7 +117,7 @@ class MetaData(ABC):
         value : any, optional
             parameter value, by default None
         """
-        if key and value:
+        if key is not None:
             if key not in self.__required_parameters and key != "name":
                 warnings.warn("{} is not a required parameter of {}: setting anyway".format(key, self.name))
             self._metadata[key] = value
@@ -152,13 +177,427 @@ class MetaData(ABC):
         return missing
 
 
+class _Missing:
+    """Marks a parameter of a CompiledMetaData object that has not been set.
+    Copying or pickling returns the same marker, so identity checks survive
+    ``deepcopy``."""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<missing>'
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return '_MISSING'
+
+
+_MISSING = _Missing()
+
+
+class Schema:
+    """The parameters of a CompiledMetaData class, compiled into a tuple of
+    names, a name -> slot offset mapping and a frozenset for O(1) membership
+    tests."""
+
+    __slots__ = ('fields', 'offsets', 'required')
+
+    def __init__(self, fields):
+        """
+        Parameters
+        ----------
+        fields : iterable
+            names of the required parameters, in order.
+        """
+        self.fields = tuple(fields)
+        self.offsets = {field: i for i, field in enumerate(self.fields)}
+        self.required = frozenset(self.fields)
+
+
+class CompiledMetaData(ABC):
+    """Schema-compiled counterpart of MetaData.
+
+    Subclasses declare their required parameters once, in the ``parameters``
+    class attribute, which is compiled into a Schema when the class is
+    created. Values live in a list indexed by slot offset and instances have
+    no ``__dict__``, so setting, reading and scanning a parameter are O(1) and
+    allocate nothing. The MetaData interface is kept, including the warnings
+    for parameters that are not required; ``set_many`` is the bulk path that
+    validates a whole dictionary in one pass without per-key warnings.
+    """
+
+    __slots__ = ('_name', '_schema', '_values', '_extra')
+
+    #: Names of the required parameters. Compiled into a Schema for each subclass.
+    parameters = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._compiled_schema = Schema(cls.parameters)
+
+    def __init__(self, name):
+        """Construct metadata object. and give it a name.
+
+        Parameters
+        ----------
+        name :
+            Give your MetaData class a descriptive name.
+        """
+        self._name = name
+        self._schema = getattr(type(self), '_compiled_schema', None) or Schema(self.parameters)
+        self._values = [_MISSING] * len(self._schema.fields)
+        self._extra = {}
+
+    @property
+    def name(self):
+        """Name that associates the class with a pair or a particular function
+        (such as with the Plugins, which are named either 'training',
+        'convergence' or 'production').
+
+        Returns
+        -------
+        str
+            the name of the class
+        """
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+
+    def set_requirements(self, list_of_requirements: list):
+        """Replaces the compiled schema of this instance. Values of parameters
+        that were already set are kept.
+
+        Parameters
+        ----------
+        list_of_requirements : list
+            list of required parameters for the class (a list of strings)
+        """
+        current = self.get_as_dictionary()
+        self._schema = Schema(list_of_requirements)
+        self._values = [_MISSING] * len(self._schema.fields)
+        self._extra = {}
+        self.set_many(current)
+
+    def get_requirements(self):
+        """Gets the set of required parameters for the class.
+
+        Returns
+        -------
+        list
+            required parameters of the class
+        """
+        return list(self._schema.fields)
+
+    def requires(self, key):
+        """Whether ``key`` is a required parameter of the class.
+
+        Parameters
+        ----------
+        key : str
+            parameter name
+
+        Returns
+        -------
+        bool
+        """
+        return key in self._schema.required
+
+    def _store(self, key, value):
+        offset = self._schema.offsets.get(key)
+        if offset is None:
+            if key != "name":
+                warnings.warn("{} is not a required parameter of {}: setting anyway".format(key, self.name))
+            self._extra[key] = value
+        else:
+            self._values[offset] = value
+
+    def set(self, key=None, value=None, **kwargs):
+        """Sets a parameter of the class. Warns if the parameter is not
+        required. You can pass the key,value pairs either as a key and value or
+        as a set of **kwargs.
+
+        Parameters
+        ----------
+        key : str, optional
+            parameter name, by default None
+        value : any, optional
+            parameter value, by default None
+        """
+        if key is not None:
+            self._store(key, value)
+        for key, value in kwargs.items():
+            self._store(key, value)
+
+    def set_many(self, data: dict, strict=False):
+        """Sets many parameters in a single pass, without per-key warnings.
+
+        Parameters
+        ----------
+        data : dict
+            parameter names and values.
+        strict : bool, optional
+            raise instead of storing parameters that are not required, by default False
+
+        Raises
+        ------
+        KeyError
+            if ``strict`` and ``data`` contains parameters that are not required. Nothing is set
+            in that case.
+        """
+        offsets = self._schema.offsets
+        if strict:
+            unknown = [key for key in data if key not in offsets and key != "name"]
+            if unknown:
+                raise KeyError('{} are not required parameters of {}'.format(unknown, self.name))
+        values = self._values
+        for key, value in data.items():
+            offset = offsets.get(key)
+            if offset is None:
+                self._extra[key] = value
+            else:
+                values[offset] = value
+
+    def get(self, key):
+        """Get the value of a parameter of the class.
+
+        Parameters
+        ----------
+        key : str
+            The name of the parameter you wish to get.
+
+        Returns
+        -------
+        type
+            The value of the parameter associated with the key.
+
+        Raises
+        ------
+        KeyError
+            if the parameter has not been set.
+        """
+        offset = self._schema.offsets.get(key)
+        if offset is None:
+            return self._extra[key]
+        value = self._values[offset]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def update_from(self, data):
+        """Copies the parameters this class requires from another metadata
+        object, ignoring everything else.
+
+        Parameters
+        ----------
+        data : CompiledMetaData or MetaData
+            the object to copy from.
+        """
+        if not isinstance(data, CompiledMetaData):
+            self.update_from_dictionary(data.get_as_dictionary())
+            return
+        other_offsets = data._schema.offsets
+        other_values = data._values
+        values = self._values
+        for offset, field in enumerate(self._schema.fields):
+            other = other_offsets.get(field)
+            if other is not None and other_values[other] is not _MISSING:
+                values[offset] = other_values[other]
+            elif field in data._extra:
+                values[offset] = data._extra[field]
+
+    def update_from_dictionary(self, dictionary: dict):
+        """Copies the parameters this class requires from a dictionary,
+        ignoring everything else.
+
+        Parameters
+        ----------
+        dictionary : dict
+            a superset of the parameters to copy.
+        """
+        values = self._values
+        for offset, field in enumerate(self._schema.fields):
+            if field in dictionary:
+                values[offset] = dictionary[field]
+
+    def set_from_dictionary(self, data: dict):
+        """Same as ``set``, but takes a dictionary.
+
+        Parameters
+        ----------
+        data : dict
+            A dictionary of parameter names and values to set.
+        """
+        self.set(**data)
+
+    def get_as_dictionary(self):
+        """Get all of the current parameters of the class as a dictionary.
+
+        Returns
+        -------
+        dict
+            dictionary of class parameters
+        """
+        dictionary = {
+            field: value
+            for field, value in zip(self._schema.fields, self._values) if value is not _MISSING
+        }
+        dictionary.update(self._extra)
+        return dictionary
+
+    def get_missing_keys(self):
+        """Gets all of the required parameters that have not been set.
+
+        Returns
+        -------
+        list
+            A list of required parameter names that have not been set.
+        """
+        return [field for field, value in zip(self._schema.fields, self._values) if value is _MISSING]
+
+
+class NameIndex:
+    """O(1) mapping between names and contiguous integer ids (their position
+    in a MultiMetaData), plus optional aliases that resolve to the same ids
+    (such as the plugin name built from a restraint's sites)."""
+
+    def __init__(self, names=()):
+        """
+        Parameters
+        ----------
+        names : iterable, optional
+            initial names, in id order, by default ()
+        """
+        self.names = []
+        self._ids = {}
+        self._aliases = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def add(self, name):
+        """Appends a name and returns its id.
+
+        Parameters
+        ----------
+        name : str
+
+        Returns
+        -------
+        int
+
+        Raises
+        ------
+        ValueError
+            if the name is already indexed.
+        """
+        if name in self._ids:
+            raise ValueError('{} is already in the index'.format(name))
+        self._ids[name] = len(self.names)
+        self.names.append(name)
+        return self._ids[name]
+
+    def add_alias(self, alias, name):
+        """Makes ``alias`` resolve to the id of ``name``.
+
+        Parameters
+        ----------
+        alias : hashable
+        name : str
+            an indexed name.
+        """
+        self._aliases[alias] = self._ids[name]
+
+    def id(self, name):
+        """Id of a name.
+
+        Parameters
+        ----------
+        name : str
+
+        Returns
+        -------
+        int
+
+        Raises
+        ------
+        ValueError
+            if the name is not indexed.
+        """
+        try:
+            return self._ids[name]
+        except KeyError:
+            raise ValueError('{} is not a valid name.'.format(name)) from None
+
+    def ids(self, names):
+        """Ids of many names as a contiguous array.
+
+        Parameters
+        ----------
+        names : iterable
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        return np.fromiter((self.id(name) for name in names), dtype=np.intp)
+
+    def resolve(self, alias):
+        """Name that an alias (or a name) refers to.
+
+        Parameters
+        ----------
+        alias : hashable
+
+        Returns
+        -------
+        str
+
+        Raises
+        ------
+        KeyError
+            if neither an alias nor a name.
+        """
+        if alias in self._aliases:
+            return self.names[self._aliases[alias]]
+        if alias in self._ids:
+            return alias
+        raise KeyError('{} is not a known name or alias'.format(alias))
+
+
 class MultiMetaData(ABC):
     """A single class that handles multiple MetaData classes (useful when
     restraining multiple atom-atom pairs)."""
 
     def __init__(self):
         self._metadata_list = []
-        self.__names = []
+        self._index = NameIndex()
+
+    def _clear(self):
+        """Removes all metadata and names."""
+        self._metadata_list = []
+        self._index = NameIndex()
+
+    @property
+    def index(self):
+        """Name index of the metadata.
+
+        Returns
+        -------
+        NameIndex
+        """
+        return self._index
 
     @property
     def names(self):
@@ -170,8 +609,15 @@ class MultiMetaData(ABC):
         -------
         list
             a list of names
+
+        Raises
+        ------
+        IndexError
+            Raise IndexError if no metadata have been loaded.
         """
-        return self.__names
+        if not self._index.names:
+            raise IndexError('Must import a list of metadata before retrieving names')
+        return self._index.names
 
     @names.setter
     def names(self, names: list):
@@ -181,27 +627,7 @@ class MultiMetaData(ABC):
         ----------
         names : list
         """
-        self.__names = names
-
-    @names.getter
-    def names(self):
-        """getter for names.
-
-        Returns
-        -------
-        list
-            list of names
-
-        Raises
-        ------
-        IndexError
-            Raise IndexError if no metadata have been loaded.
-        """
-        if not self.__names:
-            if not self._metadata_list:
-                raise IndexError('Must import a list of metadata before retrieving names')
-            self.__names = [metadata.name for metadata in self._metadata_list]
-        return self.__names
+        self._index = NameIndex(names)
 
     def add_metadata(self, metadata: MetaData):
         """Appends new MetaData object to self._metadata.
@@ -211,8 +637,8 @@ class MultiMetaData(ABC):
         metadata : MetaData
             metadata to append
         """
+        self._index.add(metadata.name)
         self._metadata_list.append(metadata)
-        self.__names.append(metadata.name)
 
     def name_to_id(self, name):
         """Converts the name of one of the MetaData classes to it's associated
@@ -232,10 +658,12 @@ class MultiMetaData(ABC):
         ------
         IndexError
             Raise IndexError if no metadata have been loaded.
+        ValueError
+            Raise ValueError if the name is unknown.
         """
-        if not self.__names:
+        if not len(self._index):
             raise IndexError('{} is not a valid name.'.format(name))
-        return self.__names.index(name)
+        return self._index.id(name)
 
     def id_to_name(self, id):
         """Converts the index of one of the MetaData classes to it's associated
@@ -251,7 +679,7 @@ class MultiMetaData(ABC):
         str
             the name of the metadata class
         """
-        return self.__names[id]
+        return self._index.names[id]
 
     def __getitem__(self, item):
         return self._metadata_list[item]
@@ -271,7 +699,7 @@ class MultiMetaData(ABC):
         filename : str
              (Default value = 'state.json')
         """
-        json.dump(self.get_as_single_dataset(), open(filename, 'w'))
+        json.dump(self.get_as_single_dataset(), open(filename, 'w'), default=to_serializable)
 
     def read_from_json(self, filename='state.json'):
         """Reads state from json.
@@ -282,11 +710,9 @@ class MultiMetaData(ABC):
              (Default value = 'state.json')
         """
         # TODO: decide on expected behavior here if there's a pre-existing list of data. For now, overwrite
-        self._metadata_list = []
-        self._names = []
+        self._clear()
         data = json.load(open(filename, 'r'))
         for name, metadata in data.items():
-            self.__names.append(name)
             metadata_obj = MetaData(name=name)
             metadata_obj.set_from_dictionary(metadata)
-            self._metadata_list.append(metadata_obj)
+            self.add_metadata(metadata_obj)
@@ -2,8 +2,107 @@
 each new BRER iteration."""
 
 import numpy as np
-from run_brer.metadata import MetaData, MultiMetaData
+from run_brer.metadata import MetaData, MultiMetaData, to_serializable
 import json
+import os
+
+#: Sampling backends understood by MultiPair.
+SAMPLERS = ('choice', 'cdf', 'alias')
+
+
+def index_filename(filename):
+    """Name of the JSON index that accompanies a binary array file.
+
+    Parameters
+    ----------
+    filename : str
+        path to the ``.npy`` file.
+
+    Returns
+    -------
+    str
+        path to the index file, e.g. ``pair_data.index.json`` for ``pair_data.npy``
+    """
+    return '{}.index.json'.format(os.path.splitext(filename)[0])
+
+
+def plugin_name(sites):
+    """Name given to the gmxapi plugin that restrains ``sites``.
+
+    Parameters
+    ----------
+    sites : list
+        atom ids of the restraint.
+
+    Returns
+    -------
+    str
+    """
+    return '{}'.format([int(site) for site in sites])
+
+
+def convert_json_to_binary(json_filename, binary_filename, tolerance=None, dtype=None):
+    """Converts a pair data json file into the binary format read by
+    ``MultiPair.read_from_binary``.
+
+    Parameters
+    ----------
+    json_filename : str
+        pair data json, e.g. pair_data.json in the data directory.
+    binary_filename : str
+        path to the ``.npy`` file to write. The index is written next to it.
+    tolerance : float, optional
+        store the distributions in compact form (see PairData.truncate), by default None
+    dtype : numpy.dtype, optional
+        floating point type of the stored arrays, by default None
+    """
+    pairs = MultiPair()
+    pairs.read_from_json(json_filename, tolerance=tolerance, dtype=dtype)
+    pairs.write_to_binary(binary_filename)
+
+
+def _uniform(size, random_state=None):
+    """Draw uniform random numbers on [0, 1).
+
+    Parameters
+    ----------
+    size : int or tuple
+        shape of the output array.
+    random_state : numpy.random.Generator, optional
+        source of randomness. If None, the global numpy random state is used, by default None
+
+    Returns
+    -------
+    numpy.ndarray
+        uniform samples
+    """
+    if random_state is None:
+        return np.random.random_sample(size)
+    return random_state.random(size)
+
+
+def latin_hypercube(num_samples, num_pairs, random_state=None):
+    """Stratified uniform random numbers: for every pair, [0, 1) is split into
+    ``num_samples`` equal strata and each sample falls into a different one.
+    Strata are permuted independently for each pair, which gives a Latin
+    hypercube over the pairs.
+
+    Parameters
+    ----------
+    num_samples : int
+        number of samples (and strata per pair).
+    num_pairs : int
+        number of pairs.
+    random_state : numpy.random.Generator, optional
+        source of randomness. If None, the global numpy random state is used, by default None
+
+    Returns
+    -------
+    numpy.ndarray
+        uniform random numbers with shape (num_samples, num_pairs)
+    """
+    strata = np.argsort(_uniform((num_pairs, num_samples), random_state), axis=1).T
+    return (strata + _uniform((num_samples, num_pairs), random_state)) / num_samples
 
 
 class PairData(MetaData):
@@ -13,6 +112,79 @@ class PairData(MetaData):
         super().__init__(name=name)
         self.set_requirements(['distribution', 'bins', 'sites'])
 
+    def normalized(self):
+        """The distribution, normalized to unit mass.
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        distribution = np.asarray(self.get('distribution'), dtype=np.float64)
+        return distribution / np.sum(distribution)
+
+    def truncate(self, tolerance=0., dtype=np.float64):
+        """Stores the distribution in compact form: the bins and distribution
+        are trimmed to the support of the distribution and kept as numpy arrays.
+        Leading and trailing bins whose share of the total mass is at most
+        ``tolerance`` are dropped; interior bins are always kept.
+
+        Sampling, normalization and serialization (``MultiPair.write_to_json``)
+        work on the compact form directly.
+
+        Parameters
+        ----------
+        tolerance : float, optional
+            relative mass below which tail bins are dropped, by default 0.
+        dtype : numpy.dtype, optional
+            floating point type of the stored arrays, e.g. np.float32 to halve memory use,
+            by default np.float64
+
+        Returns
+        -------
+        tuple
+            (first, last): indices of the first and last kept bin in the original grid.
+        """
+        distribution = np.asarray(self.get('distribution'), dtype=np.float64)
+        bins = np.asarray(self.get('bins'), dtype=np.float64)
+        support = np.flatnonzero(distribution > tolerance * np.sum(distribution))
+        if not len(support):
+            raise ValueError('Truncating {} with tolerance {} would remove every bin'.format(self.name, tolerance))
+        first, last = support[0], support[-1]
+        self.set(bins=bins[first:last + 1].astype(dtype), distribution=distribution[first:last + 1].astype(dtype))
+        return first, last
+
+    def build_alias_table(self):
+        """Builds a Walker/Vose alias table for the distribution. A draw from
+        the table costs O(1) regardless of the number of bins: pick a bin
+        uniformly, then keep it with probability ``prob[bin]`` or jump to
+        ``alias[bin]`` otherwise.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            (prob, alias): acceptance probability and alias index for each bin.
+        """
+        scaled = self.normalized()
+        num_bins = len(scaled)
+        scaled *= num_bins
+        prob = np.ones(num_bins, dtype=np.float64)
+        alias = np.arange(num_bins, dtype=np.intp)
+
+        small = list(np.flatnonzero(scaled < 1.))
+        large = list(np.flatnonzero(scaled >= 1.))
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1. - scaled[less]
+            if scaled[more] < 1.:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left over is 1 up to round-off and keeps prob = 1.
+        return prob, alias
+
 
 class MultiPair(MultiMetaData):
     """Single class for handling multiple pair data.
@@ -20,10 +192,76 @@ class MultiPair(MultiMetaData):
     Handles resampling of targets.
     """
 
-    def __init__(self):
+    def __init__(self, sampler='cdf'):
+        """
+        Parameters
+        ----------
+        sampler : str, optional
+            default sampling backend, one of 'choice' (one ``np.random.choice`` call per pair),
+            'cdf' (inverse cumulative distribution via ``np.searchsorted``) or 'alias'
+            (Walker/Vose alias tables), by default 'cdf'
+        """
         super().__init__()
+        self.sampler = sampler
+        self._cdf = None
+        self._bins = None
+        self._offsets = None
+        self._num_bins = None
+        self._alias_prob = None
+        self._alias = None
+        # Contiguous block of bins and distributions the pairs were built from (see from_arrays).
+        self._block = None
+
+    @property
+    def sampler(self):
+        """Default sampling backend used by ``sample`` and ``re_sample``.
 
-    def read_from_json(self, filename='state.json'):
+        Returns
+        -------
+        str
+            one of 'choice', 'cdf' or 'alias'
+        """
+        return self._sampler
+
+    @sampler.setter
+    def sampler(self, sampler):
+        if sampler not in SAMPLERS:
+            raise ValueError('{} is not a valid sampler. Choose one of {}'.format(sampler, SAMPLERS))
+        self._sampler = sampler
+
+    def add_metadata(self, metadata: MetaData):
+        """Appends new PairData object and invalidates the compiled sampler.
+        The pair is also indexed under the name of its gmxapi plugin (its
+        sites), see ``name_from_plugin``.
+
+        Parameters
+        ----------
+        metadata : MetaData
+            pair data to append
+        """
+        super().add_metadata(metadata)
+        if 'sites' in metadata.get_as_dictionary():
+            self._index.add_alias(plugin_name(metadata.get('sites')), metadata.name)
+        self._cdf = None
+        self._alias_prob = None
+        self._block = None
+
+    def name_from_plugin(self, name):
+        """Name of the pair restrained by a gmxapi plugin.
+
+        Parameters
+        ----------
+        name : str
+            the plugin name, which is built from the sites of the restraint (see ``plugin_name``).
+
+        Returns
+        -------
+        str
+            the pair name.
+        """
+        return self._index.resolve(name)
+
+    def read_from_json(self, filename='state.json', tolerance=None, dtype=None):
         """Reads pair data from json file. For an example file, see
         pair_data.json in the data directory.
 
@@ -31,32 +269,526 @@ class MultiPair(MultiMetaData):
         ----------
         filename : str, optional
             filename of the pair data, by default 'state.json'
+        tolerance : float, optional
+            if provided (or if dtype is), store every distribution in compact form (see
+            PairData.truncate), dropping tail bins with at most this relative mass, by default None
+        dtype : numpy.dtype, optional
+            floating point type of the compact form, by default None (np.float64)
         """
-        self._metadata_list = []
-        self._names = []
+        self._clear()
         data = json.load(open(filename, 'r'))
         for name, metadata in data.items():
-            self._names.append(name)
             metadata_obj = PairData(name=name)
             metadata_obj.set_from_dictionary(metadata)
-            self._metadata_list.append(metadata_obj)
+            if tolerance is not None or dtype is not None:
+                metadata_obj.truncate(tolerance=tolerance or 0., dtype=dtype or np.float64)
+            self.add_metadata(metadata_obj)
+
+    def write_to_binary(self, filename='pair_data.npy'):
+        """Writes the pair data in a binary format that can be memory-mapped.
+        The bins and distributions of all pairs are stored contiguously in a
+        single ``.npy`` array of shape (2, total number of bins); the names,
+        the offset of each pair in the array, the sites and any other metadata
+        go into a small JSON index (see ``index_filename``).
+
+        Parameters
+        ----------
+        filename : str, optional
+            path to the ``.npy`` file, by default 'pair_data.npy'
+        """
+        block, offsets, metadata = self.to_arrays()
+        np.save(filename, block)
+        with open(index_filename(filename), 'w') as fh:
+            json.dump({'offsets': offsets, 'metadata': metadata}, fh, default=to_serializable)
+
+    def to_arrays(self):
+        """Packs the bins and distributions of all pairs into one contiguous
+        block; the inverse of ``from_arrays``.
+
+        Returns
+        -------
+        tuple
+            (block, offsets, metadata): array of shape (2, total number of bins), start of each
+            pair in the block followed by the total number of bins, and the remaining metadata
+            of each pair keyed by name.
+        """
+        bins = [np.asarray(pair_data.get('bins')) for pair_data in self._metadata_list]
+        distributions = [np.asarray(pair_data.get('distribution')) for pair_data in self._metadata_list]
+        dtype = np.result_type(*bins, *distributions)
+        offsets = np.concatenate(([0], np.cumsum([len(b) for b in bins]))).tolist()
 
-    def re_sample(self):
+        block = np.empty((2, offsets[-1]), dtype=dtype)
+        for i in range(len(bins)):
+            block[0, offsets[i]:offsets[i + 1]] = bins[i]
+            block[1, offsets[i]:offsets[i + 1]] = distributions[i]
+
+        metadata = {}
+        for pair_data in self._metadata_list:
+            metadata[pair_data.name] = {
+                key: value
+                for key, value in pair_data.get_as_dictionary().items() if key not in ('bins', 'distribution')
+            }
+        return block, offsets, metadata
+
+    def read_from_binary(self, filename='pair_data.npy', mmap_mode='r'):
+        """Reads pair data written by ``write_to_binary``. By default the
+        array is memory-mapped, so members on the same node share the pages of
+        the file instead of each holding a parsed copy.
+
+        Parameters
+        ----------
+        filename : str, optional
+            path to the ``.npy`` file, by default 'pair_data.npy'
+        mmap_mode : str, optional
+            passed to ``np.load``, by default 'r'
+        """
+        with open(index_filename(filename)) as fh:
+            index = json.load(fh)
+        self.from_arrays(np.load(filename, mmap_mode=mmap_mode), index['offsets'], index['metadata'])
+
+    def from_arrays(self, block, offsets, metadata, cdf=None):
+        """Builds the pair data from a contiguous block of bins and
+        distributions (see ``write_to_binary``). The PairData objects hold views
+        into ``block``; nothing is copied. The sampler is compiled on first use
+        and reads the bins from ``block`` as well.
+
+        Parameters
+        ----------
+        block : numpy.ndarray
+            array of shape (2, total number of bins).
+        offsets : list
+            start of each pair in ``block``, followed by the total number of bins.
+        metadata : dict
+            remaining metadata (such as sites) of each pair, keyed by name, in order.
+        cdf : numpy.ndarray, optional
+            the compiled cumulative distributions of these pairs (see ``compiled_cdf``), which
+            are used instead of compiling the sampler, by default None
+        """
+        self._clear()
+        for i, (name, pair_metadata) in enumerate(metadata.items()):
+            metadata_obj = PairData(name=name)
+            metadata_obj.set_from_dictionary(pair_metadata)
+            metadata_obj.set(bins=block[0, offsets[i]:offsets[i + 1]],
+                             distribution=block[1, offsets[i]:offsets[i + 1]])
+            self.add_metadata(metadata_obj)
+        self._block = (block, np.asarray(offsets, dtype=np.intp))
+        if cdf is not None:
+            self._cdf = cdf
+            self._bins = block[0]
+            self._offsets = self._block[1]
+            self._num_bins = np.diff(self._offsets)
+
+    def read(self, filename):
+        """Reads pair data in either format: binary if ``filename`` ends in
+        ``.npy`` (see ``read_from_binary``), json otherwise.
+
+        Parameters
+        ----------
+        filename : str
+            path to the pair data.
+        """
+        if os.path.splitext(filename)[1] == '.npy':
+            self.read_from_binary(filename)
+        else:
+            self.read_from_json(filename)
+
+    def compile_sampler(self):
+        """Builds normalized cumulative distributions for all pairs and stores
+        them back to back in one contiguous array, with the bins in a second
+        array of the same layout (``self._offsets`` holds the start of each
+        pair). Called on first use by the sampling methods.
+
+        The cumulative distribution of pair ``i`` is offset by ``i`` so that
+        targets for every pair can be drawn with a single call to
+        ``np.searchsorted`` on the whole array. Pairs built by ``from_arrays``
+        keep their bins in the (possibly memory-mapped) block, so only the
+        cumulative distributions are allocated.
+        """
+        if self._block is not None:
+            block, offsets = self._block
+            bins, distributions = block[0], block[1]
+        else:
+            bins = [np.asarray(pair_data.get('bins'), dtype=np.float64) for pair_data in self._metadata_list]
+            distributions = [np.asarray(pair_data.get('distribution')) for pair_data in self._metadata_list]
+            for pair_data, b, distribution in zip(self._metadata_list, bins, distributions):
+                if len(distribution) != len(b):
+                    raise ValueError('{} has {} bins but {} distribution values'.format(
+                        pair_data.name, len(b), len(distribution)))
+            offsets = np.concatenate(([0], np.cumsum([len(b) for b in bins]))).astype(np.intp)
+            bins = np.concatenate(bins) if bins else np.empty(0)
+            distributions = np.concatenate(distributions) if distributions else np.empty(0)
+
+        num_pairs = len(offsets) - 1
+        cdf = np.empty(offsets[-1], dtype=np.float64)
+        for i in range(num_pairs):
+            start, stop = offsets[i], offsets[i + 1]
+            np.cumsum(distributions[start:stop], out=cdf[start:stop])
+            cdf[start:stop] /= cdf[stop - 1]
+            # Guard against round-off: the last bin must close the distribution.
+            cdf[stop - 1] = 1.
+            cdf[start:stop] += i
+        self._cdf = cdf
+        self._bins = bins
+        self._offsets = offsets
+        self._num_bins = np.diff(offsets)
+        self._alias_prob = None
+
+    def compiled_cdf(self):
+        """Cumulative distributions of the compiled sampler (see
+        ``compile_sampler``), laid out like the block of ``to_arrays``.
+
+        Returns
+        -------
+        numpy.ndarray
+            array of shape (total number of bins, )
+        """
+        if self._cdf is None:
+            self.compile_sampler()
+        return self._cdf
+
+    def compile_alias_tables(self):
+        """Stacks the alias tables of all pairs into arrays of shape (number
+        of pairs, maximum number of bins) so that all pairs can be drawn at
+        once."""
+        if self._cdf is None:
+            self.compile_sampler()
+        shape = (len(self._num_bins), self._num_bins.max() if len(self._num_bins) else 0)
+        prob = np.ones(shape, dtype=np.float64)
+        alias = np.zeros(shape, dtype=np.intp)
+        for i, pair_data in enumerate(self._metadata_list):
+            prob[i, :self._num_bins[i]], alias[i, :self._num_bins[i]] = pair_data.build_alias_table()
+        self._alias_prob = prob
+        self._alias = alias
+
+    def sample_indices(self, uniforms):
+        """Converts uniform random numbers into bin indices by inverting the
+        cumulative distribution of every pair.
+
+        Parameters
+        ----------
+        uniforms : numpy.ndarray
+            uniform random numbers on [0, 1) with shape (..., number of pairs).
+
+        Returns
+        -------
+        numpy.ndarray
+            bin indices with the same shape as ``uniforms``.
+        """
+        if self._cdf is None:
+            self.compile_sampler()
+        uniforms = np.asarray(uniforms, dtype=np.float64)
+        num_pairs = len(self._num_bins)
+        if uniforms.shape[-1] != num_pairs:
+            raise ValueError('Expected {} uniforms per sample, got {}'.format(num_pairs, uniforms.shape[-1]))
+
+        flat = np.searchsorted(self._cdf, uniforms + np.arange(num_pairs), side='right')
+        return np.minimum(flat - self._offsets[:-1], self._num_bins - 1)
+
+    def _bins_at(self, indices):
+        """Bins of every pair at ``indices`` of shape (..., number of pairs)."""
+        return self._bins[self._offsets[:-1] + indices].astype(np.float64, copy=False)
+
+    def inverse_cdf(self, uniforms):
+        """Converts uniform random numbers into targets for every pair.
+
+        Parameters
+        ----------
+        uniforms : numpy.ndarray
+            uniform random numbers on [0, 1) with shape (..., number of pairs).
+
+        Returns
+        -------
+        numpy.ndarray
+            targets with the same shape as ``uniforms``.
+        """
+        return self._bins_at(self.sample_indices(uniforms))
+
+    def bin_indices(self, targets):
+        """Converts targets back into the index of their bin.
+
+        Parameters
+        ----------
+        targets : numpy.ndarray
+            targets with shape (..., number of pairs), such as those returned by ``sample``.
+
+        Returns
+        -------
+        numpy.ndarray
+            bin indices with the same shape as ``targets``.
+        """
+        if self._cdf is None:
+            self.compile_sampler()
+        targets = np.asarray(targets, dtype=np.float64)
+        indices = np.empty(targets.shape, dtype=np.intp)
+        for i in range(len(self._num_bins)):
+            indices[..., i] = np.searchsorted(self._bins[self._offsets[i]:self._offsets[i + 1]], targets[..., i])
+        return np.minimum(indices, self._num_bins - 1)
+
+    def _padded(self, values, fill):
+        """Per-pair slices of a flat array of the sampler layout, stacked into
+        an array of shape (number of pairs, maximum number of bins)."""
+        num_pairs = len(self._num_bins)
+        grid = np.empty((num_pairs, self._num_bins.max() if num_pairs else 0), dtype=np.float64)
+        for i in range(num_pairs):
+            row = values[self._offsets[i]:self._offsets[i + 1]]
+            grid[i, :len(row)] = row
+            grid[i, len(row):] = fill(row)
+        return grid
+
+    def bin_grid(self):
+        """Bins of all pairs, padded with the last bin to the maximum number
+        of bins.
+
+        Returns
+        -------
+        numpy.ndarray
+            array of shape (number of pairs, maximum number of bins)
+        """
+        if self._cdf is None:
+            self.compile_sampler()
+        return self._padded(self._bins, lambda row: row[-1])
+
+    def probabilities(self):
+        """Normalized distributions of all pairs, padded with zeros to the
+        maximum number of bins.
+
+        Returns
+        -------
+        numpy.ndarray
+            array of shape (number of pairs, maximum number of bins)
+        """
+        if self._cdf is None:
+            self.compile_sampler()
+        cdf = self._padded(self._cdf, lambda row: row[-1]) - np.arange(len(self._num_bins))[:, np.newaxis]
+        return np.diff(cdf, axis=1, prepend=0.)
+
+    def stratified_sample(self, num_samples, random_state=None):
+        """Draws ``num_samples`` joint target sets with a Latin hypercube over
+        the pairs (see ``latin_hypercube``). The histogram of the targets of
+        each pair matches its distribution far more closely than independent
+        draws of the same size.
+
+        Parameters
+        ----------
+        num_samples : int
+            number of joint target sets to draw.
+        random_state : numpy.random.Generator, optional
+            source of randomness. If None, the global numpy random state is used, by default None
+
+        Returns
+        -------
+        numpy.ndarray
+            array of targets with shape (num_samples, number of pairs).
+        """
+        return self.inverse_cdf(latin_hypercube(num_samples, len(self._metadata_list), random_state))
+
+    def sample(self, num_samples=1, random_state=None, sampler=None):
+        """Draws targets for all pairs at once.
+
+        Parameters
+        ----------
+        num_samples : int, optional
+            number of joint target sets to draw, by default 1
+        random_state : numpy.random.Generator, optional
+            source of randomness. If None, the global numpy random state is used, by default None
+        sampler : str, optional
+            sampling backend to use instead of ``self.sampler``, by default None
+
+        Returns
+        -------
+        numpy.ndarray
+            array of targets with shape (num_samples, number of pairs). Columns follow the
+            order of ``self.names``.
+        """
+        sampler = sampler or self.sampler
+        if sampler not in SAMPLERS:
+            raise ValueError('{} is not a valid sampler. Choose one of {}'.format(sampler, SAMPLERS))
+
+        if sampler == 'choice':
+            choice = np.random.choice if random_state is None else random_state.choice
+            samples = np.empty((num_samples, len(self._metadata_list)), dtype=np.float64)
+            for i, pair_data in enumerate(self._metadata_list):
+                samples[:, i] = choice(pair_data.get('bins'), size=num_samples, p=pair_data.normalized())
+            return samples
+
+        num_pairs = len(self._metadata_list)
+        if sampler == 'cdf':
+            return self.inverse_cdf(_uniform((num_samples, num_pairs), random_state))
+
+        if self._alias_prob is None:
+            self.compile_alias_tables()
+        row = np.arange(num_pairs)
+        uniforms = _uniform((2, num_samples, num_pairs), random_state)
+        column = np.minimum((uniforms[0] * self._num_bins).astype(np.intp), self._num_bins - 1)
+        indices = np.where(uniforms[1] < self._alias_prob[row, column], column, self._alias[row, column])
+        return self._bins_at(indices)
+
+    def feasible_sample(self, num_samples, feasibility=None, block_size=4096, max_blocks=1000, random_state=None,
+                        sampler=None):
+        """Draws joint target sets that pass a FeasibilityFilter. Candidates
+        are drawn and checked in blocks of ``block_size``.
+
+        Parameters
+        ----------
+        num_samples : int
+            number of feasible target sets to return.
+        feasibility : FeasibilityFilter, optional
+            filter to apply. If None, a filter with triangle constraints only is built, by default None
+        block_size : int, optional
+            number of candidates drawn at once, by default 4096
+        max_blocks : int, optional
+            give up after this many blocks, by default 1000
+        random_state : numpy.random.Generator, optional
+            source of randomness. If None, the global numpy random state is used, by default None
+        sampler : str, optional
+            sampling backend to use instead of ``self.sampler``, by default None
+
+        Returns
+        -------
+        tuple
+            (targets, acceptance rate): array of shape (num_samples, number of pairs) and the
+            fraction of candidates drawn by this call that were accepted.
+
+        Raises
+        ------
+        RuntimeError
+            if not enough feasible candidates are found within ``max_blocks`` blocks.
+        """
+        if feasibility is None:
+            feasibility = FeasibilityFilter(self)
+        accepted = []
+        num_accepted = 0
+        num_drawn = 0
+        while num_accepted < num_samples:
+            if num_drawn >= max_blocks * block_size:
+                raise RuntimeError('Only {} of {} feasible target sets found in {} candidates'.format(
+                    num_accepted, num_samples, num_drawn))
+            candidates = self.sample(num_samples=block_size, random_state=random_state, sampler=sampler)
+            candidates = candidates[feasibility.feasible(candidates)]
+            accepted.append(candidates)
+            num_accepted += len(candidates)
+            num_drawn += block_size
+        return np.concatenate(accepted)[:num_samples], num_accepted / num_drawn
+
+    def re_sample(self, random_state=None):
         """Re-sample from the joint space. Do normalization just in case the
         data aren't normalized already.
 
+        Parameters
+        ----------
+        random_state : numpy.random.Generator, optional
+            source of randomness. If None, the global numpy random state is used, by default None
+
         Returns
         -------
         dict
             dictionary of targets, drawn from DEER distributions.
         """
-        answer = {}
-        for pair_data in self._metadata_list:
-            name = pair_data.__getattribute__('name')
-            distribution = pair_data.get('distribution')
-            bins = pair_data.get('bins')
+        targets = self.sample(random_state=random_state)[0]
+        return {pair_data.name: targets[i] for i, pair_data in enumerate(self._metadata_list)}
+
+
+class FeasibilityFilter:
+    """Rejects joint target sets that are geometrically impossible.
+
+    Each restraint acts between the first and the last atom of its ``sites``.
+    Whenever three restraints connect three atoms pairwise, their targets must
+    satisfy the triangle inequality. Optional per-pair bounds can be supplied
+    as well. Candidates are checked in vectorized blocks and the filter keeps
+    count of how many candidates it has accepted.
+    """
+
+    def __init__(self, pairs: MultiPair, bounds=None, tolerance=0., triangle_chunk=1024):
+        """
+        Parameters
+        ----------
+        pairs : MultiPair
+            pair data the candidates are drawn from.
+        bounds : dict, optional
+            (lower, upper) bounds on the target of a pair, keyed by pair name. Either bound
+            may be None, by default None
+        tolerance : float, optional
+            slack allowed in the triangle inequality, in the units of the bins, by default 0.
+        triangle_chunk : int, optional
+            number of triangles checked at once; limits the memory used per block, by default 1024
+        """
+        self.tolerance = tolerance
+        self.triangle_chunk = triangle_chunk
+        self.num_drawn = 0
+        self.num_accepted = 0
+
+        num_pairs = len(pairs.names)
+        self.lower = np.full(num_pairs, -np.inf)
+        self.upper = np.full(num_pairs, np.inf)
+        for name, (lower, upper) in (bounds or {}).items():
+            idx = pairs.name_to_id(name)
+            if lower is not None:
+                self.lower[idx] = lower
+            if upper is not None:
+                self.upper[idx] = upper
+
+        self.triangles = self.find_triangles(pairs)
+
+    @staticmethod
+    def find_triangles(pairs: MultiPair):
+        """Finds all sets of three restraints that connect three atoms
+        pairwise.
+
+        Parameters
+        ----------
+        pairs : MultiPair
+            pair data.
+
+        Returns
+        -------
+        numpy.ndarray
+            array of shape (number of triangles, 3) of pair indices.
+        """
+        edges = {}
+        neighbors = {}
+        for idx, pair_data in enumerate(pairs):
+            sites = pair_data.get('sites')
+            a, b = sites[0], sites[-1]
+            edges[frozenset((a, b))] = idx
+            neighbors.setdefault(a, set()).add(b)
+            neighbors.setdefault(b, set()).add(a)
+
+        triangles = set()
+        for edge, idx in edges.items():
+            if len(edge) != 2:
+                continue
+            a, b = edge
+            for c in neighbors[a] & neighbors[b]:
+                triangles.add(tuple(sorted((idx, edges[frozenset((a, c))], edges[frozenset((b, c))]))))
+        return np.array(sorted(triangles), dtype=np.intp).reshape(-1, 3)
+
+    @property
+    def acceptance_rate(self):
+        """Fraction of all candidates checked so far that were accepted.
+
+        Returns
+        -------
+        float
+        """
+        return self.num_accepted / self.num_drawn if self.num_drawn else 0.
 
-            normalized = np.divide(distribution, np.sum(distribution))
-            answer[name] = np.random.choice(bins, p=normalized)
+    def feasible(self, candidates):
+        """Checks a block of candidate target sets.
 
-        return answer
+        Parameters
+        ----------
+        candidates : numpy.ndarray
+            targets with shape (number of candidates, number of pairs).
+
+        Returns
+        -------
+        numpy.ndarray
+            boolean mask of the feasible candidates.
+        """
+        mask = np.all((candidates >= self.lower) & (candidates <= self.upper), axis=1)
+        for start in range(0, len(self.triangles), self.triangle_chunk):
+            sides = candidates[:, self.triangles[start:start + self.triangle_chunk]]
+            mask &= np.all(2 * sides.max(axis=2) <= sides.sum(axis=2) + self.tolerance, axis=1)
+        self.num_drawn += len(candidates)
+        self.num_accepted += int(np.count_nonzero(mask))
+        return mask
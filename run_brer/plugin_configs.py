@@ -2,15 +2,18 @@
 class corresponds to ONE restraint since gmxapi plugins each correspond to one
 restraint."""
 
-from run_brer.metadata import MetaData
+from run_brer.metadata import CompiledMetaData
+from run_brer.pair_data import plugin_name
 from abc import abstractmethod
 import gmx
 
 
-class PluginConfig(MetaData):
+class PluginConfig(CompiledMetaData):
     """Abstract class used to build training, convergence, and production
     plugins."""
 
+    __slots__ = ()
+
     def __init__(self):
         super().__init__('build_plugin')
 
@@ -25,10 +28,7 @@ class PluginConfig(MetaData):
             The dictionary may contain *extra* data, i.e., this can be a superset of the
             needed plugin data.
         """
-
-        for requirement in self.get_requirements():
-            if requirement in dictionary.keys():
-                self._metadata[requirement] = dictionary[requirement]
+        self.update_from_dictionary(dictionary)
 
     def scan_metadata(self, data):
         """This scans a RunData or PairData obj and stores whatever parameters
@@ -39,7 +39,7 @@ class PluginConfig(MetaData):
         data :
             either type RunData or type PairData
         """
-        self.scan_dictionary(data.get_as_dictionary())
+        self.update_from(data)
 
     # def set_parameters(self, **kwargs):
     #     """
@@ -65,10 +65,12 @@ class PluginConfig(MetaData):
 
 
 class TrainingPluginConfig(PluginConfig):
+    __slots__ = ()
+    parameters = ('sites', 'target', 'A', 'tau', 'tolerance', 'num_samples', 'logging_filename')
+
     def __init__(self):
         super().__init__()
         self.name = 'training'
-        self.set_requirements(['sites', 'target', 'A', 'tau', 'tolerance', 'num_samples', 'logging_filename'])
 
     def build_plugin(self):
         """Builds training phase plugin for BRER simulations.
@@ -90,15 +92,17 @@ class TrainingPluginConfig(PluginConfig):
                                              operation="brer_restraint",
                                              depends=[],
                                              params=self.get_as_dictionary())
-        potential.name = '{}'.format(self.get('sites'))
+        potential.name = plugin_name(self.get('sites'))
         return potential
 
 
 class ConvergencePluginConfig(PluginConfig):
+    __slots__ = ()
+    parameters = ('sites', 'alpha', 'target', 'tolerance', 'sample_period', 'logging_filename')
+
     def __init__(self):
         super().__init__()
         self.name = 'convergence'
-        self.set_requirements(['sites', 'alpha', 'target', 'tolerance', 'sample_period', 'logging_filename'])
 
     def build_plugin(self):
         """Builds convergence phase plugin for BRER simulations.
@@ -119,15 +123,17 @@ class ConvergencePluginConfig(PluginConfig):
                                              operation="linearstop_restraint",
                                              depends=[],
                                              params=self.get_as_dictionary())
-        potential.name = '{}'.format(self.get('sites'))
+        potential.name = plugin_name(self.get('sites'))
         return potential
 
 
 class ProductionPluginConfig(PluginConfig):
+    __slots__ = ()
+    parameters = ('sites', 'target', 'alpha', 'sample_period', 'logging_filename')
+
     def __init__(self):
         super().__init__()
         self.name = 'production'
-        self.set_requirements(['sites', 'target', 'alpha', 'sample_period', 'logging_filename'])
 
     def build_plugin(self):
         """Builds production phase plugin for BRER simulations.
@@ -148,5 +154,5 @@ class ProductionPluginConfig(PluginConfig):
                                              operation="linear_restraint",
                                              depends=[],
                                              params=self.get_as_dictionary())
-        potential.name = '{}'.format(self.get('sites'))
+        potential.name = plugin_name(self.get('sites'))
         return potential
@@ -0,0 +1,300 @@
+"""Retention of checkpoints and trajectories of finished phases.
+
+Every phase leaves ``state.cpt``, ``state_prev.cpt``, step-numbered
+checkpoints and trajectory parts in its directory (see DirectoryHelper), so
+the disk use of an ensemble grows with every iteration. A RetentionPolicy
+decides which of these files are still needed:
+
+* a finished training phase's checkpoints are never read again (convergence
+  starts from the production checkpoint of the previous iteration), so they
+  are dropped once the next phase starts;
+* ``state_prev.cpt`` and step-numbered checkpoints of finished phases are
+  dropped, keeping only their ``state.cpt``;
+* the checkpoints of the last ``keep_checkpoints`` iterations are kept, the
+  older ones dropped; so are the trajectories of those iterations, except for
+  the phases in ``keep_trajectories`` (by default production);
+* optionally, iteration directories older than ``archive_after`` iterations
+  are packed into a compressed ``mem_N/<iteration>.tar.<compression>``.
+
+Only finished phases are touched. A RetentionManager applies the policy in a
+pool of background threads while the next phase runs, and keeps count of the
+bytes it deleted and archived per member in ``mem_N/retention.json``.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from run_brer.directory_helper import PHASE_ORDER
+from run_brer.state_store import atomic_write_json
+
+#: Name of the byte accounting file in each member directory.
+RETENTION_FILE = 'retention.json'
+
+#: Compression of archived iteration directories understood by tarfile.
+COMPRESSIONS = ('gz', 'bz2', 'xz')
+
+
+def _is_checkpoint(name):
+    return name.endswith('.cpt') or name.endswith('.cpt.bak')
+
+
+class RetentionPolicy:
+    """Which files of finished phases to keep, delete or archive."""
+
+    def __init__(self, keep_checkpoints=2, keep_trajectories=('production', ), drop_training_cpt=True,
+                 drop_intermediate_cpt=True, archive_after=None, compression='gz'):
+        """
+        Parameters
+        ----------
+        keep_checkpoints : int, optional
+            number of previous iterations whose checkpoints (and trajectories, see
+            ``keep_trajectories``) are kept. At least 1, since the next iteration starts
+            from the production checkpoint of the previous one, by default 2
+        keep_trajectories : tuple, optional
+            phases whose trajectories are kept in every iteration, by default ('production', )
+        drop_training_cpt : bool, optional
+            drop the checkpoints of a training phase once it has finished, by default True
+        drop_intermediate_cpt : bool, optional
+            drop ``state_prev.cpt`` and step-numbered checkpoints of finished phases, by
+            default True
+        archive_after : int, optional
+            pack iteration directories more than this many iterations old into a compressed
+            tar file, or never if None, by default None
+        compression : str, optional
+            one of ``COMPRESSIONS``, by default 'gz'
+        """
+        if keep_checkpoints < 1:
+            raise ValueError('The checkpoints of at least the previous iteration must be kept')
+        if archive_after is not None and archive_after < 1:
+            raise ValueError('Only iterations before the previous one can be archived')
+        if compression not in COMPRESSIONS:
+            raise ValueError('{} is not a valid compression. Choose one of {}'.format(compression, COMPRESSIONS))
+        self.keep_checkpoints = keep_checkpoints
+        self.keep_trajectories = tuple(keep_trajectories)
+        self.drop_training_cpt = drop_training_cpt
+        self.drop_intermediate_cpt = drop_intermediate_cpt
+        self.archive_after = archive_after
+        self.compression = compression
+
+    def archive_path(self, paths, iteration):
+        """Archive of an iteration directory.
+
+        Parameters
+        ----------
+        paths : PathPlan
+            paths of the member.
+        iteration : int
+            BRER iteration.
+
+        Returns
+        -------
+        pathlib.Path
+        """
+        return paths.member_dir / '{}.tar.{}'.format(iteration, self.compression)
+
+    def plan(self, paths, iteration, phase, iterations):
+        """Files and directories of finished phases to delete or archive when
+        ``phase`` of ``iteration`` starts.
+
+        Parameters
+        ----------
+        paths : PathPlan
+            paths of the member.
+        iteration : int
+            current BRER iteration.
+        phase : str
+            current phase.
+        iterations : iterable
+            iterations to consider.
+
+        Returns
+        -------
+        list
+            ``('delete', path)`` and ``('archive', iteration)`` tuples.
+        """
+        actions = []
+        for i in sorted(iterations):
+            age = iteration - i
+            if age < 0:
+                continue
+            if self.archive_after is not None and age > self.archive_after:
+                if paths.member_dir.joinpath(str(i)).is_dir():
+                    actions.append(('archive', i))
+                continue
+            for phase_name in PHASE_ORDER:
+                if age == 0 and PHASE_ORDER.index(phase_name) >= PHASE_ORDER.index(phase):
+                    break
+                phase_dir = paths.phase_dir(i, phase_name)
+                if not phase_dir.is_dir():
+                    continue
+                for entry in os.scandir(phase_dir):
+                    if _is_checkpoint(entry.name):
+                        drop = (age > self.keep_checkpoints
+                                or (phase_name == 'training' and self.drop_training_cpt)
+                                or (entry.name != 'state.cpt' and self.drop_intermediate_cpt))
+                    else:
+                        drop = (entry.name.endswith('.xtc') and age > self.keep_checkpoints
+                                and phase_name not in self.keep_trajectories)
+                    if drop:
+                        actions.append(('delete', phase_dir / entry.name))
+        return actions
+
+
+class RetentionManager:
+    """Applies a RetentionPolicy to ensemble members in background
+    threads."""
+
+    def __init__(self, policy=None, workers=2):
+        """
+        Parameters
+        ----------
+        policy : RetentionPolicy, optional
+            the policy, by default RetentionPolicy()
+        workers : int, optional
+            number of background threads, by default 2
+        """
+        self.policy = policy or RetentionPolicy()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='run_brer-retention')
+        self._lock = threading.Lock()
+        # member directory -> lock that serializes the jobs of the member
+        self._member_locks = {}
+        # members whose iterations have all been considered once
+        self._scanned = set()
+        self._futures = []
+        self._logger = logging.getLogger('BRER')
+
+    def _member_lock(self, member_dir):
+        with self._lock:
+            return self._member_locks.setdefault(member_dir, threading.Lock())
+
+    def _iterations(self, paths, iteration):
+        """Iterations to consider: all of them the first time a member is
+        seen, afterwards only those that just crossed a threshold of the
+        policy."""
+        member_dir = str(paths.member_dir)
+        if member_dir not in self._scanned:
+            self._scanned.add(member_dir)
+            return [int(entry.name) for entry in os.scandir(member_dir) if entry.name.isdigit() and entry.is_dir()]
+        thresholds = {0, 1, self.policy.keep_checkpoints + 1}
+        if self.policy.archive_after is not None:
+            thresholds.add(self.policy.archive_after + 1)
+        return [iteration - age for age in thresholds if iteration - age >= 0]
+
+    def _archive(self, paths, iteration):
+        directory = paths.member_dir / str(iteration)
+        archive = self.policy.archive_path(paths, iteration)
+        size = sum(os.path.getsize(os.path.join(dirpath, filename)) for dirpath, _, filenames in os.walk(directory)
+                   for filename in filenames)
+        if not archive.exists():
+            # Only an archive that was completely written replaces the directory.
+            tmp = '{}.tmp'.format(archive)
+            with tarfile.open(tmp, 'w:{}'.format(self.policy.compression)) as tar:
+                tar.add(str(directory), arcname=str(iteration))
+            os.replace(tmp, str(archive))
+        # The archive may be from an earlier run that was stopped while removing the directory.
+        shutil.rmtree(str(directory))
+        return size, os.path.getsize(str(archive))
+
+    def apply(self, paths, iteration, phase):
+        """Applies the policy to a member whose ``phase`` of ``iteration``
+        has started.
+
+        Parameters
+        ----------
+        paths : PathPlan
+            paths of the member.
+        iteration : int
+            current BRER iteration.
+        phase : str
+            current phase.
+
+        Returns
+        -------
+        dict
+            bytes deleted, archived (before compression) and written to archives by this call.
+        """
+        accounting = {'deleted': 0, 'archived': 0, 'archive_size': 0}
+        with self._member_lock(str(paths.member_dir)):
+            for action, target in self.policy.plan(paths, iteration, phase, self._iterations(paths, iteration)):
+                if action == 'delete':
+                    try:
+                        size = os.path.getsize(str(target))
+                        os.remove(str(target))
+                    except FileNotFoundError:
+                        continue
+                    accounting['deleted'] += size
+                else:
+                    archived, archive_size = self._archive(paths, target)
+                    accounting['archived'] += archived
+                    accounting['archive_size'] += archive_size
+            if any(accounting.values()):
+                total = self.usage(paths)
+                for key, value in accounting.items():
+                    total[key] = total.get(key, 0) + value
+                atomic_write_json(total, str(paths.member_dir / RETENTION_FILE))
+                self._logger.info('Retention of {}: {}'.format(paths.member_dir, accounting))
+        return accounting
+
+    def _apply(self, paths, iteration, phase):
+        try:
+            return self.apply(paths, iteration, phase)
+        except OSError as error:
+            # Disk space is not worth failing the simulation for: retry with the next phase.
+            self._logger.warning('Retention of {} failed: {}'.format(paths.member_dir, error))
+            with self._lock:
+                self._scanned.discard(str(paths.member_dir))
+            return None
+
+    def submit(self, paths, iteration, phase):
+        """Applies the policy in the background (see ``apply``).
+
+        Returns
+        -------
+        concurrent.futures.Future
+        """
+        future = self._executor.submit(self._apply, paths, iteration, phase)
+        with self._lock:
+            self._futures = [f for f in self._futures if not f.done()] + [future]
+        return future
+
+    def wait(self):
+        """Waits for the submitted jobs to finish."""
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.result()
+
+    def shutdown(self, wait=True):
+        """Stops the background threads.
+
+        Parameters
+        ----------
+        wait : bool, optional
+            wait for the submitted jobs to finish, by default True
+        """
+        self._executor.shutdown(wait=wait)
+
+    @staticmethod
+    def usage(paths):
+        """Bytes deleted and archived so far for a member.
+
+        Parameters
+        ----------
+        paths : PathPlan
+            paths of the member.
+
+        Returns
+        -------
+        dict
+            ``deleted``, ``archived`` (before compression) and ``archive_size`` in bytes.
+        """
+        filename = paths.member_dir / RETENTION_FILE
+        if not filename.exists():
+            return {'deleted': 0, 'archived': 0, 'archive_size': 0}
+        with open(str(filename)) as fh:
+            return json.load(fh)
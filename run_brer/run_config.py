@@ -1,22 +1,258 @@
 """RunConfig class handles the actual workflow logic."""
 
 from run_brer.run_data import RunData
-from run_brer.pair_data import MultiPair
+from run_brer.pair_data import MultiPair, index_filename
 from run_brer.plugin_configs import TrainingPluginConfig, ConvergencePluginConfig, ProductionPluginConfig, PluginConfig
-from run_brer.directory_helper import DirectoryHelper
+from run_brer.directory_helper import PathPlan
+from run_brer.target_schedule import TargetSchedule
+from run_brer.shared_pairs import SharedPairCache
+from run_brer.state_store import StateStore, open_state_store
+from run_brer.history import HISTORY_FILE, HistoryWriter
+from run_brer.coverage import coverage_reached
+from run_brer.signals import StopSignalHandler, mdrun_stop_signal
+from run_brer.handoff import CheckpointHandoff
+from run_brer.staging import PhaseStaging
+from run_brer.artifacts import ArtifactStore
+from run_brer.retention import RetentionManager, RetentionPolicy
+from abc import ABC, abstractmethod
+from contextlib import nullcontext
 from copy import deepcopy
 import os
 import shutil
 import logging
 import gmx
+import atexit
 import json
-# import atexit
+import time
 
 
-class RunConfig:
+#: File in the phase directory that holds the training progress of an interrupted training phase.
+PARTIAL_TRAINING = 'partial_training.json'
+
+#: Fraction of the production time a production phase may end short of its end time and still count
+#: as complete.
+END_TIME_TOLERANCE = 0.01
+
+
+def _resolve_inputs(artifacts, ensemble_dir, tpr, pairs_json):
+    """Resolves the tpr and pair data through an artifact store (see
+    run_brer.artifacts).
+
+    Returns
+    -------
+    tuple
+        the store (None if not used), the path to read the tpr from and the pair data.
+    """
+    if artifacts is True:
+        artifacts = ArtifactStore(ensemble_dir)
+    if not artifacts:
+        return None, tpr, pairs_json
+    tpr = artifacts.resolve(tpr)
+    if not isinstance(pairs_json, MultiPair):
+        # Binary pair data are read together with their index.
+        companions = (index_filename(pairs_json), ) if os.path.splitext(pairs_json)[1] == '.npy' else ()
+        pairs_json = artifacts.resolve(pairs_json, companions)
+    return artifacts, tpr, pairs_json
+
+
+class GmxEngine:
+    """Runs the MD of a phase as a gmxapi session."""
+
+    def __init__(self):
+        #: The signal of a stop requested while no MD was running (see ``request_stop``).
+        self.stop_requested = None
+
+    def run(self, tpr, workdir_list, plugins, **kwargs):
+        """Runs one array context.
+
+        Parameters
+        ----------
+        tpr : str or list
+            path to the tpr, or one path per element of the array.
+        workdir_list : list
+            working directory of each element of the array.
+        plugins : list
+            gmxapi WorkElements to add to the work graph of this rank.
+        **kwargs :
+            passed to ``gmx.workflow.from_tpr``.
+
+        Returns
+        -------
+        list
+            the restraint potentials of this rank after the run (``context.potentials``), or
+            an empty list if a stop was requested before the MD started.
+        """
+        md = gmx.workflow.from_tpr(tpr, **kwargs)
+        for plugin in plugins:
+            md.add_dependency(plugin)
+        context = gmx.context.ParallelArrayContext(md, workdir_list=workdir_list)
+        with context as session:
+            # The context is entered even so: setting it up is collective over the ranks.
+            if self.stop_requested is not None:
+                return []
+            session.run()
+        return context.potentials
+
+    def idle(self, tpr, workdir_list, **kwargs):
+        """Takes part in an array context without an element of the array on
+        this rank. Setting up the context is collective over all the ranks, so
+        a rank that has no member to run must still enter it; it builds no
+        restraints and runs no MD.
+
+        Parameters
+        ----------
+        tpr : str or list
+            path to the tpr, or one path per element of the array.
+        workdir_list : list
+            working directory of each element of the array.
+        **kwargs :
+            passed to ``gmx.workflow.from_tpr``.
+        """
+        context = gmx.context.ParallelArrayContext(gmx.workflow.from_tpr(tpr, **kwargs), workdir_list=workdir_list)
+        with context:
+            pass
+
+    def request_stop(self, signum=None):
+        """Asks the simulation to stop. Python only sees a signal while no MD
+        is running: mdrun traps SIGTERM and SIGUSR1 itself while it runs (and
+        stops early, see ``stop_signal``). A request made in between keeps any
+        further MD from starting.
+
+        Parameters
+        ----------
+        signum : int, optional
+            the signal that triggered the request, by default None
+        """
+        self.stop_requested = signum if signum is not None else True
+
+    def stop_signal(self, workdir):
+        """The signal that stopped the last MD in ``workdir`` before it
+        completed, if any (see run_brer.signals.mdrun_stop_signal).
+
+        Parameters
+        ----------
+        workdir : str
+            working directory of the run.
+
+        Returns
+        -------
+        int or None
+        """
+        return mdrun_stop_signal(workdir)
+
+
+class PhaseDriver(ABC):
+    """Runs BRER phases back to back in one process until an iteration or
+    time budget is used up. Subclasses provide ``run``, which performs one
+    phase and saves the state, and ``current_iteration``."""
+
+    #: The signal that asked the driver to stop, if any (see run_brer.signals).
+    stop_requested = None
+
+    def request_stop(self, signum=None):
+        """Do not start any further phase.
+
+        Parameters
+        ----------
+        signum : int, optional
+            the signal that triggered the request, by default None
+        """
+        self.stop_requested = signum if signum is not None else True
+
+    @abstractmethod
+    def current_iteration(self):
+        """The BRER iteration that is currently being run.
+
+        Returns
+        -------
+        int
+        """
+
+    @abstractmethod
+    def run(self):
+        """Perform one phase."""
+
+    def _refresh(self):
+        """Brings the state up to date before the stopping criteria are
+        checked."""
+
+    def _agree(self, stop):
+        """Whether to stop, given whether this process would. A driver spread
+        over several processes must make all of them take the same decision."""
+        return stop
+
+    def run_until(self, walltime=None, iteration=None, stop_on_coverage=False):
+        """Runs phases (training, convergence, production, training, ...)
+        until any of the stopping criteria is met. The state is saved after
+        every phase, so the run can be picked up again by a later launch.
+
+        Parameters
+        ----------
+        walltime : float, optional
+            do not start a phase once this many seconds have passed, by default None
+        iteration : int, optional
+            stop once this BRER iteration is reached, by default None
+        stop_on_coverage : bool, optional
+            stop once a CoverageMonitor has signalled that the ensemble covers the DEER
+            distributions (see run_brer.coverage), by default False
+
+        Returns
+        -------
+        int
+            the number of phases that were run.
+        """
+        start = time.time()
+        phases = 0
+        while True:
+            self._refresh()
+            reason = None
+            if self.stop_requested is not None:
+                reason = 'a stop was requested'
+            elif iteration is not None and self.current_iteration() >= iteration:
+                reason = 'reached iteration {}'.format(iteration)
+            elif walltime is not None and time.time() - start >= walltime:
+                reason = 'used up the walltime of {} s'.format(walltime)
+            elif stop_on_coverage and coverage_reached(self.ens_dir):
+                reason = 'coverage of the DEER distributions was reached'
+            if self._agree(reason is not None):
+                break
+            self.run()
+            phases += 1
+        if reason is None:
+            reason = 'a stop was requested' if self.stop_requested is not None else 'another process stopped'
+        logging.getLogger('BRER').info('Stopping after {} phases: {}'.format(phases, reason))
+        return phases
+
+    def run_iterations(self, num_iterations=1, walltime=None, stop_on_coverage=False):
+        """Runs phases until ``num_iterations`` more BRER iterations have been
+        completed (see ``run_until``).
+
+        Parameters
+        ----------
+        num_iterations : int, optional
+            number of iterations to complete, by default 1
+        walltime : float, optional
+            do not start a phase once this many seconds have passed, by default None
+        stop_on_coverage : bool, optional
+            stop once coverage of the DEER distributions has been reached, by default False
+
+        Returns
+        -------
+        int
+            the number of phases that were run.
+        """
+        return self.run_until(walltime=walltime, iteration=self.current_iteration() + num_iterations,
+                              stop_on_coverage=stop_on_coverage)
+
+
+class RunConfig(PhaseDriver):
     """Run configuration for single BRER ensemble member."""
 
-    def __init__(self, tpr, ensemble_dir, ensemble_num=1, pairs_json='pair_data.json'):
+    def __init__(self, tpr, ensemble_dir, ensemble_num=1, pairs_json='pair_data.json', target_schedule=None,
+                 shared_pairs=False, state_generations=0, state_store='json', state_options=None,
+                 record_history=True, engine=None, handle_signals=True, cpt_handoff='auto', scratch=None,
+                 sync_interval=60., precreate_iterations=0, metadata_counter=None, artifacts=None,
+                 retention=None):
         """The run configuration specifies the files and directory structure
         used for the run. It determines whether the run is in the training,
         convergence, or production phase, then performs the run.
@@ -29,39 +265,138 @@ class RunConfig:
             path to top directory which contains the full ensemble.
         ensemble_num : int, optional
             the ensemble member to run, by default 1
-        pairs_json : str, optional
+        pairs_json : str or MultiPair, optional
             path to file containing *ALL* the pair metadata.
-            An example of what such a file should look like is provided in the data directory,
-            by default 'pair_data.json'
+            An example of what such a file should look like is provided in the data directory.
+            Pair data converted with run_brer.pair_data.convert_json_to_binary (a ``.npy`` file)
+            are memory-mapped instead. Pair data that have already been loaded may be passed
+            directly, by default 'pair_data.json'
+        target_schedule : str or TargetSchedule, optional
+            pre-generated targets for the ensemble (see run_brer.target_schedule), or the path
+            to a saved schedule. If provided, training looks up its targets instead of
+            re-sampling them, by default None
+        shared_pairs : bool, optional
+            attach to a node-wide shared-memory copy of the pair data (see
+            run_brer.shared_pairs) instead of parsing the file in this process, by default False
+        state_generations : int, optional
+            number of previous versions of state.json to keep next to it (state.json.1, ...),
+            by default 0
+        state_store : str or StateStore, optional
+            how the state of the member is persisted: 'json' rewrites state.json on every save,
+            'journal' appends each change to state.journal and compacts it into state.json
+            periodically and 'sqlite' keeps the state of the whole ensemble in
+            ensemble_dir/state.db (see run_brer.state_store). A StateStore instance is used as is,
+            by default 'json'
+        state_options : dict, optional
+            keyword arguments for the state store, e.g. ``{'journal_mode': 'wal'}`` for 'sqlite'
+            when all the members run on one host, or ``{'compact_every': 64}`` for 'journal',
+            by default None
+        record_history : bool, optional
+            append the targets, alphas and wallclock time of every phase to mem_N/history.bin
+            (see run_brer.history), which is also where a CoverageMonitor reads the targets
+            from, by default True
+        engine : GmxEngine, optional
+            runs the MD of each phase, by default GmxEngine()
+        handle_signals : bool, optional
+            while a phase runs, turn SIGTERM and SIGUSR1 into a checkpoint and a clean stop
+            (see run_brer.signals), by default True
+        cpt_handoff : str or CheckpointHandoff, optional
+            how the checkpoint of the previous phase is brought into a new phase directory: one
+            of 'auto', 'reflink', 'hardlink', 'rename', 'symlink' or 'copy' (see
+            run_brer.handoff). Training and convergence both start from the production
+            checkpoint of the previous iteration, so that checkpoint is never renamed. 'symlink'
+            cannot be combined with ``retention``, by default 'auto'
+        scratch : str, optional
+            node-local directory to run the phases in. Output is synced back to the phase
+            directory in the background and completely before the state advances (see
+            run_brer.staging). If None, phases run in the phase directory, by default None
+        sync_interval : float, optional
+            seconds between two background syncs from scratch, by default 60.
+        precreate_iterations : int, optional
+            when a phase directory has to be created, also create those of this many
+            following iterations, which saves metadata operations on parallel file systems,
+            by default 0
+        metadata_counter : callable, optional
+            hook called as ``metadata_counter(operation, path)`` for the metadata operations
+            of the member's PathPlan, e.g. a run_brer.directory_helper.MetadataCounter. If it
+            has a ``reset`` method, the counts are logged after every phase, by default None
+        artifacts : bool or ArtifactStore, optional
+            read the tpr and pair data from the node-local cache of a content-addressed
+            store (see run_brer.artifacts). True uses an ArtifactStore in ``ensemble_dir``
+            with the default node cache, by default None
+        retention : RetentionPolicy or RetentionManager, optional
+            delete or archive the checkpoints and trajectories of finished phases that are no
+            longer needed, in the background while the next phase runs (see
+            run_brer.retention). If None, every file is kept, by default None
         """
+        self.artifacts, tpr, pairs_json = _resolve_inputs(artifacts, ensemble_dir, tpr, pairs_json)
         self.tpr = tpr
         self.ens_dir = ensemble_dir
+        self.engine = engine if engine is not None else GmxEngine()
+        self.handle_signals = handle_signals
+        self.handoff = cpt_handoff if isinstance(cpt_handoff, CheckpointHandoff) else CheckpointHandoff(cpt_handoff)
+        self.scratch = scratch
+        self.sync_interval = sync_interval
+        self.precreate_iterations = precreate_iterations
+        if retention is not None and self.handoff.strategy == 'symlink':
+            raise ValueError('Symlinked checkpoints would dangle once retention deletes their source')
+        if isinstance(retention, RetentionPolicy):
+            retention = RetentionManager(retention)
+        self.retention = retention
+        self.paths = PathPlan(ensemble_dir, ensemble_num, counter=metadata_counter)
 
         # a list of identifiers of the residue-residue pairs that will be restrained
         self.__names = []
 
         # Load the pair data from a json. Use this to set up the run metadata
-        self.pairs = MultiPair()
-        self.pairs.read_from_json(pairs_json)
+        if isinstance(pairs_json, MultiPair):
+            self.pairs = pairs_json
+        elif shared_pairs:
+            self._pair_cache = SharedPairCache(pairs_json)
+            self.pairs = self._pair_cache.attach()
+            atexit.register(self._pair_cache.detach)
+        else:
+            self.pairs = MultiPair()
+            self.pairs.read(pairs_json)
         # use the same identifiers for the pairs here as those provided in the pair metadata
         # file this prevents mixing up pair data amongst the different pairs (i.e.,
         # accidentally applying the restraints for pair 1 to pair 2.)
         self.__names = self.pairs.names
 
+        if isinstance(target_schedule, str):
+            target_schedule = TargetSchedule.load(target_schedule)
+        if target_schedule is not None and set(target_schedule.names) != set(self.__names):
+            raise ValueError('The target schedule was generated for pairs {}, not {}'.format(
+                target_schedule.names, self.__names))
+        self.target_schedule = target_schedule
+
         self.run_data = RunData()
         self.run_data.set(ensemble_num=ensemble_num)
 
-        self.state_json = '{}/mem_{}/state.json'.format(ensemble_dir, self.run_data.get('ensemble_num'))
+        self.paths.makedirs(self.paths.member_dir)
+        self.state_json = str(self.paths.state_json)
+        # The state is written atomically and only when it has changed.
+        if isinstance(state_store, StateStore):
+            self.state_store = state_store
+        else:
+            state_options = dict(state_options or {})
+            if state_store == 'json':
+                state_options.setdefault('generations', state_generations)
+            self.state_store = open_state_store(state_store, ensemble_dir, ensemble_num, **state_options)
         # If we're in the middle of a run, load the BRER checkpoint file and continue from
         # the current state.
-        if os.path.exists(self.state_json):
-            self.run_data.from_dictionary(json.load(open(self.state_json)))
+        if self.state_store.exists():
+            self.state_store.load(self.run_data)
         # Otherwise, populate the state information using the pre-loaded pair data. Then save
         # the current state.
         else:
             for pd in self.pairs:
                 self.run_data.from_pair_data(pd)
-            self.run_data.save_config(self.state_json)
+            self.state_store.save(self.run_data)
+
+        self.history = None
+        if record_history:
+            self.history = HistoryWriter(str(self.paths.member_dir / HISTORY_FILE), self.__names, ensemble_num)
 
         # List of plugins
         self.__plugins = []
@@ -69,32 +404,29 @@ class RunConfig:
         # Logging
         self._logger = logging.getLogger('BRER')
         self._logger.setLevel(logging.DEBUG)
-        # create file handler which logs even debug messages
-        fh = logging.FileHandler('brer{}.log'.format(ensemble_num))
-        fh.setLevel(logging.DEBUG)
-        # create console handler with a higher log level
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
+        # Several members may be configured in one process (see EnsembleRunConfig): only add
+        # each handler once.
+        log_file = os.path.abspath('brer{}.log'.format(ensemble_num))
+        log_files = {getattr(handler, 'baseFilename', None) for handler in self._logger.handlers}
+        has_console = any(type(handler) is logging.StreamHandler for handler in self._logger.handlers)
         # create formatter and add it to the handlers
         formatter = logging.Formatter('%(asctime)s:%(name)s:%(levelname)s - %(message)s')
-        fh.setFormatter(formatter)
-        ch.setFormatter(formatter)
-        # add the handlers to the logger
-        self._logger.addHandler(fh)
-        self._logger.addHandler(ch)
+        if log_file not in log_files:
+            # create file handler which logs even debug messages
+            fh = logging.FileHandler(log_file)
+            fh.setLevel(logging.DEBUG)
+            fh.setFormatter(formatter)
+            self._logger.addHandler(fh)
+        if not has_console:
+            # create console handler with a higher log level
+            ch = logging.StreamHandler()
+            ch.setLevel(logging.DEBUG)
+            ch.setFormatter(formatter)
+            self._logger.addHandler(ch)
 
         self._logger.info("Initialized the run configuration: {}".format(self.run_data.as_dictionary()))
         self._logger.info("Names of restraints: {}".format(self.__names))
 
-        # Need to cleanly handle cancelled jobs: write out a checkpoint of the state if the
-        # job is exited.
-        # def cleanup():
-        #     """"""
-        #     self.run_data.save_config(self.state_json)
-        #     self._logger.info("BRER received INT signal, stopping and saving data to {}".format(self.state_json))
-
-        # atexit.register(cleanup)
-
     def build_plugins(self, plugin_config: PluginConfig):
         """Builds the plugin configuration. For each pair-wise restraint,
         populate the plugin with data: both the "general" data and the data
@@ -119,154 +451,538 @@ class RunConfig:
             new_restraint.scan_metadata(pair_params)  # load pair-specific data into current restraint
             self.__plugins.append(new_restraint.build_plugin())
 
+    @property
+    def plugins(self):
+        """Plugins built for the current phase (see ``build_plugins``).
+
+        Returns
+        -------
+        list
+            gmxapi WorkElements, one per restraint.
+        """
+        return self.__plugins
+
+    def workdir(self):
+        """Working directory of the current phase
+        (ensemble_path/member_path/iteration/phase).
+
+        Returns
+        -------
+        str
+        """
+        return str(self.paths.phase_dir(self.run_data.get('iteration'), self.run_data.get('phase')))
+
     def __change_directory(self):
         # change into the current working directory (ensemble_path/member_path/iteration/phase)
-        dir_help = DirectoryHelper(top_dir=self.ens_dir, param_dict=self.run_data.general_params.get_as_dictionary())
-        dir_help.build_working_dir()
-        dir_help.change_dir('phase')
+        self.paths.chdir(
+            self.paths.make_phase_dir(self.run_data.get('iteration'), self.run_data.get('phase'),
+                                      ahead=self.precreate_iterations))
 
-    def __move_cpt(self):
+    def __move_cpt(self, workdir):
         current_iter = self.run_data.get('iteration')
-        ens_num = self.run_data.get('ensemble_num')
         phase = self.run_data.get('phase')
 
         # If the cpt already exists, don't overwrite it
-        if os.path.exists('{}/mem_{}/{}/{}/state.cpt'.format(self.ens_dir, ens_num, current_iter, phase)):
+        if self.paths.exists(self.paths.checkpoint(current_iter, phase)):
             self._logger.info("Phase is {} and state.cpt already exists: not moving any files".format(phase))
-
+            return
+
+        # Training and convergence start from the production cpt of the previous iteration (if
+        # any), production from the convergence cpt of the current iteration.
+        gmx_cpt = self.paths.source_checkpoint(current_iter, phase)
+        if gmx_cpt is not None:
+            self.__handoff_cpt(str(gmx_cpt), '{}/state.cpt'.format(workdir), shared=(phase != 'production'))
+
+    def __handoff_cpt(self, src, dst, shared=False):
+        handoff = self.handoff
+        if shared and handoff.strategy == 'rename':
+            # The source has more than one consumer: it must stay where it is.
+            handoff = CheckpointHandoff('auto', verify=handoff.verify)
+        strategy = handoff.transfer(src, dst)
+        self._logger.info("Handed {} over to {} ({})".format(src, dst, strategy))
+
+    def __train(self, workdir):
+
+        cpt = '{}/state.cpt'.format(workdir)
+        if self.run_data.get('subphase') in ('running', 'interrupted'):
+            # This training phase was started before: keep its targets and continue from its
+            # checkpoint, if it wrote one.
+            targets = {name: self.run_data.get('target', name=name) for name in self.__names}
+            self._logger.info('Resuming {} training with targets: {}'.format(self.run_data.get('subphase'), targets))
+            if self.paths.exists('{}/{}'.format(workdir, PARTIAL_TRAINING)):
+                # The training plugin takes no initial alpha, so it estimates alpha from scratch;
+                # only the simulation continues from the checkpoint.
+                self._logger.info('Training progress of the interrupted run is kept in {}/{} but cannot be '
+                                  'restored into the plugins'.format(workdir, PARTIAL_TRAINING))
         else:
-            member_dir = '{}/mem_{}'.format(self.ens_dir, ens_num)
-            prev_iter = current_iter - 1
+            # do re-sampling, or look up the pre-generated targets for this iteration
+            if self.target_schedule is not None:
+                targets = self.target_schedule.get_targets(self.run_data.get('ensemble_num'),
+                                                           self.run_data.get('iteration'))
+            else:
+                targets = self.pairs.re_sample()
+            self._logger.info('New targets: {}'.format(targets))
+            for name in self.__names:
+                self.run_data.set(name=name, target=targets[name])
 
-            if phase in ['training', 'convergence']:
-                if prev_iter > -1:
-                    # Get the production cpt from previous iteration
-                    gmx_cpt = '{}/{}/production/state.cpt'.format(member_dir, prev_iter)
-                    shutil.copy(gmx_cpt, '{}/state.cpt'.format(os.getcwd()))
+            # The new targets are saved to the BRER checkpoint file by prepare_phase.
 
-                else:
-                    pass  # Do nothing
+            # A checkpoint left by an earlier training phase that never recorded its targets
+            # cannot be continued with the new ones: back it up.
+            if self.paths.exists(cpt):
+                self._logger.warning('There is a checkpoint file in your current working directory, but the '
+                                     'targets it was trained with are unknown. The cpt will be backed up and the '
+                                     'run will start over with new targets')
+                shutil.move(cpt, '{}.bak'.format(cpt))
 
-            else:
-                # Get the convergence cpt from current iteration
-                gmx_cpt = '{}/{}/convergence/state.cpt'.format(member_dir, current_iter)
-                shutil.copy(gmx_cpt, '{}/state.cpt'.format(os.getcwd()))
+        # If this is not the first BRER iteration, grab the checkpoint from the production
+        # phase of the last round (unless this phase already has its own)
+        self.__move_cpt(workdir)
 
-    def __train(self):
+        self.build_plugins(TrainingPluginConfig())
+        return {}
 
-        # do re-sampling
-        targets = self.pairs.re_sample()
-        self._logger.info('New targets: {}'.format(targets))
-        for name in self.__names:
-            self.run_data.set(name=name, target=targets[name])
+    def __converge(self, workdir):
 
-        # save the new targets to the BRER checkpoint file.
-        self.run_data.save_config(fnm=self.state_json)
+        self.__move_cpt(workdir)
 
-        # backup existing checkpoint.
-        # TODO: Don't backup the cpt, actually use it!!
-        cpt = '{}/state.cpt'.format(os.getcwd())
-        if os.path.exists(cpt):
-            self._logger.warning('There is a checkpoint file in your current working directory, but you are '
-                                 'training. The cpt will be backed up and the run will start over with new targets')
-            shutil.move(cpt, '{}.bak'.format(cpt))
+        self.build_plugins(ConvergencePluginConfig())
+        return {}
 
-        # If this is not the first BRER iteration, grab the checkpoint from the production
-        # phase of the last round
-        self.__move_cpt()
+    def __production(self, workdir):
 
-        # Set up a dictionary to go from plugin name -> restraint name
-        sites_to_name = {}
+        # Get the checkpoint file from the convergence phase
+        self.__move_cpt(workdir)
 
-        # Build the gmxapi session.
-        md = gmx.workflow.from_tpr(self.tpr, append_output=False)
-        self.build_plugins(TrainingPluginConfig())
-        for plugin in self.__plugins:
-            plugin_name = plugin.name
-            for name in self.__names:
-                run_data_sites = "{}".format(self.run_data.get('sites', name=name))
-                if run_data_sites == plugin_name:
-                    sites_to_name[plugin_name] = name
-            md.add_dependency(plugin)
-        context = gmx.context.ParallelArrayContext(md, workdir_list=[os.getcwd()])
+        self.build_plugins(ProductionPluginConfig())
+        return {'end_time': self.end_time()}
 
-        # Run it.
-        with context as session:
-            session.run()
+    def end_time(self):
+        """Time (in ps) at which the production phase of the current BRER
+        iteration should finish: the end time of the convergence run plus the
+        amount of production simulation specified by the user.
 
-        # In the future runs (convergence, production) we need the ABSOLUTE VALUE of alpha.
-        self._logger.info("=====TRAINING INFO======\n")
+        Returns
+        -------
+        float
+        """
+        return self.run_data.get('production_time') + self.run_data.get('start_time')
 
-        for i in range(len(self.__names)):
-            current_name = sites_to_name[context.potentials[i].name]
-            current_alpha = context.potentials[i].alpha
-            current_target = context.potentials[i].target
+    def prepare_phase(self, workdir):
+        """Gets the current phase ready to run in ``workdir``: draws the
+        targets (training), brings in the checkpoint of the previous phase and
+        builds the plugins (see ``plugins``). With a ``retention`` policy, the
+        files of finished phases are then cleaned up in the background.
 
-            self.run_data.set(name=current_name, alpha=current_alpha)
-            self.run_data.set(name=current_name, target=current_target)
-            self._logger.info("Plugin {}: alpha = {}, target = {}".format(current_name, current_alpha, current_target))
+        Parameters
+        ----------
+        workdir : str
+            working directory of the phase, which must exist.
 
-    def __converge(self):
+        Returns
+        -------
+        dict
+            keyword arguments for ``gmx.workflow.from_tpr``.
+        """
+        phase = self.run_data.get('phase')
+        if phase == 'training':
+            kwargs = self.__train(workdir)
+        elif phase == 'convergence':
+            kwargs = self.__converge(workdir)
+        else:
+            kwargs = self.__production(workdir)
+        kwargs['append_output'] = False
 
-        self.__move_cpt()
+        self.run_data.set(subphase='running')
+        self.state_store.save(self.run_data)
 
-        md = gmx.workflow.from_tpr(self.tpr, append_output=False)
-        self.build_plugins(ConvergencePluginConfig())
-        for plugin in self.__plugins:
-            md.add_dependency(plugin)
-        context = gmx.context.ParallelArrayContext(md, workdir_list=[os.getcwd()])
-        with context as session:
-            session.run()
+        # The checkpoint has been handed over: earlier phases can be cleaned up while this one runs.
+        if self.retention is not None:
+            self.retention.submit(self.paths, self.run_data.get('iteration'), phase)
+        return kwargs
 
-        # Get the absolute time (in ps) at which the convergence run finished.
-        # This value will be needed if a production run needs to be restarted.
-        self.run_data.set(start_time=context.potentials[0].time)
+    def finish_phase(self, potentials, wall_time=0.):
+        """Stores the results of the current phase, records them in the
+        history, moves on to the next phase and saves the state.
 
-        self._logger.info("=====CONVERGENCE INFO======\n")
-        for name in self.__names:
-            current_alpha = self.run_data.get('alpha', name=name)
-            current_target = self.run_data.get('target', name=name)
-            self._logger.info("Plugin {}: alpha = {}, target = {}".format(name, current_alpha, current_target))
+        Parameters
+        ----------
+        potentials : list
+            the restraint potentials of this member after the run (``context.potentials``).
+        wall_time : float, optional
+            wallclock duration of the phase in seconds, by default 0.
+        """
+        phase = self.run_data.get('phase')
+        iteration = self.run_data.get('iteration')
 
-    def __production(self):
+        if phase == 'training':
+            # In the future runs (convergence, production) we need the ABSOLUTE VALUE of alpha.
+            self._logger.info("=====TRAINING INFO======\n")
+
+            for potential in potentials:
+                # plugin name -> restraint name
+                current_name = self.pairs.name_from_plugin(potential.name)
+                current_alpha = potential.alpha
+                current_target = potential.target
+
+                self.run_data.set(name=current_name, alpha=current_alpha)
+                self.run_data.set(name=current_name, target=current_target)
+                self._logger.info("Plugin {}: alpha = {}, target = {}".format(current_name, current_alpha,
+                                                                              current_target))
+        else:
+            if phase == 'convergence':
+                # Get the absolute time (in ps) at which the convergence run finished.
+                # This value will be needed if a production run needs to be restarted.
+                self.run_data.set(start_time=potentials[0].time)
+                self._logger.info("=====CONVERGENCE INFO======\n")
+            else:
+                self._logger.info("=====PRODUCTION INFO======\n")
+            for name in self.__names:
+                current_alpha = self.run_data.get('alpha', name=name)
+                current_target = self.run_data.get('target', name=name)
+                self._logger.info("Plugin {}: alpha = {}, target = {}".format(name, current_alpha, current_target))
 
-        # Get the checkpoint file from the convergence phase
-        self.__move_cpt()
+        if self.history is not None:
+            targets = {name: self.run_data.get('target', name=name) for name in self.__names}
+            alphas = {name: self.run_data.get('alpha', name=name) for name in self.__names}
+            self.history.append(iteration, phase, targets, alphas, start_time=self.run_data.get('start_time'),
+                                wall_time=wall_time)
 
-        # Calculate the time (in ps) at which the BRER iteration should finish.
-        # This should be: the end time of the convergence run + the amount of time for
-        # production simulation (specified by the user).
-        end_time = self.run_data.get('production_time') + self.run_data.get('start_time')
+        if phase == 'training':
+            self.run_data.set(phase='convergence')
+        elif phase == 'convergence':
+            self.run_data.set(phase='production')
+        else:
+            self.run_data.set(phase='training', start_time=0, iteration=(iteration + 1))
+        self.run_data.set(subphase='pending')
+        self.state_store.save(self.run_data)
 
-        md = gmx.workflow.from_tpr(self.tpr, end_time=end_time, append_output=False)
+    def interrupt_phase(self, workdir, potentials=None):
+        """Saves the state of a phase that was stopped before it completed.
+        The phase stays current, marked as 'interrupted', so that the next
+        launch continues it from its checkpoint.
 
-        self.build_plugins(ProductionPluginConfig())
-        for plugin in self.__plugins:
-            md.add_dependency(plugin)
-        context = gmx.context.ParallelArrayContext(md, workdir_list=[os.getcwd()])
-        with context as session:
-            session.run()
+        Parameters
+        ----------
+        workdir : str
+            working directory of the phase.
+        potentials : list, optional
+            the restraint potentials after the stopped run, if any. For training, their alphas
+            and targets are saved to ``PARTIAL_TRAINING`` in ``workdir``, by default None
+        """
+        phase = self.run_data.get('phase')
+        if phase == 'training' and potentials:
+            progress = {
+                self.pairs.name_from_plugin(potential.name): {
+                    'alpha': potential.alpha,
+                    'target': potential.target
+                }
+                for potential in potentials
+            }
+            tmp = '{}/{}.tmp'.format(workdir, PARTIAL_TRAINING)
+            with open(tmp, 'w') as fh:
+                json.dump(progress, fh)
+            os.replace(tmp, '{}/{}'.format(workdir, PARTIAL_TRAINING))
+        self.run_data.set(subphase='interrupted')
+        self.state_store.save(self.run_data)
+        self._logger.info("The {} phase of iteration {} was interrupted; state saved to {}".format(
+            phase, self.run_data.get('iteration'), self.state_json))
+
+    def request_stop(self, signum=None):
+        """Asks the running phase to checkpoint and stop, and prevents
+        further phases from starting (see run_brer.signals).
 
-        self._logger.info("=====PRODUCTION INFO======\n")
-        for name in self.__names:
-            current_alpha = self.run_data.get('alpha', name=name)
-            current_target = self.run_data.get('target', name=name)
-            self._logger.info("Plugin {}: alpha = {}, target = {}".format(name, current_alpha, current_target))
+        Parameters
+        ----------
+        signum : int, optional
+            the signal that triggered the request, by default None
+        """
+        super().request_stop(signum)
+        self.engine.request_stop(signum)
+
+    def current_iteration(self):
+        return self.run_data.get('iteration')
 
     def run(self):
         """Perform the MD simulations.
         """
-        phase = self.run_data.get('phase')
+        self.run_phase()
 
-        self.__change_directory()
+    def run_phase(self, run_md=None, collective=False):
+        """Performs the current phase: prepares it, runs its MD (in scratch if
+        configured) while stop signals are handled, then finishes it, or saves
+        it as interrupted if a stop was requested.
 
-        if phase == 'training':
-            self.__train()
-            self.run_data.set(phase='convergence')
-        elif phase == 'convergence':
-            self.__converge()
-            self.run_data.set(phase='production')
+        Parameters
+        ----------
+        run_md : callable, optional
+            called as ``run_md(rundir, plugins, kwargs)`` to run the MD of this member in
+            ``rundir`` and return its restraint potentials, e.g. as one element of an array
+            context (see EnsembleRunConfig). By default the member's engine runs it alone
+        collective : bool, optional
+            ``run_md`` is collective over several ranks: it is called even if a stop is
+            requested while the phase is prepared, since the other ranks wait for this one,
+            by default False
+        """
+        if self.stop_requested is not None and not collective:
+            return
+        if run_md is None:
+            def run_md(rundir, plugins, kwargs):
+                return self.engine.run(self.tpr, [rundir], plugins, **kwargs)
+        phase = self.run_data.get('phase')
+        try:
+            self.__run_phase(run_md, collective)
+        finally:
+            counter = self.paths.counter
+            if hasattr(counter, 'reset'):
+                self._logger.info("Metadata operations of the {} phase: {}".format(phase, counter.reset()))
+
+    def __run_phase(self, run_md, collective):
+        self.__change_directory()
+        workdir = os.getcwd()
+
+        with StopSignalHandler(self) if self.handle_signals else nullcontext():
+            wall_start = time.time()
+            kwargs = self.prepare_phase(workdir)
+            potentials = None
+            if self.stop_requested is None or collective:
+                staging = None
+                rundir = workdir
+                if self.scratch is not None:
+                    staging = PhaseStaging(workdir, root=self.scratch, interval=self.sync_interval)
+                try:
+                    if staging is not None:
+                        staging.stage_in()
+                        staging.start()
+                        rundir = staging.scratch_dir
+                        self.paths.chdir(rundir)
+                    potentials = run_md(rundir, self.__plugins, kwargs)
+                finally:
+                    if staging is not None:
+                        self.__unstage(staging, workdir)
+                if self.stop_requested is None:
+                    self.__check_complete(workdir, potentials)
+            if self.stop_requested is not None:
+                self.interrupt_phase(workdir, potentials)
+                return
+
+            self.finish_phase(potentials, wall_time=time.time() - wall_start)
+
+    def __unstage(self, staging, workdir):
+        """Stops syncing a phase that ran in scratch, brings all its output to
+        the phase directory and removes the scratch directory, also if the MD
+        failed. Scratch is kept if the output could not be synced: it holds
+        the only copy."""
+        self.paths.chdir(workdir)
+        try:
+            # Durability barrier: the phase directory must hold all the output before the state
+            # of the member moves on.
+            staging.barrier()
+        finally:
+            staging.stop()
+        self._logger.info("Synced {} bytes from {} to {}".format(staging.bytes_synced, staging.scratch_dir, workdir))
+        staging.cleanup()
+
+    def __check_complete(self, workdir, potentials):
+        """Requests a stop if the MD of the phase ended before the phase was
+        complete without Python seeing a signal: mdrun reports a stop in its
+        log, or a production phase fell short of its end time."""
+        signum = self.engine.stop_signal(workdir)
+        if signum is not None:
+            self._logger.warning("mdrun was stopped by a signal before the {} phase was complete".format(
+                self.run_data.get('phase')))
+            self.request_stop(signum)
+        elif self.run_data.get('phase') == 'production' and potentials:
+            reached = getattr(potentials[0], 'time', None)
+            end_time = self.end_time()
+            if reached is not None and reached < end_time - END_TIME_TOLERANCE * self.run_data.get('production_time'):
+                self._logger.warning("The production phase stopped at {} ps, short of {} ps".format(
+                    reached, end_time))
+                self.request_stop()
+
+
+def _world_communicator():
+    """MPI_COMM_WORLD if mpi4py is available, else None."""
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        return None
+    return MPI.COMM_WORLD
+
+
+class EnsembleRunConfig(PhaseDriver):
+    """Runs the current phase of several ensemble members in shared gmxapi
+    array contexts.
+
+    Members in the same phase (and, for production, with the same end time)
+    are run together: one ``ParallelArrayContext`` whose ``workdir_list`` has
+    one entry per member. As in any gmxapi array context, element ``k`` of the
+    array runs on MPI rank ``k``, so every rank builds the work graph with the
+    plugins of its own member and reads that member's results from
+    ``context.potentials``. A group with more members than ranks is run in
+    several rounds. Without MPI, a single rank runs the members one after the
+    other, still sharing the loaded pair data and the Python process.
+
+    Each member's phase goes through ``RunConfig.run_phase``, so stop signals,
+    staging and interrupted phases are handled as for a single member. Ranks
+    without a member in a group only take part in setting up its context (see
+    ``GmxEngine.idle``). Before every group the ranks agree on whether any of
+    them was asked to stop, and ``run_until`` reloads the members and stops
+    every rank as soon as one of them meets a stopping criterion.
+    """
+
+    def __init__(self, tpr, ensemble_dir, ensemble_nums, pairs_json='pair_data.json', comm=None, engine=None,
+                 **kwargs):
+        """
+        Parameters
+        ----------
+        tpr : str
+            path to tpr. Must be gmx 2017 compatible.
+        ensemble_dir : str
+            path to top directory which contains the full ensemble.
+        ensemble_nums : list
+            the ensemble members to run.
+        pairs_json : str or MultiPair, optional
+            pair data (see RunConfig), loaded once for all members, by default 'pair_data.json'
+        comm : mpi4py.MPI.Comm, optional
+            communicator of the ranks that run the ensemble. By default MPI_COMM_WORLD if
+            mpi4py is available, else a single rank, by default None
+        engine : GmxEngine, optional
+            runs the MD of each group, by default GmxEngine()
+        **kwargs :
+            passed to the RunConfig of every member. The inputs are resolved once through
+            ``artifacts`` (see RunConfig) for all of them, and a ``retention`` policy is
+            applied by a single RetentionManager shared by all of them.
+        """
+        self.artifacts, tpr, pairs_json = _resolve_inputs(kwargs.pop('artifacts', None), ensemble_dir, tpr,
+                                                          pairs_json)
+        self.tpr = tpr
+        self.ens_dir = ensemble_dir
+        self.ensemble_nums = list(ensemble_nums)
+        self.engine = engine if engine is not None else GmxEngine()
+        self.handle_signals = kwargs.get('handle_signals', True)
+        if not self.ensemble_nums:
+            raise ValueError('At least one ensemble member is required')
+        if isinstance(kwargs.get('retention'), RetentionPolicy):
+            # One pool of background threads for all the members.
+            kwargs['retention'] = RetentionManager(kwargs['retention'])
+        self.retention = kwargs.get('retention')
+
+        self.comm = comm if comm is not None else _world_communicator()
+        self.rank = self.comm.Get_rank() if self.comm is not None else 0
+        self.size = self.comm.Get_size() if self.comm is not None else 1
+
+        if isinstance(pairs_json, MultiPair):
+            self.pairs = pairs_json
         else:
-            self.__production()
-            self.run_data.set(phase='training', start_time=0, iteration=(self.run_data.get('iteration') + 1))
-        self.run_data.save_config(self.state_json)
+            self.pairs = MultiPair()
+            self.pairs.read(pairs_json)
+
+        self.members = {}
+        for ensemble_num in self.ensemble_nums:
+            self.members[ensemble_num] = RunConfig(tpr, ensemble_dir, ensemble_num, pairs_json=self.pairs,
+                                                   engine=self.engine, **kwargs)
+
+    def _barrier(self):
+        if self.comm is not None:
+            self.comm.Barrier()
+
+    def _any(self, flag):
+        """Whether ``flag`` is set on this or any other rank. Collective."""
+        if self.comm is None:
+            return flag
+        return self.comm.allreduce(int(flag)) > 0
+
+    def _stop_agreed(self):
+        """Whether this or any other rank was asked to stop. All the ranks
+        must agree before a group starts, or those that go on would wait for
+        the others forever."""
+        requests = [self.stop_requested] + [rc.stop_requested for rc in self.members.values()]
+        requests = [signum for signum in requests if signum is not None]
+        stop = self._any(bool(requests))
+        if stop and self.stop_requested is None:
+            self.stop_requested = requests[0] if requests else True
+        return stop
+
+    def _refresh(self):
+        self.reload()
+
+    def _agree(self, stop):
+        # The ranks check their own walltime and may see different states: any rank that stops,
+        # stops them all. Both collectives run on every rank.
+        requested = self._stop_agreed()
+        return self._any(stop) or requested
+
+    def request_stop(self, signum=None):
+        """Asks a running group to checkpoint and stop, and prevents further
+        groups from starting.
+
+        Parameters
+        ----------
+        signum : int, optional
+            the signal that triggered the request, by default None
+        """
+        super().request_stop(signum)
+        self.engine.request_stop(signum)
+
+    def groups(self):
+        """Members that can run together, in the order of ``ensemble_nums``.
+        Groups with more members than ranks are split into rounds.
+
+        Returns
+        -------
+        list
+            lists of ensemble member numbers.
+        """
+        grouped = {}
+        for ensemble_num in self.ensemble_nums:
+            rc = self.members[ensemble_num]
+            phase = rc.run_data.get('phase')
+            key = (phase, rc.end_time() if phase == 'production' else None)
+            grouped.setdefault(key, []).append(ensemble_num)
+        rounds = []
+        for members in grouped.values():
+            rounds.extend(members[i:i + self.size] for i in range(0, len(members), self.size))
+        return rounds
+
+    def current_iteration(self):
+        # The ensemble has finished an iteration once its slowest member has.
+        return min(rc.run_data.get('iteration') for rc in self.members.values())
+
+    def reload(self):
+        """Reloads the state of every member, which other ranks may have
+        advanced since it was loaded. Changes made on this rank that were not
+        saved yet (e.g. parameters set before the run) are kept: they are
+        replayed on top of the saved state and saved once the member's next
+        phase starts."""
+        self._barrier()
+        for rc in self.members.values():
+            changes = rc.run_data.peek_changes()
+            rc.state_store.load(rc.run_data)
+            rc.run_data.apply_changes(changes)
+
+    def run(self):
+        """Perform the current phase of every member."""
+        self.reload()
+
+        for group in self.groups():
+            if self._stop_agreed():
+                break
+            workdirs = [self.members[ensemble_num].workdir() for ensemble_num in group]
+            tprs = [self.tpr] * len(group)
+            if self.rank < len(group):
+                def run_md(rundir, plugins, kwargs):
+                    # This rank's element of the array may run in scratch.
+                    return self.engine.run(tprs, workdirs[:self.rank] + [rundir] + workdirs[self.rank + 1:],
+                                           plugins, **kwargs)
+
+                self.members[group[self.rank]].run_phase(run_md, collective=self.comm is not None)
+            else:
+                # This rank has no member in the group and only takes part in the context.
+                first = self.members[group[0]]
+                kwargs = {'append_output': False}
+                if first.run_data.get('phase') == 'production':
+                    kwargs['end_time'] = first.end_time()
+                with StopSignalHandler(self) if self.handle_signals else nullcontext():
+                    self.engine.idle(tprs, workdirs, **kwargs)
+        self._barrier()
@@ -1,44 +1,37 @@
 """Class that handles the simulation data for BRER simulations.
 """
-from run_brer.metadata import MetaData
+from run_brer.metadata import CompiledMetaData
 from run_brer.pair_data import PairData
+from run_brer.state_store import atomic_write_json
 import json
 
 
-class GeneralParams(MetaData):
+class GeneralParams(CompiledMetaData):
     """Stores the parameters that are shared by all restraints in a single
     simulation.
 
     These include some of the "Voth" parameters: tau, A, tolerance
     """
 
+    __slots__ = ()
+    parameters = ('ensemble_num', 'iteration', 'phase', 'subphase', 'start_time', 'A', 'tau', 'tolerance',
+                  'num_samples', 'sample_period', 'production_time')
+
     def __init__(self):
         super().__init__('general')
-        self.set_requirements([
-            'ensemble_num', 'iteration', 'phase', 'start_time', 'A', 'tau', 'tolerance', 'num_samples',
-            'sample_period', 'production_time'
-        ])
 
     def set_to_defaults(self):
         """Sets general parameters to their default values."""
-        self.set_from_dictionary({
-            'ensemble_num': 1,
-            'iteration': 0,
-            'phase': 'training',
-            'start_time': 0,
-            'A': 50,
-            'tau': 50,
-            'tolerance': 0.25,
-            'num_samples': 50,
-            'sample_period': 100,
-            'production_time': 10000  # 10 ns
-        })
+        self.set_many(self.get_defaults())
 
     def get_defaults(self):
         return {
             'ensemble_num': 1,
             'iteration': 0,
             'phase': 'training',
+            # 'pending' until the phase starts, then 'running'; 'interrupted' if it was
+            # stopped by a signal (see run_brer.signals).
+            'subphase': 'pending',
             'start_time': 0,
             'A': 50,
             'tau': 50,
@@ -49,12 +42,14 @@ class GeneralParams(MetaData):
         }
 
 
-class PairParams(MetaData):
+class PairParams(CompiledMetaData):
     """Stores the parameters that are unique to a specific restraint."""
 
+    __slots__ = ()
+    parameters = ('sites', 'logging_filename', 'alpha', 'target')
+
     def __init__(self, name):
         super().__init__(name)
-        self.set_requirements(['sites', 'logging_filename', 'alpha', 'target'])
 
     def set_to_defaults(self):
         self.set(alpha=0., target=3.)
@@ -85,7 +80,9 @@ class RunData:
         self.general_params = GeneralParams()
         self.general_params.set_to_defaults()
         self.pair_params = {}
-        self.__names = []
+        # (restraint name or None, parameter, value) for every change since the state
+        # was last saved or loaded.
+        self._changes = []
 
     def set(self, name=None, **kwargs):
         """method used to set either general or a pair-specific parameter.
@@ -106,14 +103,16 @@ class RunData:
         for key, value in kwargs.items():
             # If a restraint name is not specified, it is assumed that the parameter is a "general" parameter.
             if not name:
-                if key in self.general_params.get_requirements():
+                if self.general_params.requires(key):
                     self.general_params.set(key, value)
+                    self._changes.append((None, key, value))
                 else:
                     raise ValueError('You have provided a name; this means you are probably trying to set a '
                                      'pair-specific parameter. {} is not pair-specific'.format(key))
             else:
-                if key in self.pair_params[name].get_requirements():
+                if self.pair_params[name].requires(key):
                     self.pair_params[name].set(key, value)
+                    self._changes.append((name, key, value))
                 else:
                     raise ValueError('{} is not a pair-specific parameter'.format(key))
 
@@ -132,7 +131,7 @@ class RunData:
         type
             the parameter value.
         """
-        if key in self.general_params.get_requirements():
+        if self.general_params.requires(key):
             return self.general_params.get(key)
         elif name:
             return self.pair_params[name].get(key)
@@ -178,10 +177,11 @@ class RunData:
         data : dict
             RunData metadata as a dictionary.
         """
-        self.general_params.set_from_dictionary(data['general parameters'])
-        for name in data['pair parameters'].keys():
+        self.general_params.set_many(data['general parameters'])
+        for name, pair_data in data['pair parameters'].items():
             self.pair_params[name] = PairParams(name)
-            self.pair_params[name].set_from_dictionary(data['pair parameters'][name])
+            self.pair_params[name].set_many(pair_data)
+        self._changes = []
 
     def from_pair_data(self, pd: PairData):
         """Load some of the run metadata from a PairData object. Useful at the
@@ -196,20 +196,79 @@ class RunData:
         self.pair_params[name] = PairParams(name)
         self.pair_params[name].load_sites(pd.get('sites'))
         self.pair_params[name].set_to_defaults()
+        for key, value in self.pair_params[name].get_as_dictionary().items():
+            self._changes.append((name, key, value))
 
     def clear_pair_data(self):
         """Removes all the pair parameters, replace with empty dict."""
         self.pair_params = {}
+        self._changes.append((None, 'pair parameters', {}))
+
+    def is_dirty(self):
+        """Whether any parameter changed since the state was last saved or
+        loaded.
+
+        Returns
+        -------
+        bool
+        """
+        return bool(self._changes)
+
+    def apply_changes(self, changes):
+        """Replays changes recorded by ``pop_changes`` (e.g. from a journal).
+        Pair parameters are created as needed.
+
+        Parameters
+        ----------
+        changes : list
+            (restraint name or None, parameter, value) tuples, in order.
+        """
+        for name, key, value in changes:
+            if name is None:
+                if key == 'pair parameters':
+                    self.pair_params = {}
+                else:
+                    self.general_params.set_many({key: value})
+            else:
+                if name not in self.pair_params:
+                    self.pair_params[name] = PairParams(name)
+                self.pair_params[name].set_many({key: value})
+            self._changes.append((name, key, value))
+
+    def peek_changes(self):
+        """The changes since the state was last saved or loaded, without
+        marking the state as clean (see ``pop_changes``).
+
+        Returns
+        -------
+        list
+            (restraint name or None for general parameters, parameter, value) tuples, in order.
+        """
+        return list(self._changes)
+
+    def pop_changes(self):
+        """Returns the changes since the state was last saved or loaded and
+        marks the state as clean.
+
+        Returns
+        -------
+        list
+            (restraint name or None for general parameters, parameter, value) tuples, in order.
+        """
+        changes, self._changes = self._changes, []
+        return changes
 
     def save_config(self, fnm='state.json'):
-        """Saves the run parameters to a log file.
+        """Saves the run parameters to a log file. The file is replaced
+        atomically, so a crash never leaves a truncated state behind.
 
         Parameters
         ----------
         fnm : str, optional
             log file for state parameters, by default 'state.json'
         """
-        json.dump(self.as_dictionary(), open(fnm, 'w'))
+        atomic_write_json(self.as_dictionary(), fnm)
+        self._changes = []
 
     def load_config(self, fnm='state.json'):
         """Load state parameters from file.
@@ -219,4 +278,5 @@ class RunData:
         fnm : str, optional
             log file of state parameters, by default 'state.json'
         """
-        self.from_dictionary(json.load(open(fnm)))
+        with open(fnm) as fh:
+            self.from_dictionary(json.load(fh))
@@ -0,0 +1,358 @@
+"""Walltime-aware scheduling of BRER phases.
+
+A phase that is killed at the end of an allocation loses all the compute spent
+on it. The PhaseScheduler records how long every phase took, per ensemble
+member and hardware class, in ``ensemble_dir/phase_timings.json``. Before
+starting a phase it predicts the phase's duration from these observations and
+only starts the phase if it is expected to finish before the allocation ends.
+Otherwise it stops cleanly, leaving the phase for the next job.
+
+Predictions use a high quantile of past durations, preferring the member's own
+observations over those of the whole hardware class. Training lasts as long as
+the restraints take to converge, so its duration is simply observed; the
+production phase simulates ``production_time`` ps, so its duration is
+predicted from the observed wallclock time per simulated ps.
+
+The end of the allocation is read from ``--walltime`` or, inside a SLURM job,
+from ``SLURM_JOB_END_TIME`` or ``squeue``. ``--walltime`` is counted from
+``--start``, by default the start of the SLURM job (``SLURM_JOB_START_TIME``)
+so that time spent before the script, e.g. in setup, is not counted twice, or
+the start of the script outside SLURM.
+
+Usage:
+    python -m run_brer.scheduler --tpr topol.tpr --ensemble-dir . --ensemble-num 1 --walltime 24:00:00
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import time
+
+import numpy as np
+from run_brer.state_store import atomic_write_json
+
+#: Name of the file, in the ensemble directory, that holds the observed phase durations.
+TIMINGS_FILE = 'phase_timings.json'
+
+
+def parse_duration(duration):
+    """Parses a duration in seconds or in the SLURM format
+    ``[days-]hours:minutes:seconds``.
+
+    Parameters
+    ----------
+    duration : str
+        e.g. '3600', '1:00:00' or '1-00:00:00'.
+
+    Returns
+    -------
+    float
+        the duration in seconds.
+    """
+    duration = duration.strip()
+    days = 0
+    if '-' in duration:
+        days, duration = duration.split('-', 1)
+    seconds = 0.
+    for part in duration.split(':'):
+        seconds = 60 * seconds + float(part)
+    return 86400 * int(days) + seconds
+
+
+def allocation_start():
+    """Time at which the current allocation started: ``SLURM_JOB_START_TIME``
+    inside a SLURM job, else now.
+
+    Returns
+    -------
+    float
+        the start as a UNIX time.
+    """
+    if 'SLURM_JOB_START_TIME' in os.environ:
+        return float(os.environ['SLURM_JOB_START_TIME'])
+    return time.time()
+
+
+def allocation_end(walltime=None, start=None):
+    """Time at which the current allocation ends.
+
+    Parameters
+    ----------
+    walltime : str or float, optional
+        length of the allocation, counted from ``start`` (see ``parse_duration``). Takes
+        precedence over SLURM, by default None
+    start : float, optional
+        start of the allocation as a UNIX time, by default ``allocation_start()``
+
+    Returns
+    -------
+    float or None
+        the end as a UNIX time, or None if it is unknown.
+    """
+    start = allocation_start() if start is None else start
+    if walltime is not None:
+        return start + (parse_duration(walltime) if isinstance(walltime, str) else float(walltime))
+    if 'SLURM_JOB_END_TIME' in os.environ:
+        return float(os.environ['SLURM_JOB_END_TIME'])
+    job_id = os.environ.get('SLURM_JOB_ID')
+    if job_id and shutil.which('squeue'):
+        try:
+            left = subprocess.run(['squeue', '-h', '-j', job_id, '-o', '%L'], capture_output=True, text=True,
+                                  timeout=30, check=True).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return None
+        if left and left not in ('UNLIMITED', 'NOT_SET', 'INVALID'):
+            return time.time() + parse_duration(left)
+    return None
+
+
+def hardware_class():
+    """Name of the class of hardware this process runs on: ``BRER_HARDWARE_CLASS``
+    if set, else the SLURM partition, else the host name.
+
+    Returns
+    -------
+    str
+    """
+    return os.environ.get('BRER_HARDWARE_CLASS') or os.environ.get('SLURM_JOB_PARTITION') or platform.node()
+
+
+class PhaseTimings:
+    """Observed phase durations of an ensemble, shared by all its members."""
+
+    def __init__(self, filename, max_observations=50):
+        """
+        Parameters
+        ----------
+        filename : str
+            path to the timings file (see ``TIMINGS_FILE``).
+        max_observations : int, optional
+            number of most recent observations to keep per member, hardware class and
+            phase, by default 50
+        """
+        self.filename = filename
+        self.max_observations = max_observations
+
+    def load(self):
+        """Reads the observations.
+
+        Returns
+        -------
+        dict
+            ``{hardware class: {phase: {member: [[seconds, simulated ps], ...]}}}``
+        """
+        if not os.path.exists(self.filename):
+            return {}
+        with open(self.filename) as fh:
+            return json.load(fh)
+
+    def record(self, hardware, phase, ensemble_num, seconds, simulated=None):
+        """Adds an observation. Members update the file under an exclusive
+        lock, so concurrent members do not lose each other's observations.
+
+        Parameters
+        ----------
+        hardware : str
+            hardware class.
+        phase : str
+            the phase.
+        ensemble_num : int
+            the ensemble member.
+        seconds : float
+            wallclock duration of the phase.
+        simulated : float, optional
+            simulated time of the phase in ps, by default None
+        """
+        with open('{}.lock'.format(self.filename), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            timings = self.load()
+            observations = timings.setdefault(hardware, {}).setdefault(phase, {}).setdefault(str(ensemble_num), [])
+            observations.append([seconds, simulated])
+            del observations[:-self.max_observations]
+            atomic_write_json(timings, self.filename)
+
+    def predict(self, hardware, phase, ensemble_num, simulated=None, quantile=0.9, min_observations=3):
+        """Predicts the duration of a phase.
+
+        Parameters
+        ----------
+        hardware : str
+            hardware class.
+        phase : str
+            the phase.
+        ensemble_num : int
+            the ensemble member.
+        simulated : float, optional
+            simulated time of the phase in ps. If given, the prediction scales the observed
+            wallclock time per ps, by default None
+        quantile : float, optional
+            quantile of the observed durations to predict, by default 0.9
+        min_observations : int, optional
+            number of observations of the member itself needed to ignore the rest of its
+            hardware class, by default 3
+
+        Returns
+        -------
+        float or None
+            the predicted duration in seconds, or None without observations.
+        """
+        members = self.load().get(hardware, {}).get(phase, {})
+        observations = members.get(str(ensemble_num), [])
+        if len(observations) < min_observations:
+            observations = [observation for member in members.values() for observation in member]
+        if simulated is not None:
+            rates = [seconds / ps for seconds, ps in observations if ps]
+            return float(np.quantile(rates, quantile)) * simulated if rates else None
+        if not observations:
+            return None
+        return float(np.quantile([seconds for seconds, _ in observations], quantile))
+
+
+class PhaseScheduler:
+    """Runs the phases of a RunConfig while they fit in the allocation."""
+
+    def __init__(self, run_config, end_time=None, margin=300., hardware=None, quantile=0.9, timings=None):
+        """
+        Parameters
+        ----------
+        run_config : RunConfig
+            the ensemble member to run.
+        end_time : float, optional
+            end of the allocation as a UNIX time (see ``allocation_end``). If None, phases
+            are run without a time limit, by default None
+        margin : float, optional
+            seconds to keep free at the end of the allocation, e.g. for staging out,
+            by default 300.
+        hardware : str, optional
+            hardware class, by default ``hardware_class()``
+        quantile : float, optional
+            quantile of past durations used as the prediction, by default 0.9
+        timings : PhaseTimings, optional
+            where the durations are recorded, by default ``ensemble_dir/phase_timings.json``
+        """
+        self.run_config = run_config
+        self.end_time = end_time
+        self.margin = margin
+        self.hardware = hardware or hardware_class()
+        self.quantile = quantile
+        self.timings = timings or PhaseTimings(os.path.join(run_config.ens_dir, TIMINGS_FILE))
+        self._logger = logging.getLogger('BRER')
+
+    def _simulated(self, phase):
+        """Simulated time of a production phase, which is set by the run
+        parameters; the length of the other phases is not known in advance."""
+        if phase == 'production':
+            return self.run_config.run_data.get('production_time')
+        return None
+
+    def predict(self):
+        """Predicted duration of the member's next phase.
+
+        Returns
+        -------
+        float or None
+            seconds, or None if there are no observations to predict from.
+        """
+        phase = self.run_config.run_data.get('phase')
+        return self.timings.predict(self.hardware, phase, self.run_config.run_data.get('ensemble_num'),
+                                    simulated=self._simulated(phase), quantile=self.quantile)
+
+    def fits(self):
+        """Whether the next phase is predicted to finish before the allocation
+        ends. A phase without a prediction always fits.
+
+        Returns
+        -------
+        bool
+        """
+        if self.end_time is None:
+            return True
+        remaining = self.end_time - self.margin - time.time()
+        predicted = self.predict()
+        if predicted is None:
+            return remaining > 0
+        return predicted <= remaining
+
+    def run_phase(self):
+        """Runs the next phase and records its duration. A phase that was
+        stopped before it finished is not recorded, since its duration says
+        nothing about that of a whole phase.
+
+        Returns
+        -------
+        bool
+            whether the phase finished.
+        """
+        phase = self.run_config.run_data.get('phase')
+        iteration = self.run_config.run_data.get('iteration')
+        simulated = self._simulated(phase)
+        start = time.time()
+        self.run_config.run()
+        finished = (getattr(self.run_config, 'stop_requested', None) is None
+                    and (self.run_config.run_data.get('phase'), self.run_config.run_data.get('iteration')) !=
+                    (phase, iteration))
+        if finished:
+            self.timings.record(self.hardware, phase, self.run_config.run_data.get('ensemble_num'),
+                                time.time() - start, simulated)
+        else:
+            self._logger.info('The {} phase did not finish: its duration is not recorded'.format(phase))
+        return finished
+
+    def run(self, max_phases=None):
+        """Runs phases until the next one would not fit in the allocation.
+
+        Parameters
+        ----------
+        max_phases : int, optional
+            run at most this many phases, by default None
+
+        Returns
+        -------
+        int
+            the number of phases that were run.
+        """
+        phases = 0
+        while max_phases is None or phases < max_phases:
+            if getattr(self.run_config, 'stop_requested', None) is not None:
+                break
+            if not self.fits():
+                self._logger.info('The {} phase is predicted to take {} s, which does not fit in the allocation: '
+                                  'leaving it for the next job'.format(self.run_config.run_data.get('phase'),
+                                                                       self.predict()))
+                break
+            finished = self.run_phase()
+            phases += 1
+            if not finished:
+                break
+        return phases
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tpr', required=True)
+    parser.add_argument('--ensemble-dir', required=True)
+    parser.add_argument('--ensemble-num', type=int, default=1)
+    parser.add_argument('--pairs-json', default='pair_data.json')
+    parser.add_argument('--walltime', help='length of the allocation, e.g. 24:00:00 (default: from SLURM)')
+    parser.add_argument('--start', type=float,
+                        help='UNIX time the walltime is counted from (default: start of the SLURM job, else now)')
+    parser.add_argument('--margin', type=float, default=300., help='seconds to keep free at the end')
+    parser.add_argument('--max-phases', type=int)
+    args = parser.parse_args(argv)
+
+    # Before the setup below, which takes time out of the allocation.
+    start = allocation_start() if args.start is None else args.start
+    # Imported here so that the timing helpers can be used without gmxapi.
+    from run_brer.run_config import RunConfig
+    run_config = RunConfig(args.tpr, args.ensemble_dir, args.ensemble_num, pairs_json=args.pairs_json)
+    scheduler = PhaseScheduler(run_config, end_time=allocation_end(args.walltime, start), margin=args.margin)
+    scheduler.run(max_phases=args.max_phases)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""Node-level cache of parsed pair data in shared memory.
+
+The first member on a node to ask for a pair data file parses it, compiles
+its sampler and publishes the packed bins and distributions (see
+``MultiPair.to_arrays``) together with the compiled cumulative distributions
+in a ``multiprocessing.shared_memory`` segment. Every later member, in any
+process, attaches to the segment and builds its MultiPair from views into it,
+so the data are parsed and compiled once and held in memory once per node.
+
+Segments are named after the file's path, modification time and a hash of its
+contents, so editing the file publishes a fresh segment. The users attached to
+a segment are listed, with their process id, in a registry file next to its
+lock file. Users whose process has died are dropped from the registry
+whenever it is updated, so a crashed member does not keep the segment alive:
+it is unlinked when the last live user detaches. A segment is only marked as
+ready once it has been filled; one whose publisher failed or died before that
+is unlinked and published again.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from run_brer.metadata import to_serializable
+from run_brer.pair_data import MultiPair
+
+# Segment header: length of the JSON index, written last. Zero until the segment is ready.
+_HEADER = struct.Struct('q')
+
+
+def _open_shared_memory(name, create=False, size=0):
+    """Opens a shared memory segment whose lifetime is managed by the caller
+    rather than by the multiprocessing resource tracker (which would unlink it
+    when the creating process exits)."""
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument.
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def process_alive(pid):
+    """Whether a process with id ``pid`` exists on this node.
+
+    Parameters
+    ----------
+    pid : int
+        the process id.
+
+    Returns
+    -------
+    bool
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedPairCache:
+    """Shared-memory copy of one pair data file."""
+
+    def __init__(self, filename, hash_contents=True):
+        """
+        Parameters
+        ----------
+        filename : str
+            path to the pair data (json or binary, see ``MultiPair.read``).
+        hash_contents : bool, optional
+            include a hash of the file contents in the key, in addition to its path,
+            modification time and size. Only turn this off for files that are never
+            rewritten in place within the resolution of their modification time, by
+            default True
+        """
+        self.filename = os.path.abspath(filename)
+        stat = os.stat(self.filename)
+        key = hashlib.sha1('{}:{}:{}'.format(self.filename, stat.st_mtime_ns, stat.st_size).encode())
+        if hash_contents:
+            with open(self.filename, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(1 << 20), b''):
+                    key.update(chunk)
+        self.name = 'run_brer_{}'.format(key.hexdigest()[:20])
+        self._lock_file = os.path.join(tempfile.gettempdir(), '{}.lock'.format(self.name))
+        self._registry_file = os.path.join(tempfile.gettempdir(), '{}.users'.format(self.name))
+        self._token = uuid.uuid4().hex
+        self._shm = None
+
+    def _locked(self):
+        """Opens the lock file and takes an exclusive lock on it."""
+        fh = open(self._lock_file, 'a')
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        return fh
+
+    def _users(self):
+        """Users in the registry whose process is still alive. Must be called
+        with the lock held."""
+        if not os.path.exists(self._registry_file):
+            return {}
+        with open(self._registry_file) as fh:
+            users = json.load(fh)
+        return {token: pid for token, pid in users.items() if process_alive(pid)}
+
+    def _register(self, users):
+        """Replaces the registry with ``users``. Must be called with the lock
+        held."""
+        tmp = '{}.tmp'.format(self._registry_file)
+        with open(tmp, 'w') as fh:
+            json.dump(users, fh)
+        os.replace(tmp, self._registry_file)
+
+    @property
+    def references(self):
+        """Number of live users currently attached to the segment.
+
+        Returns
+        -------
+        int
+        """
+        if self._shm is None:
+            return 0
+        with self._locked():
+            return len(self._users())
+
+    def _publish(self):
+        pairs = MultiPair()
+        pairs.read(self.filename)
+        block, offsets, metadata = pairs.to_arrays()
+        cdf = pairs.compiled_cdf()
+        index = json.dumps({
+            'offsets': offsets,
+            'metadata': metadata,
+            'dtype': block.dtype.str,
+            'shape': block.shape
+        }, default=to_serializable).encode()
+        data_offset = _HEADER.size + -(-len(index) // 8) * 8
+        cdf_offset = data_offset + -(-block.nbytes // 8) * 8
+
+        shm = _open_shared_memory(self.name, create=True, size=cdf_offset + cdf.nbytes)
+        try:
+            shm.buf[_HEADER.size:_HEADER.size + len(index)] = index
+            np.ndarray(block.shape, dtype=block.dtype, buffer=shm.buf, offset=data_offset)[...] = block
+            np.ndarray(cdf.shape, dtype=cdf.dtype, buffer=shm.buf, offset=cdf_offset)[...] = cdf
+            _HEADER.pack_into(shm.buf, 0, len(index))
+        except BaseException:
+            # Later users must not attach to a half-written segment.
+            shm.unlink()
+            shm.close()
+            raise
+        return shm
+
+    def _open(self):
+        """Opens the segment if it has been published and is ready. Must be
+        called with the lock held, so a segment that is not ready was left by
+        a publisher that died; it is unlinked."""
+        try:
+            shm = _open_shared_memory(self.name)
+        except FileNotFoundError:
+            return None
+        if shm.size >= _HEADER.size and _HEADER.unpack_from(shm.buf, 0)[0] > 0:
+            return shm
+        shm.unlink()
+        shm.close()
+        return None
+
+    def attach(self):
+        """Attaches to the shared segment, publishing it first if no other
+        user has.
+
+        Returns
+        -------
+        MultiPair
+            pair data whose bins, distributions and compiled sampler are read-only views into
+            shared memory.
+        """
+        if self._shm is not None:
+            raise RuntimeError('Already attached to {}'.format(self.name))
+        with self._locked():
+            self._shm = self._open() or self._publish()
+            users = self._users()
+            users[self._token] = os.getpid()
+            self._register(users)
+
+        length = _HEADER.unpack_from(self._shm.buf, 0)[0]
+        index = json.loads(bytes(self._shm.buf[_HEADER.size:_HEADER.size + length]))
+        data_offset = _HEADER.size + -(-length // 8) * 8
+        block = np.ndarray(tuple(index['shape']), dtype=np.dtype(index['dtype']), buffer=self._shm.buf,
+                           offset=data_offset)
+        block.flags.writeable = False
+        cdf = np.ndarray((block.shape[1], ), dtype=np.float64, buffer=self._shm.buf,
+                         offset=data_offset + -(-block.nbytes // 8) * 8)
+        cdf.flags.writeable = False
+
+        pairs = MultiPair()
+        pairs.from_arrays(block, index['offsets'], index['metadata'], cdf=cdf)
+        return pairs
+
+    def detach(self):
+        """Removes this user from the registry. The segment is unlinked when
+        the last live user detaches. MultiPair objects returned by ``attach``
+        must not be used afterwards."""
+        if self._shm is None:
+            return
+        with self._locked():
+            users = self._users()
+            users.pop(self._token, None)
+            if users:
+                self._register(users)
+            else:
+                self._shm.unlink()
+                if os.path.exists(self._registry_file):
+                    os.remove(self._registry_file)
+        try:
+            self._shm.close()
+        except BufferError:
+            # Arrays still reference the mapping; it is released with them.
+            pass
+        self._shm = None
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.detach()
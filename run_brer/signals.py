@@ -0,0 +1,100 @@
+"""Graceful handling of scheduler signals.
+
+Batch schedulers announce preemption or the end of an allocation with SIGTERM
+(or a user signal such as SIGUSR1, e.g. ``sbatch --signal=USR1@300``). A
+StopSignalHandler turns these signals into a stop request for whatever is
+running: RunConfig asks its engine to write a checkpoint and stop, persists
+its state with the ``subphase`` marker set to ``'interrupted'`` and does not
+start another phase. The next launch then picks up the interrupted phase from
+its checkpoint.
+
+Handlers can only be installed from the main thread; elsewhere the handler is
+a no-op.
+
+While mdrun runs, its own handlers take over: it writes a checkpoint, returns
+early and Python never sees the signal. ``mdrun_stop_signal`` finds such a
+stop in the mdrun log, so that the phase is not mistaken for a complete one.
+"""
+
+import glob
+import logging
+import os
+import re
+import signal
+import threading
+
+#: Signals that request a checkpoint and a clean exit.
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGUSR1)
+
+# What mdrun logs when it stops for a signal, e.g. "Received the TERM signal, stopping within 100 steps",
+# "Received the second INT/TERM signal, stopping within 100 steps" or, on the ranks that did not receive the
+# signal themselves, "Received the remote INT/TERM signal, stopping within 100 steps".
+_MDRUN_STOP = re.compile(rb'Received the (?:second |remote )?([\w/]+) signal, stopping')
+
+
+def mdrun_stop_signal(workdir, tail=1 << 16):
+    """The signal that stopped the last mdrun in ``workdir``, according to
+    the end of its newest log file.
+
+    Parameters
+    ----------
+    workdir : str
+        working directory of the run.
+    tail : int, optional
+        bytes at the end of the log to search, by default 64 KiB
+
+    Returns
+    -------
+    int or None
+        the signal, True if mdrun named a signal unknown to Python, or None if it was not
+        stopped by a signal. mdrun names INT and TERM together as ``INT/TERM``, which is
+        reported as the last of them, SIGTERM.
+    """
+    logs = glob.glob(os.path.join(workdir, 'md*.log'))
+    if not logs:
+        return None
+    with open(max(logs, key=os.path.getmtime), 'rb') as fh:
+        fh.seek(max(os.fstat(fh.fileno()).st_size - tail, 0))
+        stops = _MDRUN_STOP.findall(fh.read())
+    if not stops:
+        return None
+    for name in reversed(stops[-1].decode().upper().split('/')):
+        if hasattr(signal, 'SIG{}'.format(name)):
+            return getattr(signal, 'SIG{}'.format(name))
+    return True
+
+
+class StopSignalHandler:
+    """Context manager that forwards stop signals to ``target.request_stop``
+    while it is active."""
+
+    def __init__(self, target, signals=STOP_SIGNALS):
+        """
+        Parameters
+        ----------
+        target : object
+            anything with a ``request_stop(signum)`` method, e.g. a RunConfig.
+        signals : tuple, optional
+            signals to handle, by default ``STOP_SIGNALS``
+        """
+        self.target = target
+        self.signals = tuple(signals)
+        self.received = None
+        self._previous = {}
+
+    def _handle(self, signum, frame):
+        self.received = signum
+        logging.getLogger('BRER').warning('Received {}: checkpointing and stopping'.format(
+            signal.Signals(signum).name))
+        self.target.request_stop(signum)
+
+    def __enter__(self):
+        if threading.current_thread() is threading.main_thread():
+            for signum in self.signals:
+                self._previous[signum] = signal.signal(signum, self._handle)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for signum, previous in self._previous.items():
+            signal.signal(signum, previous)
+        self._previous = {}
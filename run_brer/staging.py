@@ -0,0 +1,215 @@
+"""Running phases in node-local scratch space.
+
+A phase writes its output (log, trajectory, checkpoints, plugin logs) at high
+frequency. With staging, the phase runs in a scratch directory on the node and
+a background thread copies its files back to the canonical phase directory
+built by DirectoryHelper:
+
+* ``stage_in`` copies the inputs (e.g. the checkpoint handed over from the
+  previous phase) from the canonical directory to scratch;
+* while the phase runs, ``sync`` is called every ``interval`` seconds. It only
+  transfers files that changed since the last sync, and for files that only
+  grew (trajectories, logs) only the new bytes;
+* ``barrier`` performs a final sync and flushes every file and directory to
+  disk. RunConfig calls it before the state of the member advances, so a
+  saved state never refers to output that only exists on a node.
+
+Files are replaced in the canonical directory atomically, so a checkpoint
+there is always complete.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from run_brer.state_store import fsync_directory
+
+
+def scratch_root():
+    """Default node-local directory: ``BRER_SCRATCH``, else ``TMPDIR``, else
+    the system temporary directory.
+
+    Returns
+    -------
+    str
+    """
+    return os.environ.get('BRER_SCRATCH') or tempfile.gettempdir()
+
+
+class PhaseStaging:
+    """Scratch directory of one phase, synced back to its canonical
+    directory."""
+
+    def __init__(self, canonical_dir, root=None, interval=60., inputs=('state.cpt', )):
+        """
+        Parameters
+        ----------
+        canonical_dir : str
+            the phase directory on the shared file system.
+        root : str, optional
+            node-local directory under which the scratch directory is created, by default
+            ``scratch_root()``
+        interval : float, optional
+            seconds between two background syncs, by default 60.
+        inputs : tuple, optional
+            files of the canonical directory to stage in, by default ('state.cpt', )
+        """
+        self.canonical_dir = os.path.abspath(canonical_dir)
+        self.interval = interval
+        self.inputs = inputs
+        key = hashlib.sha1(self.canonical_dir.encode()).hexdigest()[:16]
+        self.scratch_dir = os.path.join(root or scratch_root(), 'run_brer_{}'.format(key))
+        self.bytes_synced = 0
+
+        # relative path -> (inode, size, mtime) of the scratch file when it was last synced
+        self._synced = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._logger = logging.getLogger('BRER')
+
+    def stage_in(self):
+        """Creates the scratch directory and copies the inputs into it.
+        Inputs already in scratch (e.g. from an interrupted run on the same
+        node) are replaced by the canonical ones."""
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        for name in self.inputs:
+            source = os.path.join(self.canonical_dir, name)
+            if os.path.exists(source):
+                destination = os.path.join(self.scratch_dir, name)
+                shutil.copyfile(source, destination)
+                stat = os.stat(destination)
+                self._synced[name] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def _grew(src, destination, synced_size, block=4096):
+        """Whether the last bytes that were synced are still the same, i.e.
+        the file was only appended to."""
+        if not os.path.exists(destination) or os.path.getsize(destination) != synced_size:
+            return False
+        start = max(synced_size - block, 0)
+        src.seek(start)
+        with open(destination, 'rb') as dst:
+            dst.seek(start)
+            return src.read(synced_size - start) == dst.read()
+
+    def _sync_file(self, name, durable):
+        source = os.path.join(self.scratch_dir, name)
+        destination = os.path.join(self.canonical_dir, name)
+        try:
+            stat = os.stat(source)
+        except FileNotFoundError:
+            # Removed (e.g. renamed by mdrun) since the directory was listed.
+            return 0
+        previous = self._synced.get(name)
+        if previous == (stat.st_ino, stat.st_size, stat.st_mtime_ns) and not durable:
+            return 0
+
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(source, 'rb') as src:
+            if (previous is not None and previous[0] == stat.st_ino and previous[1] <= stat.st_size
+                    and self._grew(src, destination, previous[1])):
+                # The file only grew: append the new bytes.
+                src.seek(previous[1])
+                with open(destination, 'ab') as dst:
+                    written = self._copy(src, dst, durable)
+            else:
+                src.seek(0)
+                tmp = '{}.staging.tmp'.format(destination)
+                with open(tmp, 'wb') as dst:
+                    written = self._copy(src, dst, durable)
+                os.replace(tmp, destination)
+        # The file may have grown while it was copied: remember how much was actually synced.
+        self._synced[name] = (stat.st_ino, os.path.getsize(destination), stat.st_mtime_ns)
+        return written
+
+    @staticmethod
+    def _copy(src, dst, durable):
+        written = 0
+        for chunk in iter(lambda: src.read(1 << 22), b''):
+            dst.write(chunk)
+            written += len(chunk)
+        if durable:
+            dst.flush()
+            os.fsync(dst.fileno())
+        return written
+
+    def sync(self, durable=False):
+        """Copies new and changed files from scratch to the canonical
+        directory.
+
+        Parameters
+        ----------
+        durable : bool, optional
+            also flush every file and directory of the canonical tree to disk, by default False
+
+        Returns
+        -------
+        int
+            number of bytes copied.
+        """
+        with self._lock:
+            written = 0
+            directories = set()
+            for dirpath, _, filenames in os.walk(self.scratch_dir):
+                for filename in filenames:
+                    name = os.path.relpath(os.path.join(dirpath, filename), self.scratch_dir)
+                    written += self._sync_file(name, durable)
+                    directories.add(os.path.dirname(os.path.join(self.canonical_dir, name)))
+            if durable:
+                for directory in directories | {self.canonical_dir}:
+                    fsync_directory(directory)
+            self.bytes_synced += written
+            return written
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sync()
+            except OSError as error:
+                # Try again at the next interval; the barrier reports persistent errors.
+                self._logger.warning('Background sync of {} failed: {}'.format(self.scratch_dir, error))
+
+    def start(self):
+        """Starts syncing in the background."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='run_brer-staging', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the background sync, waiting for a sync in progress to
+        finish."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def barrier(self):
+        """Stops the background sync, copies everything that is left and
+        makes the canonical directory durable. Afterwards, the canonical
+        directory holds all the output of the phase.
+
+        Returns
+        -------
+        int
+            number of bytes copied by the final sync.
+        """
+        self.stop()
+        return self.sync(durable=True)
+
+    def cleanup(self):
+        """Removes the scratch directory."""
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        self._synced = {}
+
+    def __enter__(self):
+        self.stage_in()
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.barrier()
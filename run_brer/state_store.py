@@ -0,0 +1,722 @@
+"""Persistence of the BRER state (RunData) of an ensemble member.
+
+Writes are crash-safe: the new state goes to a temporary file in the same
+directory, is flushed to disk and then atomically renamed over the old one, so
+a reader (or a restarted member) always sees either the old or the new state,
+never a truncated file. Writes are also coalesced: a store only writes when
+the RunData has changed since it was last saved or loaded.
+
+Three layouts are available: JSONStateStore rewrites ``state.json`` on every
+save, JournalStateStore appends each save's changes to a journal and only
+occasionally compacts them into ``state.json``, and SQLiteStateStore keeps the
+state of the whole ensemble in a single database, ``ensemble_dir/state.db``.
+"""
+
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import glob
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+from run_brer.directory_helper import PathPlan
+from run_brer.metadata import to_serializable
+
+
+def fsync_directory(dirname):
+    """Flushes a directory entry (e.g. after a rename) to disk. A no-op on
+    platforms that cannot open directories.
+
+    Parameters
+    ----------
+    dirname : str
+        the directory.
+    """
+    try:
+        fd = os.open(dirname or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _keep_generation(filename, generations):
+    """Shifts ``filename.1 ... filename.(N-1)`` up by one and links the
+    current file to ``filename.1`` without ever removing ``filename``."""
+    if generations < 1 or not os.path.exists(filename):
+        return
+    for generation in range(generations - 1, 0, -1):
+        older = '{}.{}'.format(filename, generation)
+        if os.path.exists(older):
+            os.replace(older, '{}.{}'.format(filename, generation + 1))
+    staged = '{}.1.tmp'.format(filename)
+    try:
+        os.link(filename, staged)
+    except OSError:
+        shutil.copy2(filename, staged)
+    os.replace(staged, '{}.1'.format(filename))
+
+
+def atomic_write_json(data, filename, generations=0):
+    """Writes json atomically: write to a temporary file, fsync, rename over
+    ``filename`` and fsync the directory.
+
+    Parameters
+    ----------
+    data : dict
+        data to write.
+    filename : str
+        destination.
+    generations : int, optional
+        number of previous versions to keep as ``filename.1`` (newest) to
+        ``filename.<generations>``, by default 0
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    tmp = os.path.join(dirname, '.{}.{}.tmp'.format(os.path.basename(filename), os.getpid()))
+    with open(tmp, 'w') as fh:
+        json.dump(data, fh, default=to_serializable)
+        fh.flush()
+        os.fsync(fh.fileno())
+    _keep_generation(filename, generations)
+    os.replace(tmp, filename)
+    fsync_directory(dirname)
+
+
+class StateStore(ABC):
+    """Abstract persistence backend for the RunData of one ensemble
+    member."""
+
+    @abstractmethod
+    def exists(self):
+        """Whether a state has been saved.
+
+        Returns
+        -------
+        bool
+        """
+
+    @abstractmethod
+    def load(self, run_data):
+        """Loads the saved state into ``run_data``.
+
+        Parameters
+        ----------
+        run_data : RunData
+            object to populate.
+        """
+
+    @abstractmethod
+    def save(self, run_data, force=False):
+        """Saves ``run_data`` if it changed since it was last saved or loaded.
+
+        Parameters
+        ----------
+        run_data : RunData
+            the state to save.
+        force : bool, optional
+            write even if nothing changed, by default False
+
+        Returns
+        -------
+        bool
+            whether anything was written.
+        """
+
+
+class JSONStateStore(StateStore):
+    """The classic ``state.json`` layout, written atomically."""
+
+    def __init__(self, filename='state.json', generations=0):
+        """
+        Parameters
+        ----------
+        filename : str, optional
+            path to the state file, by default 'state.json'
+        generations : int, optional
+            number of previous versions of the file to keep (see ``atomic_write_json``), by default 0
+        """
+        self.filename = filename
+        self.generations = generations
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def load(self, run_data):
+        with open(self.filename) as fh:
+            run_data.from_dictionary(json.load(fh))
+
+    def save(self, run_data, force=False):
+        if not force and not run_data.is_dirty():
+            return False
+        atomic_write_json(run_data.as_dictionary(), self.filename, generations=self.generations)
+        run_data.pop_changes()
+        return True
+
+
+class JournalStateStore(StateStore):
+    """Append-only journal of state changes with periodic compaction.
+
+    Every save appends one JSON line with the changes made since the previous
+    save (see ``RunData.pop_changes``), together with the time and the
+    iteration and phase they belong to, i.e. those of the state before them
+    (the results of a phase are saved with the move to the next one). A line is
+    fsynced before ``save`` returns; a line cut short by a crash is cut off the
+    journal when it is next loaded or saved, so later lines are appended after
+    the last complete one. Every ``compact_every`` saves, the state is written
+    atomically to the snapshot (the usual ``state.json`` layout) and the
+    journal starts over. Compacted journals can be kept as numbered segments,
+    which preserves the full per-iteration history of alphas and targets.
+
+    Note that the snapshot lags behind the journal between compactions; tools
+    that read ``state.json`` directly see the state as of the last compaction.
+    """
+
+    def __init__(self, snapshot='state.json', journal=None, compact_every=16, keep_history=True):
+        """
+        Parameters
+        ----------
+        snapshot : str, optional
+            path to the snapshot, by default 'state.json'
+        journal : str, optional
+            path to the journal, by default the snapshot path with the extension ``.journal``
+        compact_every : int, optional
+            compact after this many journal lines, by default 16
+        keep_history : bool, optional
+            keep compacted journals as ``<journal>.<segment>`` instead of deleting them, by default True
+        """
+        self.snapshot = snapshot
+        self.journal = journal or '{}.journal'.format(os.path.splitext(snapshot)[0])
+        self.compact_every = compact_every
+        self.keep_history = keep_history
+        self._lines = None
+        # Iteration and phase of the state as last saved or loaded.
+        self._labels = None
+
+    def exists(self):
+        return os.path.exists(self.snapshot) or os.path.exists(self.journal)
+
+    @staticmethod
+    def _scan_journal(filename):
+        """Complete records of a journal file, in order, and the number of
+        bytes they take up at the start of the file."""
+        records = []
+        size = 0
+        if not os.path.exists(filename):
+            return records, size
+        with open(filename, 'rb') as fh:
+            for line in fh:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                size += len(line)
+        return records, size
+
+    @classmethod
+    def _read_journal(cls, filename):
+        """Complete records of a journal file, in order."""
+        return cls._scan_journal(filename)[0]
+
+    def _repair(self):
+        """Cuts whatever follows the last complete record (e.g. a line torn
+        by a crash) off the journal, so new lines are not appended to it.
+        Returns the complete records."""
+        records, size = self._scan_journal(self.journal)
+        if os.path.exists(self.journal) and os.path.getsize(self.journal) > size:
+            with open(self.journal, 'r+b') as fh:
+                fh.truncate(size)
+                fh.flush()
+                os.fsync(fh.fileno())
+        return records
+
+    def load(self, run_data):
+        if os.path.exists(self.snapshot):
+            with open(self.snapshot) as fh:
+                run_data.from_dictionary(json.load(fh))
+        records = self._repair()
+        for record in records:
+            run_data.apply_changes(record['changes'])
+        run_data.pop_changes()
+        self._lines = len(records)
+        self._labels = (run_data.get('iteration'), run_data.get('phase'))
+
+    def save(self, run_data, force=False):
+        changes = run_data.peek_changes()
+        if not changes and not force:
+            return False
+        # A store that has neither saved nor loaded a state yet is saving the first one.
+        iteration, phase = self._labels or (run_data.get('iteration'), run_data.get('phase'))
+        record = {'time': time.time(), 'iteration': iteration, 'phase': phase, 'changes': changes}
+        if self._lines is None:
+            self._lines = len(self._repair())
+        with open(self.journal, 'a') as fh:
+            fh.write(json.dumps(record, default=to_serializable) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        # Only a record that is on disk marks the changes as saved.
+        run_data.pop_changes()
+        self._labels = (run_data.get('iteration'), run_data.get('phase'))
+        self._lines += 1
+        if self._lines >= self.compact_every:
+            self.compact(run_data)
+        return True
+
+    def _segments(self):
+        """Compacted journal segments, oldest first."""
+        segments = glob.glob('{}.*'.format(glob.escape(self.journal)))
+        return sorted((int(segment.rsplit('.', 1)[1]), segment) for segment in segments
+                      if segment.rsplit('.', 1)[1].isdigit())
+
+    def compact(self, run_data):
+        """Writes the full state to the snapshot and starts a new journal.
+
+        Parameters
+        ----------
+        run_data : RunData
+            the current state, which must include everything in the journal.
+        """
+        atomic_write_json(run_data.as_dictionary(), self.snapshot)
+        if os.path.exists(self.journal):
+            if self.keep_history:
+                segments = self._segments()
+                number = segments[-1][0] + 1 if segments else 1
+                os.replace(self.journal, '{}.{}'.format(self.journal, number))
+            else:
+                os.remove(self.journal)
+            fsync_directory(os.path.dirname(os.path.abspath(self.journal)))
+        self._lines = 0
+
+    def history(self, keys=('alpha', 'target')):
+        """Every recorded change of the given pair parameters, across all kept
+        journal segments.
+
+        Parameters
+        ----------
+        keys : tuple, optional
+            pair parameters to report, by default ('alpha', 'target')
+
+        Returns
+        -------
+        list
+            dictionaries with the time, iteration, phase, pair name, parameter and value of
+            each change, oldest first.
+        """
+        history = []
+        journals = [segment for _, segment in self._segments()] + [self.journal]
+        for journal in journals:
+            for record in self._read_journal(journal):
+                for name, key, value in record['changes']:
+                    if name is not None and key in keys:
+                        history.append({
+                            'time': record['time'],
+                            'iteration': record['iteration'],
+                            'phase': record['phase'],
+                            'name': name,
+                            'key': key,
+                            'value': value
+                        })
+        return history
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    member INTEGER PRIMARY KEY,
+    iteration INTEGER,
+    phase TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS members_phase ON members (phase, iteration);
+CREATE TABLE IF NOT EXISTS general (
+    member INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (member, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS pairs (
+    member INTEGER NOT NULL,
+    pair TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (member, pair, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS history (
+    member INTEGER NOT NULL,
+    iteration INTEGER,
+    pair TEXT NOT NULL,
+    phase TEXT,
+    key TEXT NOT NULL,
+    value TEXT,
+    time REAL
+);
+CREATE INDEX IF NOT EXISTS history_member_iteration_pair ON history (member, iteration, pair);
+CREATE INDEX IF NOT EXISTS history_pair_key ON history (pair, key);
+"""
+
+
+class EnsembleDatabase:
+    """SQLite database holding the state of every member of an ensemble,
+    together with the history of every change of a pair parameter.
+
+    Each member process opens its own connection. Writes are short
+    ``BEGIN IMMEDIATE`` transactions that wait up to ``timeout`` seconds for
+    each other. By default the database uses a rollback journal
+    (``journal_mode='delete'``), which only needs the file locks of the file
+    system, so members can share it across the nodes of a cluster. In WAL mode
+    readers (e.g. status queries) never block the members, but WAL relies on
+    shared memory between the processes using the database: only use
+    ``journal_mode='wal'`` when all of them run on the same host. Commits are
+    fully synced to disk, except in WAL mode, where a power loss can at most
+    lose the last transactions but never corrupts the database.
+    """
+
+    def __init__(self, database, timeout=60., journal_mode='delete'):
+        """
+        Parameters
+        ----------
+        database : str
+            path to the database file, created if it does not exist.
+        timeout : float, optional
+            seconds to wait for another process to finish writing, by default 60.
+        journal_mode : str, optional
+            SQLite journal mode, by default 'delete'
+        """
+        self.database = database
+        self.timeout = timeout
+        self.journal_mode = journal_mode
+        self._connection = None
+
+    @property
+    def connection(self):
+        """Connection of this process to the database, opened (and the schema
+        created) on first use.
+
+        Returns
+        -------
+        sqlite3.Connection
+        """
+        if self._connection is None:
+            connection = sqlite3.connect(self.database, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA busy_timeout = {:d}'.format(int(self.timeout * 1000)))
+            connection.execute('PRAGMA journal_mode = {}'.format(self.journal_mode))
+            # With a rollback journal, NORMAL can lose committed transactions on power loss.
+            synchronous = 'NORMAL' if self.journal_mode.lower() == 'wal' else 'FULL'
+            connection.execute('PRAGMA synchronous = {}'.format(synchronous))
+            with self._transaction(connection):
+                for statement in _SCHEMA.split(';'):
+                    if statement.strip():
+                        connection.execute(statement)
+            self._connection = connection
+        return self._connection
+
+    @staticmethod
+    @contextmanager
+    def _transaction(connection):
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def transaction(self):
+        """Context manager for a write transaction.
+
+        Returns
+        -------
+        contextmanager
+            yields the connection.
+        """
+        return self._transaction(self.connection)
+
+    def close(self):
+        """Closes the connection of this process."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def has_member(self, ensemble_num):
+        """Whether the state of an ensemble member has been saved.
+
+        Parameters
+        ----------
+        ensemble_num : int
+            the ensemble member.
+
+        Returns
+        -------
+        bool
+        """
+        row = self.connection.execute('SELECT 1 FROM members WHERE member = ?', (ensemble_num, )).fetchone()
+        return row is not None
+
+    def get_state(self, ensemble_num):
+        """State of an ensemble member in the ``state.json`` layout.
+
+        Parameters
+        ----------
+        ensemble_num : int
+            the ensemble member.
+
+        Returns
+        -------
+        dict
+            the state, as written by ``RunData.as_dictionary``.
+        """
+        connection = self.connection
+        general = {
+            key: json.loads(value)
+            for key, value in connection.execute('SELECT key, value FROM general WHERE member = ?', (ensemble_num, ))
+        }
+        pairs = {}
+        for pair, key, value in connection.execute('SELECT pair, key, value FROM pairs WHERE member = ?',
+                                                   (ensemble_num, )):
+            pairs.setdefault(pair, {})[key] = json.loads(value)
+        return {'general parameters': general, 'pair parameters': pairs}
+
+    def _update_member(self, connection, ensemble_num):
+        """Refreshes the status row of a member from its general parameters."""
+        general = dict(
+            connection.execute("SELECT key, value FROM general WHERE member = ? AND key IN ('iteration', 'phase')",
+                               (ensemble_num, )))
+        connection.execute('INSERT OR REPLACE INTO members (member, iteration, phase, updated) VALUES (?, ?, ?, ?)',
+                           (ensemble_num, json.loads(general.get('iteration', 'null')),
+                            json.loads(general.get('phase', 'null')), time.time()))
+
+    def set_state(self, ensemble_num, state: dict):
+        """Replaces the state of an ensemble member. History is not touched.
+
+        Parameters
+        ----------
+        ensemble_num : int
+            the ensemble member.
+        state : dict
+            the state in the ``state.json`` layout.
+        """
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM general WHERE member = ?', (ensemble_num, ))
+            connection.execute('DELETE FROM pairs WHERE member = ?', (ensemble_num, ))
+            connection.executemany('INSERT INTO general (member, key, value) VALUES (?, ?, ?)',
+                                   [(ensemble_num, key, json.dumps(value, default=to_serializable))
+                                    for key, value in state['general parameters'].items()])
+            connection.executemany('INSERT INTO pairs (member, pair, key, value) VALUES (?, ?, ?, ?)',
+                                   [(ensemble_num, pair, key, json.dumps(value, default=to_serializable))
+                                    for pair, params in state['pair parameters'].items()
+                                    for key, value in params.items()])
+            self._update_member(connection, ensemble_num)
+
+    def apply_changes(self, ensemble_num, changes, iteration=None, phase=None):
+        """Applies changes recorded by ``RunData.pop_changes`` to the state of
+        an ensemble member, and appends the changes of pair parameters to the
+        history.
+
+        Parameters
+        ----------
+        ensemble_num : int
+            the ensemble member.
+        changes : list
+            (pair name or None, key, value) tuples.
+        iteration : int, optional
+            iteration to record in the history, by default the member's iteration before the changes
+        phase : str, optional
+            phase to record in the history, by default the member's phase before the changes
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            # The changes of a phase are saved together with the move to the next phase: they belong
+            # to the phase the member was in.
+            row = connection.execute('SELECT iteration, phase FROM members WHERE member = ?',
+                                     (ensemble_num, )).fetchone()
+            if row is not None:
+                iteration = row[0] if iteration is None else iteration
+                phase = row[1] if phase is None else phase
+            for name, key, value in changes:
+                if name is None and key == 'pair parameters':
+                    connection.execute('DELETE FROM pairs WHERE member = ?', (ensemble_num, ))
+                    continue
+                value = json.dumps(value, default=to_serializable)
+                if name is None:
+                    connection.execute('INSERT OR REPLACE INTO general (member, key, value) VALUES (?, ?, ?)',
+                                       (ensemble_num, key, value))
+                else:
+                    connection.execute('INSERT OR REPLACE INTO pairs (member, pair, key, value) VALUES (?, ?, ?, ?)',
+                                       (ensemble_num, name, key, value))
+                    connection.execute(
+                        'INSERT INTO history (member, iteration, pair, phase, key, value, time) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)', (ensemble_num, iteration, name, phase, key, value, now))
+            self._update_member(connection, ensemble_num)
+
+    def status(self, phase=None):
+        """Iteration and phase of every ensemble member.
+
+        Parameters
+        ----------
+        phase : str, optional
+            only report members in this phase, by default None
+
+        Returns
+        -------
+        dict
+            (iteration, phase) tuples keyed by ensemble member.
+        """
+        if phase is None:
+            rows = self.connection.execute('SELECT member, iteration, phase FROM members ORDER BY member')
+        else:
+            rows = self.connection.execute(
+                'SELECT member, iteration, phase FROM members WHERE phase = ? ORDER BY member', (phase, ))
+        return {member: (iteration, phase) for member, iteration, phase in rows}
+
+    def history(self, key='alpha', ensemble_num=None, pair=None):
+        """Recorded values of a pair parameter.
+
+        Parameters
+        ----------
+        key : str, optional
+            the pair parameter, by default 'alpha'
+        ensemble_num : int, optional
+            only report this ensemble member, by default None
+        pair : str, optional
+            only report this pair, by default None
+
+        Returns
+        -------
+        list
+            (member, iteration, pair, phase, value) tuples, in the order they were recorded.
+        """
+        query = 'SELECT member, iteration, pair, phase, value FROM history WHERE key = ?'
+        parameters = [key]
+        if ensemble_num is not None:
+            query += ' AND member = ?'
+            parameters.append(ensemble_num)
+        if pair is not None:
+            query += ' AND pair = ?'
+            parameters.append(pair)
+        query += ' ORDER BY rowid'
+        return [(member, iteration, name, phase, json.loads(value))
+                for member, iteration, name, phase, value in self.connection.execute(query, parameters)]
+
+    def import_json(self, ensemble_dir):
+        """Imports every ``mem_*/state.json`` of an ensemble directory.
+
+        Parameters
+        ----------
+        ensemble_dir : str
+            path to top directory which contains the full ensemble.
+
+        Returns
+        -------
+        list
+            ensemble members that were imported.
+        """
+        imported = []
+        for entry in sorted(os.scandir(ensemble_dir), key=lambda entry: entry.name):
+            state_json = os.path.join(entry.path, 'state.json')
+            if not entry.name.startswith('mem_') or not os.path.exists(state_json):
+                continue
+            with open(state_json) as fh:
+                state = json.load(fh)
+            ensemble_num = state['general parameters'].get('ensemble_num', entry.name[len('mem_'):])
+            self.set_state(int(ensemble_num), state)
+            imported.append(int(ensemble_num))
+        return imported
+
+    def export_json(self, ensemble_dir):
+        """Writes the state of every ensemble member to
+        ``mem_<member>/state.json`` under an ensemble directory.
+
+        Parameters
+        ----------
+        ensemble_dir : str
+            path to top directory which contains the full ensemble.
+
+        Returns
+        -------
+        list
+            ensemble members that were exported.
+        """
+        members = list(self.status())
+        for ensemble_num in members:
+            paths = PathPlan(ensemble_dir, ensemble_num)
+            paths.makedirs(paths.member_dir)
+            atomic_write_json(self.get_state(ensemble_num), str(paths.state_json))
+        return members
+
+
+class SQLiteStateStore(StateStore):
+    """State of one ensemble member in an EnsembleDatabase."""
+
+    def __init__(self, database, ensemble_num, **kwargs):
+        """
+        Parameters
+        ----------
+        database : str or EnsembleDatabase
+            the database, or a path to it.
+        ensemble_num : int
+            the ensemble member.
+        **kwargs :
+            passed to EnsembleDatabase if ``database`` is a path.
+        """
+        if not isinstance(database, EnsembleDatabase):
+            database = EnsembleDatabase(database, **kwargs)
+        self.database = database
+        self.ensemble_num = ensemble_num
+
+    def exists(self):
+        return self.database.has_member(self.ensemble_num)
+
+    def load(self, run_data):
+        run_data.from_dictionary(self.database.get_state(self.ensemble_num))
+
+    def save(self, run_data, force=False):
+        changes = run_data.peek_changes()
+        if not changes and not force:
+            return False
+        # Defaults are not recorded as changes, so the first save writes the whole state.
+        if force or not self.exists():
+            self.database.set_state(self.ensemble_num, run_data.as_dictionary())
+        else:
+            self.database.apply_changes(self.ensemble_num, changes)
+        # Only changes that are in the database are forgotten: a failed write is retried by the next save.
+        run_data.pop_changes()
+        return True
+
+
+#: State store layouts understood by open_state_store.
+STATE_STORES = ('json', 'journal', 'sqlite')
+
+
+def open_state_store(kind, ensemble_dir, ensemble_num, **kwargs):
+    """Creates the state store of an ensemble member.
+
+    Parameters
+    ----------
+    kind : str
+        one of 'json' (JSONStateStore), 'journal' (JournalStateStore) or 'sqlite'
+        (SQLiteStateStore on ``ensemble_dir/state.db``).
+    ensemble_dir : str
+        path to top directory which contains the full ensemble.
+    ensemble_num : int
+        the ensemble member.
+    **kwargs :
+        passed to the store, e.g. ``journal_mode`` for 'sqlite' (see EnsembleDatabase).
+
+    Returns
+    -------
+    StateStore
+    """
+    state_json = str(PathPlan(ensemble_dir, ensemble_num).state_json)
+    if kind == 'json':
+        return JSONStateStore(state_json, **kwargs)
+    elif kind == 'journal':
+        return JournalStateStore(state_json, **kwargs)
+    elif kind == 'sqlite':
+        return SQLiteStateStore(os.path.join(ensemble_dir, 'state.db'), ensemble_num, **kwargs)
+    raise ValueError('{} is not a valid state store. Choose one of {}'.format(kind, STATE_STORES))
@@ -0,0 +1,248 @@
+"""Pre-generation of BRER targets for a whole ensemble.
+
+Targets for every (ensemble member, iteration) are drawn up front from
+independent, reproducible random streams, one per ensemble member, and stored
+as a single array of shape (members, iterations, pairs). Training phases then
+only have to look up their targets instead of re-sampling.
+"""
+
+import json
+
+import numpy as np
+from run_brer.pair_data import MultiPair, index_filename, latin_hypercube
+
+#: Ways of assigning targets to ensemble members.
+METHODS = ('random', 'stratified')
+
+# Spawn key of the stream shared by the members of stratified schedules. Member
+# streams are keyed by ensemble number, so this keeps the two apart.
+_STRATIFIED_KEY = 2**32 - 1
+
+
+def histogram_error(pairs: MultiPair, targets):
+    """Total variation distance between the histogram of the targets and the
+    DEER distribution of each pair, accumulated over iterations.
+
+    Parameters
+    ----------
+    pairs : MultiPair
+        pair data the targets were drawn from.
+    targets : numpy.ndarray
+        targets with shape (members, iterations, pairs).
+
+    Returns
+    -------
+    numpy.ndarray
+        array of shape (iterations, pairs). Entry ``[k, j]`` is the distance for pair ``j``
+        using the targets of all members over the first ``k + 1`` iterations.
+    """
+    probabilities = pairs.probabilities()
+    num_pairs, num_bins = probabilities.shape
+    num_members, num_iterations = targets.shape[:2]
+
+    indices = pairs.bin_indices(targets)
+    flat = (np.arange(num_iterations)[:, np.newaxis] * num_pairs + np.arange(num_pairs)) * num_bins + indices
+    counts = np.bincount(flat.ravel(), minlength=num_iterations * num_pairs * num_bins)
+    counts = np.cumsum(counts.reshape(num_iterations, num_pairs, num_bins), axis=0)
+
+    samples = num_members * np.arange(1, num_iterations + 1)[:, np.newaxis, np.newaxis]
+    return 0.5 * np.abs(counts / samples - probabilities).sum(axis=2)
+
+
+class TargetSchedule:
+    """Targets for every ensemble member and BRER iteration."""
+
+    def __init__(self, targets, names, ensemble_nums, seed, method='random'):
+        """
+        Parameters
+        ----------
+        targets : numpy.ndarray
+            array of targets with shape (members, iterations, pairs).
+        names : list
+            pair names, in the order of the last axis of ``targets``.
+        ensemble_nums : list
+            ensemble member numbers, in the order of the first axis of ``targets``.
+        seed : int
+            root entropy of the random streams used to generate the targets.
+        method : str, optional
+            how the targets were assigned to members (see ``generate``), by default 'random'
+        """
+        if targets.shape != (len(ensemble_nums), targets.shape[1], len(names)):
+            raise ValueError('targets of shape {} do not match {} members and {} pairs'.format(
+                targets.shape, len(ensemble_nums), len(names)))
+        self.targets = targets
+        self.names = list(names)
+        self.ensemble_nums = [int(num) for num in ensemble_nums]
+        self.seed = seed
+        self.method = method
+        self._member_index = {num: i for i, num in enumerate(self.ensemble_nums)}
+
+    @property
+    def num_iterations(self):
+        """Number of BRER iterations covered by the schedule.
+
+        Returns
+        -------
+        int
+        """
+        return self.targets.shape[1]
+
+    @staticmethod
+    def stream(seed, ensemble_num, iteration=0, num_pairs=0):
+        """Random generator of one ensemble member: the stream obtained from
+        ``SeedSequence(seed).spawn`` over ensemble members. Iteration ``k`` of
+        the member uses the ``k``-th block of ``num_pairs`` uniform numbers
+        drawn from it, so its targets do not depend on the size of the schedule
+        they belong to. For a single lookup, the generator is advanced to the
+        block of ``iteration``.
+
+        Parameters
+        ----------
+        seed : int
+            root entropy.
+        ensemble_num : int
+            ensemble member number.
+        iteration : int, optional
+            BRER iteration to start at, by default 0
+        num_pairs : int, optional
+            number of pairs, i.e. the size of the block of each iteration, by default 0
+
+        Returns
+        -------
+        numpy.random.Generator
+        """
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(ensemble_num, )))
+        if iteration:
+            # Every uniform double takes one 64 bit draw.
+            rng.bit_generator.advance(iteration * num_pairs)
+        return rng
+
+    @classmethod
+    def generate(cls, pairs: MultiPair, ensemble_nums, num_iterations, seed=None, method='random'):
+        """Draws targets for all members and iterations in one vectorized
+        pass over the compiled pair distributions.
+
+        With ``method='random'`` every member draws the uniform numbers of all
+        its iterations at once from its own stream (see ``stream``). With
+        ``method='stratified'``, the members share one stream and the members
+        of each iteration are assigned targets from a Latin hypercube over the
+        pairs, so that every iteration covers each pair's distribution as
+        evenly as the ensemble size allows. Either way, the whole block of
+        uniform numbers is then converted into targets at once.
+
+        Parameters
+        ----------
+        pairs : MultiPair
+            pair data from which the targets are drawn.
+        ensemble_nums : list
+            ensemble member numbers.
+        num_iterations : int
+            number of BRER iterations to generate targets for.
+        seed : int, optional
+            root entropy. If None, fresh entropy is drawn and stored with the schedule, by default None
+        method : str, optional
+            one of 'random' or 'stratified', by default 'random'
+
+        Returns
+        -------
+        TargetSchedule
+        """
+        if method not in METHODS:
+            raise ValueError('{} is not a valid method. Choose one of {}'.format(method, METHODS))
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        num_pairs = len(pairs.names)
+        uniforms = np.empty((len(ensemble_nums), num_iterations, num_pairs), dtype=np.float64)
+        if method == 'random':
+            for i, ensemble_num in enumerate(ensemble_nums):
+                uniforms[i] = cls.stream(seed, ensemble_num).random((num_iterations, num_pairs))
+        else:
+            rng = cls.stream(seed, _STRATIFIED_KEY)
+            for iteration in range(num_iterations):
+                uniforms[:, iteration] = latin_hypercube(len(ensemble_nums), num_pairs, rng)
+
+        return cls(pairs.inverse_cdf(uniforms), pairs.names, ensemble_nums, seed, method)
+
+    def histogram_error(self, pairs: MultiPair):
+        """Convenience wrapper around ``histogram_error`` for this schedule.
+
+        Parameters
+        ----------
+        pairs : MultiPair
+            pair data the schedule was generated from.
+
+        Returns
+        -------
+        numpy.ndarray
+            array of shape (iterations, pairs); see ``histogram_error``.
+        """
+        return histogram_error(pairs, self.targets)
+
+    def get_targets(self, ensemble_num, iteration):
+        """Look up the targets of one member at one iteration.
+
+        Parameters
+        ----------
+        ensemble_num : int
+            ensemble member number.
+        iteration : int
+            BRER iteration.
+
+        Returns
+        -------
+        dict
+            dictionary of targets, keyed by pair name.
+
+        Raises
+        ------
+        KeyError
+            if the member is not part of the schedule.
+        IndexError
+            if the iteration is beyond the end of the schedule.
+        """
+        if ensemble_num not in self._member_index:
+            raise KeyError('Ensemble member {} is not part of the target schedule'.format(ensemble_num))
+        if not 0 <= iteration < self.num_iterations:
+            raise IndexError('The target schedule only covers {} iterations; iteration {} was requested'.format(
+                self.num_iterations, iteration))
+        row = self.targets[self._member_index[ensemble_num], iteration]
+        return {name: float(row[j]) for j, name in enumerate(self.names)}
+
+    def save(self, filename='targets.npy'):
+        """Writes the targets to a ``.npy`` file and the metadata to a small
+        JSON index next to it (see ``index_filename``).
+
+        Parameters
+        ----------
+        filename : str, optional
+            path to the array file, by default 'targets.npy'
+        """
+        np.save(filename, np.ascontiguousarray(self.targets))
+        with open(index_filename(filename), 'w') as fh:
+            json.dump({
+                'names': self.names,
+                'ensemble_nums': self.ensemble_nums,
+                'seed': self.seed,
+                'method': self.method
+            }, fh)
+
+    @classmethod
+    def load(cls, filename='targets.npy', mmap_mode='r'):
+        """Loads a schedule written by ``save``. By default, the targets are
+        memory-mapped so that a member only reads the rows it looks up.
+
+        Parameters
+        ----------
+        filename : str, optional
+            path to the array file, by default 'targets.npy'
+        mmap_mode : str, optional
+            passed to ``np.load``, by default 'r'
+
+        Returns
+        -------
+        TargetSchedule
+        """
+        with open(index_filename(filename)) as fh:
+            index = json.load(fh)
+        targets = np.load(filename, mmap_mode=mmap_mode)
+        return cls(targets, index['names'], index['ensemble_nums'], index['seed'], index.get('method', 'random'))
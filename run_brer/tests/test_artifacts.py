@@ -0,0 +1,123 @@
+"""Unit tests and regression for the artifact store."""
+from run_brer.artifacts import ARTIFACTS_DIR, LEASES_DIR, ArtifactStore, NodeCache
+from run_brer.handoff import file_checksum
+import os
+import subprocess
+import sys
+import time
+
+
+def _input(tmpdir, name, contents):
+    filename = "{}/inputs/{}".format(tmpdir, name)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "wb") as fh:
+        fh.write(contents)
+    return filename
+
+
+def test_resolve(tmpdir):
+    """Inputs resolve to node-local copies of content-addressed artifacts.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    tpr = _input(tmpdir, "topol.tpr", b"tpr")
+    store = ArtifactStore("{}/ensemble".format(tmpdir), cache="{}/node".format(tmpdir))
+    resolved = store.resolve(tpr)
+    digest = file_checksum(tpr)
+    assert resolved == "{}/node/{}/topol.tpr".format(tmpdir, digest)
+    assert open(resolved, "rb").read() == b"tpr"
+    assert os.path.exists("{}/ensemble/{}/{}/topol.tpr".format(tmpdir, ARTIFACTS_DIR, digest))
+
+    # Another store on the same node finds the copy without going to the store.
+    other = ArtifactStore("{}/ensemble".format(tmpdir), cache="{}/node".format(tmpdir))
+    other.add = None
+    assert other.resolve(tpr) == resolved
+
+    # A changed input is a new artifact.
+    time.sleep(0.01)
+    _input(tmpdir, "topol.tpr", b"new tpr")
+    changed = store.resolve(tpr)
+    assert changed != resolved
+    assert open(changed, "rb").read() == b"new tpr"
+
+    # Without a node cache, inputs resolve to the store.
+    shared = ArtifactStore("{}/ensemble".format(tmpdir), cache=False)
+    assert shared.resolve(tpr) == "{}/ensemble/{}/{}/topol.tpr".format(tmpdir, ARTIFACTS_DIR, file_checksum(tpr))
+
+
+def test_companions(tmpdir):
+    """Files read together are stored together.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    pairs = _input(tmpdir, "pair_data.npy", b"bins")
+    index = _input(tmpdir, "pair_data.index.json", b"{}")
+    store = ArtifactStore("{}/ensemble".format(tmpdir), cache="{}/node".format(tmpdir))
+    resolved = store.resolve(pairs, (index, ))
+    assert os.path.basename(resolved) == "pair_data.npy"
+    assert open("{}/pair_data.index.json".format(os.path.dirname(resolved)), "rb").read() == b"{}"
+
+
+def test_eviction(tmpdir):
+    """The node cache evicts the least recently used artifacts.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    cache = NodeCache("{}/node".format(tmpdir), max_bytes=250)
+    store = ArtifactStore("{}/ensemble".format(tmpdir), cache=cache)
+    inputs = [_input(tmpdir, "input{}.tpr".format(i), bytes([i]) * 100) for i in range(3)]
+    resolved = [store.resolve(filename) for filename in inputs[:2]]
+    time.sleep(0.01)
+    # Using the first input makes the second one the least recently used.
+    assert store.resolve(inputs[0]) == resolved[0]
+    for filename in resolved:
+        cache.release(filename)
+    time.sleep(0.01)
+    store.resolve(inputs[2])
+    assert cache.size() == 200
+    assert os.path.exists(resolved[0])
+    assert not os.path.exists(resolved[1])
+    # An evicted artifact is copied again from the store.
+    assert open(store.resolve(inputs[1]), "rb").read() == bytes([1]) * 100
+
+
+def test_leases(tmpdir):
+    """Artifacts leased by a live process are never evicted; the leases of
+    processes that have died do not count.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    cache = NodeCache("{}/node".format(tmpdir), max_bytes=150)
+    store = ArtifactStore("{}/ensemble".format(tmpdir), cache=cache)
+    inputs = [_input(tmpdir, "input{}.tpr".format(i), bytes([i]) * 100) for i in range(3)]
+    first = store.resolve(inputs[0])
+    time.sleep(0.01)
+    second = store.resolve(inputs[1])
+    # This process still uses the first input.
+    assert os.path.exists(first)
+    assert cache.size() == 200
+
+    # Hand the lease on the first input over to a process that has exited.
+    cache.release(first)
+    child = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    dead = "{}/node/{}/{}/{}".format(tmpdir, LEASES_DIR, os.path.basename(os.path.dirname(first)),
+                                     child.stdout.strip())
+    open(dead, "w").close()
+    cache.release(second)
+    time.sleep(0.01)
+    store.resolve(inputs[2])
+    assert not os.path.exists(first)
+    assert not os.path.exists(second)
+    assert cache.size() == 100
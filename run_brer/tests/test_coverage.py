@@ -0,0 +1,66 @@
+"""Unit tests and regression for CoverageMonitor class."""
+from run_brer.coverage import CoverageMonitor, coverage_reached, reset_coverage
+from run_brer.history import HISTORY_FILE, HistoryWriter
+from run_brer.pair_data import MultiPair
+from run_brer.target_schedule import TargetSchedule
+import os
+import pytest
+
+
+@pytest.mark.parametrize("divergence", ["kl", "js", "wasserstein"])
+def test_coverage_monitor(tmpdir, data_dir, divergence):
+    """Append the history of members for successive iterations and check
+    that the monitor counts each iteration once and signals coverage.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    data_dir : str
+        pytest data directory
+    divergence : str
+        divergence used by the monitor
+    """
+    mp = MultiPair()
+    mp.read_from_json("{}/pair_data.json".format(data_dir))
+    num_members = 100
+    schedule = TargetSchedule.generate(mp, range(1, num_members + 1), num_iterations=2, seed=3, method="stratified")
+
+    monitor = CoverageMonitor(str(tmpdir), mp, divergence=divergence, threshold=0.25, min_samples=num_members)
+    assert not monitor.poll()
+
+    writers = {}
+    for member in range(1, num_members + 1):
+        os.makedirs("{}/mem_{}".format(tmpdir, member))
+        writers[member] = HistoryWriter("{}/mem_{}/{}".format(tmpdir, member, HISTORY_FILE), mp.names, member)
+    alphas = {name: 0. for name in mp.names}
+
+    # Nobody has finished training: nothing to count.
+    assert monitor.update() == 0
+
+    for iteration in range(2):
+        for member in range(1, num_members + 1):
+            targets = schedule.get_targets(member, iteration)
+            writers[member].append(iteration, "training", targets, alphas)
+            # Later phases of the iteration repeat its targets.
+            writers[member].append(iteration, "convergence", targets, alphas)
+        assert monitor.update() == num_members
+        # Nothing was appended, so nothing is counted twice.
+        assert monitor.update() == 0
+
+    assert monitor.num_samples == 2 * num_members
+    assert monitor.divergences().shape == (len(mp.names), )
+    assert monitor.poll()
+    assert coverage_reached(str(tmpdir))
+    assert coverage_reached(str(tmpdir), monitor)
+
+    # A stricter criterion does not count the marker, and removes it once it is not reached.
+    stricter = CoverageMonitor(str(tmpdir), mp, divergence=divergence, threshold=1e-6, min_samples=num_members)
+    assert not coverage_reached(str(tmpdir), stricter)
+    assert not stricter.poll()
+    assert not coverage_reached(str(tmpdir))
+
+    assert monitor.poll()
+    assert reset_coverage(str(tmpdir))
+    assert not coverage_reached(str(tmpdir))
+    assert not reset_coverage(str(tmpdir))
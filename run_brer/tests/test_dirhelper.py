@@ -1,5 +1,5 @@
 """Unit tests and regression for DirectoryHelper class."""
-from run_brer.directory_helper import DirectoryHelper
+from run_brer.directory_helper import PHASE_ORDER, DirectoryHelper, MetadataCounter, PathPlan
 import os
 
 
@@ -19,3 +19,37 @@ def test_directory(tmpdir):
     assert (os.getcwd() == '{}/mem_{}/{}/{}'.format(top_dir, 1, 0, 'training'))
 
     os.chdir(my_home)
+
+
+def test_path_plan(tmpdir):
+    """Paths follow the DirectoryHelper layout and directories are only
+    created once.
+
+    Parameters
+    ----------
+    tmpdir :
+        temporary pytest directory.
+    """
+    my_home = os.path.abspath(os.getcwd())
+    counter = MetadataCounter()
+    paths = PathPlan(tmpdir, 1, counter=counter)
+    dir_helper = DirectoryHelper(tmpdir, {'ensemble_num': 1, 'iteration': 2, 'phase': 'production'})
+    assert str(paths.phase_dir(2, 'production')) == dir_helper.get_dir('phase')
+    assert str(paths.state_json) == '{}/mem_1/state.json'.format(tmpdir)
+    assert paths.source_checkpoint(0, 'training') is None
+    assert paths.source_checkpoint(2, 'convergence') == paths.checkpoint(1, 'production')
+    assert paths.source_checkpoint(2, 'production') == paths.checkpoint(2, 'convergence')
+
+    paths.make_phase_dir(0, 'training', ahead=2)
+    assert counter.reset() == {'makedirs': len(PHASE_ORDER) * 3}
+    for iteration in range(3):
+        for phase in PHASE_ORDER:
+            assert os.path.isdir(str(paths.phase_dir(iteration, phase)))
+            paths.make_phase_dir(iteration, phase, ahead=2)
+    assert counter.total == 0
+
+    paths.chdir(paths.make_phase_dir(3, 'training'))
+    assert counter.reset() == {'makedirs': 1, 'chdir': 1}
+    assert os.getcwd() == str(paths.phase_dir(3, 'training'))
+
+    os.chdir(my_home)
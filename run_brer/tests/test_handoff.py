@@ -0,0 +1,109 @@
+"""Unit tests and regression for checkpoint handoff."""
+from run_brer.handoff import AUTO_STRATEGIES, STRATEGIES, CheckpointHandoff, file_checksum, sampled_checksum
+import os
+import pytest
+
+
+def _checkpoint(directory, size=1 << 16):
+    os.makedirs(directory)
+    filename = "{}/state.cpt".format(directory)
+    with open(filename, "wb") as fh:
+        fh.write(os.urandom(size))
+    return filename
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES + ("auto", ))
+def test_handoff(tmpdir, strategy):
+    """Every strategy leaves the contents of the source at the destination.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    strategy : str
+        handoff strategy
+    """
+    src = _checkpoint("{}/convergence".format(tmpdir))
+    checksum = file_checksum(src)
+    os.makedirs("{}/production".format(tmpdir))
+    dst = "{}/production/state.cpt".format(tmpdir)
+
+    handoff = CheckpointHandoff(strategy)
+    used = handoff.transfer(src, dst)
+    assert used in STRATEGIES
+    if strategy != "auto" and strategy != "reflink":
+        assert used == strategy
+    assert file_checksum(dst) == checksum
+    assert os.path.exists(src) == (used != "rename")
+    assert handoff.bytes_written == (os.path.getsize(dst) if used == "copy" else 0)
+
+
+def test_detect(tmpdir):
+    """Detection finds the strategies of the file system, ending with copy.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    handoff = CheckpointHandoff()
+    supported = handoff.detect(str(tmpdir), str(tmpdir))
+    assert supported[-1] == "copy"
+    assert "hardlink" in supported
+    assert set(supported) <= set(AUTO_STRATEGIES)
+    assert "symlink" not in supported
+    assert os.listdir(str(tmpdir)) == []
+    with pytest.raises(ValueError):
+        CheckpointHandoff("teleport")
+    with pytest.raises(ValueError):
+        CheckpointHandoff(verify="sometimes")
+
+
+def test_checksum_guard(tmpdir, monkeypatch):
+    """A destination that differs from the source is removed.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    monkeypatch : pytest fixture
+        used to corrupt the copy
+    """
+    src = _checkpoint("{}/convergence".format(tmpdir))
+    dst = "{}/state.cpt".format(tmpdir)
+
+    def corrupt(src, dst):
+        with open(dst, "wb") as fh:
+            fh.write(b"garbage")
+
+    monkeypatch.setattr("shutil.copyfile", corrupt)
+    for verify in ("sample", "full"):
+        with pytest.raises(IOError):
+            CheckpointHandoff("copy", verify=verify).transfer(src, dst)
+        assert not os.path.exists(dst)
+    # Without the guard the corrupt copy is kept.
+    assert CheckpointHandoff("copy", verify=False).transfer(src, dst) == "copy"
+    assert os.path.exists(dst)
+
+
+def test_sampled_checksum(tmpdir):
+    """The sampled checksum sees the size and the sampled blocks of a file.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    filename = _checkpoint("{}/convergence".format(tmpdir), size=1 << 20)
+    checksum = sampled_checksum(filename)
+    with open(filename, "r+b") as fh:
+        fh.seek(-1, os.SEEK_END)
+        last = fh.read(1)
+        fh.seek(-1, os.SEEK_END)
+        fh.write(b"\x00" if last != b"\x00" else b"\x01")
+    assert os.path.getsize(filename) == 1 << 20
+    assert sampled_checksum(filename) != checksum
+    checksum = sampled_checksum(filename)
+    with open(filename, "ab") as fh:
+        fh.write(b"\x00")
+    assert sampled_checksum(filename) != checksum
@@ -0,0 +1,106 @@
+"""Unit tests and regression for the BRER history."""
+from run_brer.history import HISTORY_FILE, RECORD_DTYPE, HistoryWriter, load_history, read_history
+import numpy as np
+import os
+import pytest
+
+
+def _write_member(ensemble_dir, ensemble_num, names, num_iterations):
+    member_dir = "{}/mem_{}".format(ensemble_dir, ensemble_num)
+    os.makedirs(member_dir)
+    writer = HistoryWriter("{}/{}".format(member_dir, HISTORY_FILE), names, ensemble_num)
+    for iteration in range(num_iterations):
+        targets = {name: iteration + 0.1 * j for j, name in enumerate(names)}
+        alphas = {name: -float(ensemble_num) for name in names}
+        for phase in ("training", "convergence", "production"):
+            writer.append(iteration, phase, targets, alphas, start_time=10. * iteration, wall_time=1.)
+    return writer
+
+
+def test_history(tmpdir):
+    """Records of several members are loaded as one array; pair indices of
+    members with a different pair order are remapped.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    ensemble_dir = str(tmpdir)
+    names = ["a", "b", "c"]
+    _write_member(ensemble_dir, 1, names, 4)
+    writer = _write_member(ensemble_dir, 2, ["c", "a", "b"], 2)
+
+    with pytest.raises(ValueError):
+        HistoryWriter(writer.filename, names, 2)
+
+    # A record cut short by a crash is ignored.
+    with open(writer.filename, "ab") as fh:
+        fh.write(b"\0" * 7)
+    records, member_names = read_history(writer.filename)
+    assert member_names == ["c", "a", "b"]
+    assert len(records) == 2 * 3 * 3
+
+    history = load_history(ensemble_dir)
+    assert history.names == names
+    assert len(history) == (4 + 2) * 3 * 3
+
+    selected = history.select(ensemble_num=2, pair="c", phase="convergence")
+    assert np.allclose(selected["target"], [0., 1.])
+    assert np.all(selected["alpha"] == -2.)
+
+    targets, alphas, members, iterations = history.trained()
+    assert targets.shape == alphas.shape == (6, 3)
+    assert list(members) == [1, 1, 1, 1, 2, 2]
+    assert list(iterations) == [0, 1, 2, 3, 0, 1]
+    assert np.allclose(targets[-1], [1.1, 1.2, 1.])
+
+
+def test_append_after_torn_record(tmpdir):
+    """A new writer cuts off a partial record, so later records stay aligned.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    ensemble_dir = str(tmpdir)
+    names = ["a", "b"]
+    writer = _write_member(ensemble_dir, 1, names, 1)
+    with open(writer.filename, "ab") as fh:
+        fh.write(b"\1" * 7)
+
+    writer = HistoryWriter(writer.filename, names, 1)
+    writer.append(1, "training", {"a": 5., "b": 6.}, {"a": 1., "b": 2.})
+    records, _ = read_history(writer.filename)
+    assert len(records) == 3 * 2 + 2
+    assert list(records["iteration"][-2:]) == [1, 1]
+    assert np.allclose(records["target"][-2:], [5., 6.])
+
+
+def test_append_after_torn_phase(tmpdir):
+    """A new writer cuts off the records of a phase that was written only in
+    part, so every phase keeps one record per pair.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    ensemble_dir = str(tmpdir)
+    names = ["a", "b", "c"]
+    writer = _write_member(ensemble_dir, 1, names, 1)
+    partial = np.zeros(2, dtype=RECORD_DTYPE).tobytes()
+    with open(writer.filename, "ab") as fh:
+        fh.write(partial[:RECORD_DTYPE.itemsize + 7])
+    # Readers ignore the partial phase.
+    assert len(read_history(writer.filename)[0]) == 3 * 3
+
+    writer = HistoryWriter(writer.filename, names, 1)
+    assert os.path.getsize(writer.filename) == 3 * 3 * RECORD_DTYPE.itemsize
+    for phase in ("training", "convergence", "production"):
+        writer.append(1, phase, {"a": 5., "b": 6., "c": 7.}, {"a": 1., "b": 2., "c": 3.})
+    targets, alphas, members, iterations = load_history(ensemble_dir).trained()
+    assert targets.shape == (2, 3)
+    assert list(iterations) == [0, 1]
+    assert np.allclose(targets[-1], [5., 6., 7.])
@@ -2,7 +2,8 @@
 """
 
 import pytest
-from run_brer.metadata import MetaData, MultiMetaData
+from copy import deepcopy
+from run_brer.metadata import CompiledMetaData, MetaData, MultiMetaData, NameIndex
 
 
 def test_metadata():
@@ -20,6 +21,53 @@ def test_metadata():
 
     assert metadata.get_as_dictionary() == {"param1": "string", "param2": 0., "bad_parameter": "bad"}
 
+    # Falsy values are set too.
+    metadata.set("param2", 0)
+    assert metadata.get("param2") == 0
+
+
+class CompiledExample(CompiledMetaData):
+    __slots__ = ()
+    parameters = ("param1", "param2")
+
+
+def test_compiled_metadata():
+    metadata = CompiledExample(name="test")
+    assert not hasattr(metadata, "__dict__")
+    assert metadata.get_requirements() == ["param1", "param2"]
+    assert metadata.requires("param1") and not metadata.requires("bad_parameter")
+    assert metadata.get_missing_keys() == ["param1", "param2"]
+    with pytest.raises(KeyError):
+        metadata.get("param1")
+
+    metadata.set("param1", 0)
+    metadata.set(param2="string")
+    assert not metadata.get_missing_keys()
+    assert metadata.get("param1") == 0
+
+    with pytest.warns(Warning):
+        metadata.set("bad_parameter", "bad")
+    assert metadata.get_as_dictionary() == {"param1": 0, "param2": "string", "bad_parameter": "bad"}
+
+    with pytest.raises(KeyError):
+        metadata.set_many({"param1": 1, "other_bad_parameter": 2}, strict=True)
+    assert metadata.get("param1") == 0
+    metadata.set_many({"param1": 1, "param2": 2, "name": "test"}, strict=True)
+    assert metadata.get("param1") == 1
+
+    copy = deepcopy(metadata)
+    copy.set_many({"param2": 3})
+    assert metadata.get("param2") == 2
+    assert copy.get_as_dictionary() == {"param1": 1, "param2": 3, "bad_parameter": "bad", "name": "test"}
+
+    scanned = CompiledExample(name="scanned")
+    scanned.update_from(copy)
+    assert scanned.get_as_dictionary() == {"param1": 1, "param2": 3}
+
+    metadata.set_requirements(["param1", "param3"])
+    assert metadata.get_missing_keys() == ["param3"]
+    assert metadata.get("param2") == 2
+
 
 def test_multi_metadata(tmpdir):
     multi = MultiMetaData()
@@ -43,3 +91,22 @@ def test_multi_metadata(tmpdir):
     multi.read_from_json("{}/state.json".format(tmpdir))
 
     assert old_multi.get_as_single_dataset() == multi.get_as_single_dataset()
+
+
+def test_name_index():
+    index = NameIndex(["a", "b"])
+    assert index.add("c") == 2
+    assert index.id("b") == 1
+    assert index.ids(["c", "a"]).tolist() == [2, 0]
+    assert "a" in index and len(index) == 3
+
+    index.add_alias("[1, 2]", "b")
+    assert index.resolve("[1, 2]") == "b"
+    assert index.resolve("c") == "c"
+
+    with pytest.raises(ValueError):
+        index.add("a")
+    with pytest.raises(ValueError):
+        index.id("d")
+    with pytest.raises(KeyError):
+        index.resolve("[3, 4]")
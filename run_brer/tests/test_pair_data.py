@@ -1,5 +1,6 @@
 """Unit tests and regression for PairData classes."""
-from run_brer.pair_data import PairData, MultiPair
+from run_brer.pair_data import FeasibilityFilter, PairData, MultiPair, convert_json_to_binary, plugin_name
+import numpy as np
 import pytest
 
 
@@ -23,6 +24,13 @@ def test_pair_data(data_dir, raw_pair_data):
 
     samples = mp.re_sample()
     assert list(samples.keys()) == mp.names
+
+    # Names are indexed as soon as the data are read, both by name and by plugin name.
+    fresh = MultiPair()
+    fresh.read_from_json("{}/pair_data.json".format(data_dir))
+    for i, name in enumerate(raw_pair_data):
+        assert fresh.name_to_id(name) == i
+        assert fresh.name_from_plugin(plugin_name(raw_pair_data[name]["sites"])) == name
     
 
 # def test_pair_data(multi_pair_data, raw_pair_data):
@@ -43,3 +51,170 @@ def test_pair_data(data_dir, raw_pair_data):
 
 # def test_resampling(multi_pair_data):
 #     print(multi_pair_data.re_sample())
+
+
+def test_sampler(data_dir):
+    """Checks that the compiled CDF sampler only draws bins with probability
+    mass and that draws are reproducible with a seeded generator."""
+    mp = MultiPair()
+    mp.read_from_json("{}/pair_data.json".format(data_dir))
+
+    samples = mp.sample(num_samples=1000, random_state=np.random.default_rng(0))
+    assert samples.shape == (1000, len(mp.names))
+    for i, name in enumerate(mp.names):
+        pd = mp[mp.name_to_id(name)]
+        assert np.all(np.isin(samples[:, i], pd.get('bins')))
+
+    repeat = mp.sample(num_samples=1000, random_state=np.random.default_rng(0))
+    assert np.array_equal(samples, repeat)
+
+    # Bins with zero probability are never drawn, even at the edges of [0, 1).
+    pd = PairData("edge")
+    pd.set(bins=[1., 2., 3.], distribution=[0., 1., 0.], sites=[1, 2])
+    edge = MultiPair()
+    edge.add_metadata(pd)
+    indices = edge.sample_indices(np.array([[0.], [0.5], [1. - 1e-16]]))
+    assert np.all(indices == 1)
+
+
+@pytest.mark.parametrize("sampler", ["choice", "cdf", "alias"])
+def test_sampler_backends(data_dir, sampler):
+    """All sampling backends reproduce the DEER distributions."""
+    mp = MultiPair(sampler=sampler)
+    mp.read_from_json("{}/pair_data.json".format(data_dir))
+
+    num_samples = 100000
+    samples = mp.sample(num_samples=num_samples, random_state=np.random.default_rng(1))
+    for i, name in enumerate(mp.names):
+        pd = mp[mp.name_to_id(name)]
+        distribution = np.asarray(pd.get('distribution'))
+        counts = np.array([np.sum(samples[:, i] == b) for b in pd.get('bins')])
+        assert np.abs(counts / num_samples - distribution / distribution.sum()).sum() < 0.05
+
+    with pytest.raises(ValueError):
+        mp.sample(sampler="not a sampler")
+
+
+def test_alias_table():
+    """Alias tables reconstruct the original probabilities exactly."""
+    pd = PairData("alias")
+    distribution = np.array([0., 0.1, 0.5, 0.05, 0.35, 0.])
+    pd.set(bins=list(range(6)), distribution=list(distribution), sites=[1, 2])
+    prob, alias = pd.build_alias_table()
+
+    reconstructed = prob.copy()
+    np.add.at(reconstructed, alias, 1. - prob)
+    assert np.allclose(reconstructed / len(distribution), distribution)
+
+
+def test_feasible_sample():
+    """Three restraints that form a triangle only yield target sets that
+    satisfy the triangle inequality and the user-supplied bounds."""
+    bins = np.linspace(1., 10., 10)
+    mp = MultiPair()
+    for name, sites in [("ab", [1, 5, 2]), ("bc", [2, 3]), ("ac", [1, 3]), ("cd", [3, 4])]:
+        pd = PairData(name)
+        pd.set(bins=bins, distribution=np.ones(len(bins)), sites=sites)
+        mp.add_metadata(pd)
+
+    feasibility = FeasibilityFilter(mp, bounds={"cd": (None, 5.)})
+    assert feasibility.triangles.tolist() == [[0, 1, 2]]
+
+    targets, acceptance = mp.feasible_sample(500, feasibility=feasibility, block_size=256,
+                                             random_state=np.random.default_rng(0))
+    assert targets.shape == (500, 4)
+    assert 0. < acceptance < 1.
+    assert feasibility.num_drawn >= 500 and 0. < feasibility.acceptance_rate < 1.
+
+    sides = np.sort(targets[:, :3], axis=1)
+    assert np.all(sides[:, 2] <= sides[:, 0] + sides[:, 1])
+    assert np.all(targets[:, 3] <= 5.)
+
+    with pytest.raises(RuntimeError):
+        mp.feasible_sample(10, feasibility=FeasibilityFilter(mp, bounds={"ab": (11., None)}), block_size=16,
+                           max_blocks=2)
+
+
+def test_truncated_pair_data(tmpdir, data_dir, raw_pair_data):
+    """Compact distributions drop negligible tails, sample only from their
+    support and round-trip through json.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    data_dir : str
+        pytest data directory
+    raw_pair_data : dict
+        dictionary of multiple pair data
+    """
+    mp = MultiPair()
+    mp.read_from_json("{}/pair_data.json".format(data_dir), tolerance=1e-12, dtype=np.float32)
+
+    for name in mp.names:
+        pd = mp[mp.name_to_id(name)]
+        raw = raw_pair_data[name]
+        first, last = np.flatnonzero(np.asarray(raw['distribution']) > 1e-12 * np.sum(raw['distribution']))[[0, -1]]
+        assert pd.get('distribution').dtype == np.float32
+        assert len(pd.get('bins')) == last - first + 1 < len(raw['bins'])
+        assert np.allclose(pd.get('bins'), raw['bins'][first:last + 1])
+        assert np.isclose(pd.normalized().sum(), 1.)
+
+    samples = mp.sample(num_samples=1000, random_state=np.random.default_rng(0))
+    for i, name in enumerate(mp.names):
+        assert np.all(np.isin(samples[:, i], mp[i].get('bins')))
+
+    mp.write_to_json("{}/truncated.json".format(tmpdir))
+    reloaded = MultiPair()
+    reloaded.read_from_json("{}/truncated.json".format(tmpdir))
+    for i, name in enumerate(mp.names):
+        assert reloaded.names[i] == name
+        assert np.allclose(reloaded[i].get('distribution'), mp[i].get('distribution'))
+
+    with pytest.raises(ValueError):
+        mp[0].truncate(tolerance=1.)
+
+
+def test_binary_pair_data(tmpdir, data_dir):
+    """Convert the json pair data to the binary format and check that the
+    memory-mapped data are identical.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    data_dir : str
+        pytest data directory
+    """
+    binary = "{}/pair_data.npy".format(tmpdir)
+    convert_json_to_binary("{}/pair_data.json".format(data_dir), binary)
+
+    from_json = MultiPair()
+    from_json.read("{}/pair_data.json".format(data_dir))
+    from_binary = MultiPair()
+    from_binary.read(binary)
+
+    assert from_binary.names == from_json.names
+    for i in range(len(from_json.names)):
+        assert isinstance(from_binary[i].get('distribution'), np.memmap)
+        assert np.array_equal(from_binary[i].get('bins'), from_json[i].get('bins'))
+        assert np.array_equal(from_binary[i].get('distribution'), from_json[i].get('distribution'))
+        assert from_binary[i].get('sites') == from_json[i].get('sites')
+
+    rng = np.random.default_rng(0)
+    assert np.array_equal(from_binary.sample(100, random_state=np.random.default_rng(0)),
+                          from_json.sample(100, random_state=rng))
+
+
+def test_binary_sampler_is_lazy(tmpdir, data_dir):
+    """Reading binary pair data compiles nothing; the compiled sampler reads
+    the bins from the memory-mapped file instead of copying them."""
+    binary = "{}/pair_data.npy".format(tmpdir)
+    convert_json_to_binary("{}/pair_data.json".format(data_dir), binary)
+    mp = MultiPair()
+    mp.read(binary)
+    assert mp._cdf is None
+
+    mp.sample(10, random_state=np.random.default_rng(0))
+    assert np.shares_memory(mp._bins, mp[0].get('bins'))
+    assert mp._cdf.shape == (sum(len(mp[i].get('bins')) for i in range(len(mp.names))), )
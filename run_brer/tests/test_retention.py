@@ -0,0 +1,95 @@
+"""Unit tests and regression for checkpoint and trajectory retention."""
+from run_brer.directory_helper import PHASE_ORDER, PathPlan
+from run_brer.retention import RETENTION_FILE, RetentionManager, RetentionPolicy
+import json
+import os
+import pytest
+import tarfile
+
+FILES = ("state.cpt", "state_prev.cpt", "state_step100.cpt", "traj_comp.part0001.xtc", "md.log")
+
+
+def _member(tmpdir, iterations, size=10):
+    """Member directory with the files of every phase of ``iterations``."""
+    paths = PathPlan(tmpdir, 1)
+    for iteration in range(iterations):
+        for phase in PHASE_ORDER:
+            phase_dir = paths.make_phase_dir(iteration, phase)
+            for name in FILES:
+                with open(str(phase_dir / name), "wb") as fh:
+                    fh.write(b"x" * size)
+    return paths
+
+
+def _remaining(paths, iteration, phase):
+    phase_dir = paths.phase_dir(iteration, phase)
+    return sorted(os.listdir(str(phase_dir))) if phase_dir.is_dir() else None
+
+
+def test_policy():
+    """Policies that would drop needed checkpoints are rejected."""
+    with pytest.raises(ValueError):
+        RetentionPolicy(keep_checkpoints=0)
+    with pytest.raises(ValueError):
+        RetentionPolicy(archive_after=0)
+    with pytest.raises(ValueError):
+        RetentionPolicy(compression="zip")
+
+
+def test_plan(tmpdir):
+    """Only finished phases are cleaned up, and the checkpoints the next
+    phases start from are kept.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    paths = _member(tmpdir, 4)
+    manager = RetentionManager(RetentionPolicy(keep_checkpoints=1))
+    accounting = manager.apply(paths, 3, "production")
+
+    # The running phase is untouched.
+    assert _remaining(paths, 3, "production") == sorted(FILES)
+    # Convergence of the current iteration keeps the checkpoint production started from.
+    assert _remaining(paths, 3, "convergence") == ["md.log", "state.cpt", "traj_comp.part0001.xtc"]
+    assert _remaining(paths, 3, "training") == ["md.log", "traj_comp.part0001.xtc"]
+    # The previous iteration keeps its production checkpoint, which the next iteration starts from.
+    assert _remaining(paths, 2, "production") == ["md.log", "state.cpt", "traj_comp.part0001.xtc"]
+    # Older iterations keep only their production trajectories.
+    assert _remaining(paths, 1, "production") == ["md.log", "traj_comp.part0001.xtc"]
+    assert _remaining(paths, 1, "convergence") == ["md.log"]
+
+    assert accounting["deleted"] > 0
+    assert RetentionManager.usage(paths) == accounting
+    assert json.load(open(str(paths.member_dir / RETENTION_FILE)))["deleted"] == accounting["deleted"]
+
+    # Nothing is left to do for the same phase.
+    assert manager.apply(paths, 3, "production")["deleted"] == 0
+    manager.shutdown()
+
+
+def test_archive(tmpdir):
+    """Old iteration directories are replaced by compressed archives in the
+    background.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    paths = _member(tmpdir, 4, size=1000)
+    manager = RetentionManager(RetentionPolicy(archive_after=2, drop_intermediate_cpt=False))
+    manager.submit(paths, 3, "training")
+    manager.wait()
+    manager.shutdown()
+
+    assert not os.path.exists(str(paths.member_dir / "0"))
+    archive = paths.member_dir / "0.tar.gz"
+    with tarfile.open(str(archive)) as tar:
+        assert "0/production/traj_comp.part0001.xtc" in tar.getnames()
+    assert os.path.isdir(str(paths.member_dir / "1"))
+
+    usage = RetentionManager.usage(paths)
+    assert usage["archived"] == len(PHASE_ORDER) * len(FILES) * 1000
+    assert 0 < usage["archive_size"] < usage["archived"]
@@ -1,8 +1,22 @@
-from run_brer.run_config import RunConfig
+from run_brer.artifacts import ArtifactStore
+from run_brer.coverage import COVERAGE_MARKER
+from run_brer.retention import RetentionManager, RetentionPolicy
+from run_brer.directory_helper import MetadataCounter
+from run_brer.run_config import PARTIAL_TRAINING, EnsembleRunConfig, GmxEngine, RunConfig
+import json
+import signal
+import threading
 import pytest
 import os
 
 
+@pytest.fixture(autouse=True)
+def log_in_tmpdir(tmpdir, monkeypatch):
+    """RunConfig logs to brer<N>.log in the working directory: keep the logs
+    of the tests out of the repository."""
+    monkeypatch.chdir(tmpdir)
+
+
 def test_run_config(tmpdir, data_dir, raw_pair_data):
     current_dir = os.getcwd()
     config_params = {
@@ -20,6 +34,284 @@ def test_run_config(tmpdir, data_dir, raw_pair_data):
     os.chdir(current_dir)
 
 
+def test_run_iterations(tmpdir, data_dir):
+    current_dir = os.getcwd()
+    config_params = {
+        "tpr": "{}/topol.tpr".format(data_dir),
+        "ensemble_num": 1,
+        "ensemble_dir": tmpdir,
+        "pairs_json": "{}/pair_data.json".format(data_dir)
+    }
+    os.makedirs("{}/mem_{}".format(tmpdir, config_params["ensemble_num"]))
+    rc = RunConfig(**config_params)
+    rc.run_data.set(A=5, tau=0.1, tolerance=100, num_samples=2, sample_period=0.1, production_time=0.2)
+    assert rc.run_iterations(1) == 3
+    assert rc.run_data.get("iteration") == 1
+    assert rc.run_data.get("phase") == "training"
+    assert rc.run_until(walltime=0) == 0
+
+    open("{}/{}".format(tmpdir, COVERAGE_MARKER), "w").close()
+    assert rc.run_iterations(1, stop_on_coverage=True) == 0
+    assert rc.run_iterations(1) == 3
+    os.chdir(current_dir)
+
+
+class _Engine(GmxEngine):
+    """Stand-in for GmxEngine that writes a checkpoint and a log and,
+    optionally, is sent a signal in the middle of the run or stops early the
+    way mdrun does, without Python seeing a signal."""
+
+    def __init__(self, signum=None, mdrun_signal=None, end_time_reached=1.):
+        super().__init__()
+        self.signum = signum
+        self.mdrun_signal = mdrun_signal
+        self.end_time_reached = end_time_reached
+        self.stops = []
+        self.idled = 0
+        self.fail = False
+
+    def run(self, tpr, workdir_list, plugins, **kwargs):
+        for workdir in workdir_list:
+            with open("{}/state.cpt".format(workdir), "w") as fh:
+                fh.write("cpt")
+            with open("{}/md.log".format(workdir), "w") as fh:
+                if self.mdrun_signal is not None:
+                    fh.write("Received the {} signal, stopping within 100 steps\n".format(self.mdrun_signal))
+                fh.write("Finished mdrun\n")
+        if self.signum is not None:
+            os.kill(os.getpid(), self.signum)
+        if self.fail:
+            raise RuntimeError("mdrun failed")
+        time = self.end_time_reached * kwargs.get("end_time", 7.0)
+
+        class Potential:
+            def __init__(self, plugin):
+                self.name = plugin.name
+                self.alpha = 1.5
+                self.target = plugin.params["target"]
+                self.time = time
+
+        return [Potential(plugin) for plugin in plugins]
+
+    def request_stop(self, signum=None):
+        super().request_stop(signum)
+        self.stops.append(signum)
+
+    def idle(self, tpr, workdir_list, **kwargs):
+        self.idled += 1
+
+
+def test_interrupted_phase(tmpdir, data_dir):
+    current_dir = os.getcwd()
+    config_params = {
+        "tpr": "{}/topol.tpr".format(data_dir),
+        "ensemble_num": 1,
+        "ensemble_dir": tmpdir,
+        "pairs_json": "{}/pair_data.json".format(data_dir)
+    }
+    engine = _Engine(signal.SIGTERM)
+    rc = RunConfig(engine=engine, **config_params)
+    assert rc.run_iterations(1) == 1
+    assert engine.stops == [signal.SIGTERM]
+    assert rc.stop_requested == signal.SIGTERM
+
+    state = json.load(open("{}/mem_1/state.json".format(tmpdir)))["general parameters"]
+    assert (state["phase"], state["subphase"]) == ("training", "interrupted")
+    progress = json.load(open("{}/mem_1/0/training/{}".format(tmpdir, PARTIAL_TRAINING)))
+    assert sorted(progress) == sorted(rc.pairs.names)
+    assert all(pair["alpha"] == 1.5 for pair in progress.values())
+
+    # A new launch picks the phase up again, with the same targets and checkpoint.
+    targets = {name: rc.run_data.get("target", name=name) for name in rc.pairs.names}
+    rc = RunConfig(engine=_Engine(), **config_params)
+    rc.run()
+    assert not os.path.exists("{}/mem_1/0/training/state.cpt.bak".format(tmpdir))
+    assert {name: rc.run_data.get("target", name=name) for name in rc.pairs.names} == targets
+    assert rc.run_data.get("phase") == "convergence"
+    assert rc.run_data.get("subphase") == "pending"
+    os.chdir(current_dir)
+
+
+def test_mdrun_stopped_early(tmpdir, data_dir):
+    """mdrun handles signals itself while it runs: a phase that it stopped
+    early, or a production phase that ends short of its end time, is
+    interrupted although Python never saw a signal."""
+    current_dir = os.getcwd()
+    config_params = {
+        "tpr": "{}/topol.tpr".format(data_dir),
+        "ensemble_num": 1,
+        "ensemble_dir": tmpdir,
+        "pairs_json": "{}/pair_data.json".format(data_dir)
+    }
+    rc = RunConfig(engine=_Engine(mdrun_signal="TERM"), **config_params)
+    assert rc.run_iterations(1) == 1
+    assert rc.stop_requested == signal.SIGTERM
+    assert (rc.run_data.get("phase"), rc.run_data.get("subphase")) == ("training", "interrupted")
+    # Nothing is recorded for the incomplete phase.
+    assert not os.path.exists("{}/mem_1/history.bin".format(tmpdir))
+
+    # The resumed training and the convergence complete; production falls short.
+    rc = RunConfig(engine=_Engine(end_time_reached=0.5), **config_params)
+    assert rc.run_iterations(1) == 3
+    assert rc.stop_requested is True
+    assert (rc.run_data.get("phase"), rc.run_data.get("subphase")) == ("production", "interrupted")
+
+    # A stop requested while no MD runs keeps the engine from starting any.
+    engine = GmxEngine()
+    engine.request_stop(signal.SIGUSR1)
+    assert engine.stop_requested == signal.SIGUSR1
+    os.chdir(current_dir)
+
+
+def test_scratch(tmpdir, data_dir):
+    current_dir = os.getcwd()
+    config_params = {
+        "tpr": "{}/topol.tpr".format(data_dir),
+        "ensemble_num": 1,
+        "ensemble_dir": "{}/ensemble".format(tmpdir),
+        "pairs_json": "{}/pair_data.json".format(data_dir)
+    }
+    engine = _Engine()
+    rc = RunConfig(engine=engine, scratch="{}/scratch".format(tmpdir), **config_params)
+    rc.run()
+    # The phase ran in scratch, and its output reached the phase directory before the state advanced.
+    assert open("{}/ensemble/mem_1/0/training/state.cpt".format(tmpdir)).read() == "cpt"
+    assert rc.run_data.get("phase") == "convergence"
+    assert os.listdir("{}/scratch".format(tmpdir)) == []
+
+    # The MD fails: its output is still synced back, and neither scratch nor the sync thread is left behind.
+    engine.fail = True
+    with pytest.raises(RuntimeError):
+        rc.run()
+    assert open("{}/ensemble/mem_1/0/convergence/md.log".format(tmpdir)).read() == "Finished mdrun\n"
+    assert os.listdir("{}/scratch".format(tmpdir)) == []
+    assert "run_brer-staging" not in [thread.name for thread in threading.enumerate()]
+    os.chdir(current_dir)
+
+
+class _Counter(MetadataCounter):
+    """MetadataCounter that keeps the counts of every phase."""
+
+    def __init__(self):
+        super().__init__()
+        self.phases = []
+
+    def reset(self):
+        self.phases.append(super().reset())
+        return self.phases[-1]
+
+
+def test_metadata_counter(tmpdir, data_dir):
+    current_dir = os.getcwd()
+    counter = _Counter()
+    rc = RunConfig("{}/topol.tpr".format(data_dir), tmpdir, 1, pairs_json="{}/pair_data.json".format(data_dir),
+                   engine=_Engine(), precreate_iterations=1, metadata_counter=counter)
+    rc.run()
+    # The directories of this and the next iteration were created at once.
+    assert os.path.isdir("{}/mem_1/1/production".format(tmpdir))
+    rc.run()
+    # Convergence only looks for its checkpoint and changes into its directory, which exists.
+    assert counter.phases[1] == {"stat": 1, "chdir": 1}
+    assert rc.run_data.get("phase") == "production"
+    os.chdir(current_dir)
+
+
+def test_artifacts(tmpdir, data_dir):
+    current_dir = os.getcwd()
+    tpr = "{}/topol.tpr".format(tmpdir)
+    with open(tpr, "wb") as fh:
+        fh.write(b"tpr")
+    store = ArtifactStore("{}/ensemble".format(tmpdir), cache="{}/node".format(tmpdir))
+    rc = RunConfig(tpr, "{}/ensemble".format(tmpdir), 1, pairs_json="{}/pair_data.json".format(data_dir),
+                   engine=_Engine(), artifacts=store)
+    assert rc.tpr.startswith("{}/node/".format(tmpdir))
+    assert open(rc.tpr, "rb").read() == b"tpr"
+    rc.run()
+    assert rc.run_data.get("phase") == "convergence"
+    os.chdir(current_dir)
+
+
+def test_retention(tmpdir, data_dir):
+    current_dir = os.getcwd()
+    retention = RetentionManager(RetentionPolicy(keep_checkpoints=1))
+    rc = RunConfig("{}/topol.tpr".format(data_dir), tmpdir, 1, pairs_json="{}/pair_data.json".format(data_dir),
+                   engine=_Engine(), retention=retention)
+    assert rc.run_iterations(1) == 3
+    # Training and convergence of the second iteration.
+    rc.run()
+    rc.run()
+    retention.wait()
+    # The training checkpoints are dropped once the next phase has started.
+    assert not os.path.exists("{}/mem_1/0/training/state.cpt".format(tmpdir))
+    assert not os.path.exists("{}/mem_1/1/training/state.cpt".format(tmpdir))
+    # The checkpoints later phases start from are kept.
+    assert os.path.exists("{}/mem_1/0/convergence/state.cpt".format(tmpdir))
+    assert os.path.exists("{}/mem_1/0/production/state.cpt".format(tmpdir))
+    retention.shutdown()
+    os.chdir(current_dir)
+
+    # Symlinked checkpoints would dangle once retention deletes their source.
+    with pytest.raises(ValueError):
+        RunConfig("{}/topol.tpr".format(data_dir), tmpdir, 1, pairs_json="{}/pair_data.json".format(data_dir),
+                  engine=_Engine(), retention=RetentionPolicy(), cpt_handoff="symlink")
+
+
+class _Communicator:
+    """Stand-in for an MPI communicator."""
+
+    def __init__(self, rank, size, others=0):
+        self.rank = rank
+        self.size = size
+        # What the other ranks contribute to a reduction.
+        self.others = others
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def Barrier(self):
+        pass
+
+    def allreduce(self, value):
+        return value + self.others
+
+
+def test_ensemble_run_config(tmpdir, data_dir):
+    current_dir = os.getcwd()
+    config_params = {
+        "tpr": "{}/topol.tpr".format(data_dir),
+        "ensemble_dir": tmpdir,
+        "ensemble_nums": [1, 2, 3],
+        "pairs_json": "{}/pair_data.json".format(data_dir)
+    }
+    erc = EnsembleRunConfig(**config_params)
+    for rc in erc.members.values():
+        rc.run_data.set(A=5, tau=0.1, tolerance=100, num_samples=2, sample_period=0.1, production_time=0.2)
+    assert erc.groups() == [[1], [2], [3]]
+    erc.run()
+    for ensemble_num, rc in erc.members.items():
+        assert rc.run_data.get("phase") == "convergence"
+        assert os.path.exists("{}/mem_{}/0/training/state.cpt".format(tmpdir, ensemble_num))
+        # Parameters set before the run are used and saved, not lost when the members are reloaded.
+        assert rc.run_data.get("A") == 5
+        with open("{}/mem_{}/state.json".format(tmpdir, ensemble_num)) as fh:
+            assert json.load(fh)["general parameters"]["production_time"] == 0.2
+
+    # Two ranks: members in the same phase share a context; the others wait for their turn.
+    erc = EnsembleRunConfig(comm=_Communicator(0, 2), **config_params)
+    erc.members[3].run_data.set(phase="production")
+    assert erc.groups() == [[1, 2], [3]]
+
+    # The members share one retention manager, and with it one pool of background threads.
+    erc = EnsembleRunConfig(retention=RetentionPolicy(), **config_params)
+    assert isinstance(erc.retention, RetentionManager)
+    assert all(rc.retention is erc.retention for rc in erc.members.values())
+    erc.retention.shutdown()
+    os.chdir(current_dir)
+
+
 # def test_converge(tmpdir, data_dir, raw_pair_data):
 #     current_dir = os.getcwd()
 #     config_params = {
@@ -33,3 +325,71 @@ def test_run_config(tmpdir, data_dir, raw_pair_data):
 #     rc.run_data.set(A=5, tau=0.1, tolerance=100, num_samples=2, sample_period=0.1, production_time=0.2)
 #     rc.run()
 #     os.chdir(current_dir)
+
+
+def test_ensemble_members(tmpdir, data_dir):
+    """Members of an ensemble go through the same phase path as a single
+    member: a stop signal interrupts the running member and no further group
+    is started, and ranks without a member in a group only idle."""
+    current_dir = os.getcwd()
+    config_params = {
+        "tpr": "{}/topol.tpr".format(data_dir),
+        "ensemble_dir": tmpdir,
+        "ensemble_nums": [1, 2, 3],
+        "pairs_json": "{}/pair_data.json".format(data_dir)
+    }
+    engine = _Engine(signal.SIGTERM)
+    erc = EnsembleRunConfig(engine=engine, **config_params)
+    assert erc.run_until(iteration=1) == 1
+    assert erc.stop_requested == signal.SIGTERM
+    assert erc.members[1].run_data.get("phase") == "training"
+    assert erc.members[1].run_data.get("subphase") == "interrupted"
+    assert erc.members[2].run_data.get("subphase") == "pending"
+    assert engine.stops == [signal.SIGTERM]
+
+    # The second of two ranks runs member 2 and idles while member 3 runs on the first.
+    engine = _Engine()
+    erc = EnsembleRunConfig(comm=_Communicator(1, 2), engine=engine, **config_params)
+    erc.members[2].run_data.set(A=5)
+    assert erc.groups() == [[1, 2], [3]]
+    erc.run()
+    assert engine.idled == 1
+    assert erc.members[2].run_data.get("phase") == "convergence"
+    assert erc.members[2].run_data.get("A") == 5
+    assert erc.members[3].run_data.get("phase") == "training"
+    os.chdir(current_dir)
+
+
+def test_ensemble_run_until(tmpdir, data_dir):
+    """The ranks of an ensemble stop together: on the state as saved by the
+    other ranks, and as soon as any rank meets a stopping criterion."""
+    current_dir = os.getcwd()
+    config_params = {
+        "tpr": "{}/topol.tpr".format(data_dir),
+        "ensemble_dir": tmpdir,
+        "ensemble_nums": [1],
+        "pairs_json": "{}/pair_data.json".format(data_dir)
+    }
+    erc = EnsembleRunConfig(engine=_Engine(), **config_params)
+    # Another rank finishes the iteration of member 1.
+    other = RunConfig(config_params["tpr"], tmpdir, 1, pairs_json=config_params["pairs_json"], engine=_Engine())
+    other.run_data.set(iteration=1)
+    other.state_store.save(other.run_data)
+    assert erc.run_until(iteration=1) == 0
+    assert erc.current_iteration() == 1
+
+    # Another rank stops.
+    erc = EnsembleRunConfig(comm=_Communicator(0, 2, others=1), engine=_Engine(), **config_params)
+    assert erc.run_until(iteration=5) == 0
+    assert erc.members[1].run_data.get("iteration") == 1
+    os.chdir(current_dir)
+
+
+def test_state_options(tmpdir, data_dir):
+    """Options of the state store are passed through."""
+    rc = RunConfig("{}/topol.tpr".format(data_dir), tmpdir, 1, pairs_json="{}/pair_data.json".format(data_dir),
+                   engine=_Engine(), state_store="sqlite", state_options={"journal_mode": "wal"})
+    assert rc.state_store.database.connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    rc = RunConfig("{}/topol.tpr".format(data_dir), tmpdir, 2, pairs_json="{}/pair_data.json".format(data_dir),
+                   engine=_Engine(), state_store="journal", state_options={"compact_every": 64})
+    assert rc.state_store.compact_every == 64
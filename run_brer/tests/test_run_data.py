@@ -61,6 +61,8 @@ def test_run_data(tmpdir, raw_pair_data):
     with pytest.raises(ValueError):
         rd.set(alpha=1.)
     rd.set(alpha=1., name=name)
+    rd.set(start_time=0, iteration=2)
+    assert rd.get("start_time") == 0 and rd.get("iteration") == 2
     
     # Test getting
     rd.get("alpha", name=name)
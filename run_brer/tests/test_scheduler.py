@@ -0,0 +1,117 @@
+"""Unit tests and regression for walltime-aware phase scheduling."""
+from run_brer.run_data import RunData
+from run_brer.scheduler import PhaseScheduler, PhaseTimings, allocation_end, allocation_start, parse_duration
+import pytest
+import time
+
+
+class _Member:
+    """Stand-in for a RunConfig whose phases take no time."""
+
+    def __init__(self, ensemble_dir):
+        self.ens_dir = ensemble_dir
+        self.run_data = RunData()
+        self.run_data.set(ensemble_num=1, production_time=100.)
+        self.phases = []
+        self.stop_requested = None
+        # Number of phases to run before the next one is stopped by a signal.
+        self.signal_after = None
+
+    def run(self):
+        phase = self.run_data.get('phase')
+        self.phases.append(phase)
+        if self.signal_after is not None and len(self.phases) > self.signal_after:
+            self.stop_requested = 15
+            return
+        self.run_data.set(phase={'training': 'convergence', 'convergence': 'production'}.get(phase, 'training'))
+
+
+def test_allocation_end(monkeypatch):
+    """The allocation length can be given explicitly or read from SLURM."""
+    assert parse_duration("90") == 90
+    assert parse_duration("1:30:00") == 5400
+    assert parse_duration("2-00:00:10") == 2 * 86400 + 10
+    assert allocation_end("1:00", start=100.) == 160.
+
+    # The walltime counts from the start of the job, not of the script.
+    monkeypatch.setenv("SLURM_JOB_START_TIME", "1000")
+    assert allocation_start() == 1000.
+    assert allocation_end("1:00") == 1060.
+    monkeypatch.delenv("SLURM_JOB_START_TIME")
+    assert abs(allocation_end(60) - time.time() - 60) < 5
+
+    monkeypatch.delenv("SLURM_JOB_ID", raising=False)
+    monkeypatch.delenv("SLURM_JOB_END_TIME", raising=False)
+    assert allocation_end() is None
+    monkeypatch.setenv("SLURM_JOB_END_TIME", "12345")
+    assert allocation_end() == 12345.
+
+
+def test_phase_timings(tmpdir):
+    """Predictions prefer the member's own observations and scale production
+    with its simulated time.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    timings = PhaseTimings("{}/phase_timings.json".format(tmpdir), max_observations=3)
+    assert timings.predict("gpu", "training", 1) is None
+    for seconds in (10., 20., 30.):
+        timings.record("gpu", "training", 2, seconds)
+    assert timings.predict("gpu", "training", 1, quantile=0.5) == 20.
+    for seconds in (100., 100., 100., 100.):
+        timings.record("gpu", "training", 1, seconds)
+    assert len(timings.load()["gpu"]["training"]["1"]) == 3
+    assert timings.predict("gpu", "training", 1) == 100.
+    assert timings.predict("cpu", "training", 1) is None
+
+    timings.record("gpu", "production", 1, 50., 100.)
+    assert timings.predict("gpu", "production", 1, simulated=1000.) == pytest.approx(500.)
+
+
+def test_phase_scheduler(tmpdir):
+    """Phases are only started while they are predicted to fit.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    member = _Member(str(tmpdir))
+    scheduler = PhaseScheduler(member, end_time=None, hardware="gpu")
+    assert scheduler.run(max_phases=3) == 3
+    assert set(scheduler.timings.load()["gpu"]) == {"training", "convergence", "production"}
+    assert member.phases == ["training", "convergence", "production"]
+
+    timings = PhaseTimings("{}/observed.json".format(tmpdir))
+    scheduler = PhaseScheduler(member, end_time=time.time() + 1800., margin=0., hardware="gpu", timings=timings)
+    timings.record("gpu", "training", 1, 3600.)
+    assert not scheduler.fits()
+    assert scheduler.run() == 0
+
+    # The member is expected to need 100 s per simulated ps: production does not fit.
+    scheduler.timings.record("gpu", "training", 1, 1.)
+    scheduler.timings.record("gpu", "convergence", 1, 1.)
+    scheduler.timings.record("gpu", "production", 1, 1000., 10.)
+    scheduler.quantile = 0.
+    assert scheduler.run(max_phases=10) == 2
+    assert member.run_data.get("phase") == "production"
+
+
+def test_interrupted_phase_not_recorded(tmpdir):
+    """A phase that is stopped by a signal does not count as an observed
+    duration.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    member = _Member(str(tmpdir))
+    member.signal_after = 1
+    scheduler = PhaseScheduler(member, end_time=None, hardware="gpu")
+    assert scheduler.run(max_phases=3) == 2
+    assert member.phases == ["training", "convergence"]
+    assert set(scheduler.timings.load()["gpu"]) == {"training"}
@@ -0,0 +1,143 @@
+"""Unit tests and regression for SharedPairCache class."""
+from run_brer.pair_data import MultiPair
+from run_brer import shared_pairs
+from run_brer.shared_pairs import SharedPairCache
+from multiprocessing import get_context, shared_memory
+import numpy as np
+import os
+import pytest
+
+
+def _attach_in_child(filename, queue):
+    cache = SharedPairCache(filename)
+    pairs = cache.attach()
+    queue.put((pairs.names, cache.references, float(np.sum(pairs[0].get('distribution')))))
+    del pairs
+    cache.detach()
+
+
+def _crash_in_child(filename):
+    SharedPairCache(filename).attach()
+    os._exit(1)
+
+
+def test_shared_pair_cache(data_dir):
+    """Attach to the same pair data from this process and a child process;
+    the segment is published once and unlinked after the last detach.
+
+    Parameters
+    ----------
+    data_dir : str
+        pytest data directory
+    """
+    filename = "{}/pair_data.json".format(data_dir)
+    reference = MultiPair()
+    reference.read(filename)
+
+    first = SharedPairCache(filename)
+    second = SharedPairCache(filename)
+    assert first.name == second.name
+
+    pairs = first.attach()
+    other = second.attach()
+    assert first.references == 2
+    assert pairs.names == reference.names
+    for i in range(len(reference.names)):
+        assert np.array_equal(pairs[i].get('distribution'), reference[i].get('distribution'))
+        assert pairs[i].get('sites') == reference[i].get('sites')
+    with pytest.raises(ValueError):
+        pairs[0].get('distribution')[0] = 1.
+    # The sampler was compiled once, into the segment.
+    assert np.shares_memory(pairs.compiled_cdf(), np.frombuffer(first._shm.buf, dtype=np.uint8))
+    assert np.array_equal(pairs.compiled_cdf(), reference.compiled_cdf())
+    assert pairs.sample(10).shape == (10, len(reference.names))
+
+    context = get_context("spawn")
+    queue = context.Queue()
+    child = context.Process(target=_attach_in_child, args=(filename, queue))
+    child.start()
+    names, references, mass = queue.get(timeout=60)
+    child.join()
+    assert names == reference.names
+    assert references == 3
+    assert np.isclose(mass, np.sum(reference[0].get('distribution')))
+    assert first.references == 2
+
+    del pairs, other
+    second.detach()
+    first.detach()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=first.name)
+    # Nobody is attached anymore, so the next user publishes a fresh segment.
+    with SharedPairCache(filename) as pairs:
+        assert pairs.names == reference.names
+
+
+def test_crashed_user(data_dir):
+    """A user that dies without detaching does not keep the segment alive.
+
+    Parameters
+    ----------
+    data_dir : str
+        pytest data directory
+    """
+    filename = "{}/pair_data.json".format(data_dir)
+    cache = SharedPairCache(filename)
+    pairs = cache.attach()
+
+    context = get_context("spawn")
+    child = context.Process(target=_crash_in_child, args=(filename, ))
+    child.start()
+    child.join()
+    assert child.exitcode == 1
+    assert cache.references == 1
+
+    del pairs
+    cache.detach()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=cache.name)
+
+
+class _FailingHeader:
+    """Stand-in for the segment header that fails to mark the segment as
+    ready."""
+
+    size = shared_pairs._HEADER.size
+
+    def pack_into(self, buffer, offset, *values):
+        raise OSError("No space left on device")
+
+
+def test_failed_publish(data_dir, monkeypatch):
+    """A segment whose publisher failed or died before it was filled is not
+    attached to.
+
+    Parameters
+    ----------
+    data_dir : str
+        pytest data directory
+    monkeypatch : pytest.MonkeyPatch
+        pytest monkeypatch fixture
+    """
+    filename = "{}/pair_data.json".format(data_dir)
+    reference = MultiPair()
+    reference.read(filename)
+
+    cache = SharedPairCache(filename)
+    monkeypatch.setattr(shared_pairs, "_HEADER", _FailingHeader())
+    with pytest.raises(OSError):
+        cache.attach()
+    monkeypatch.undo()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=cache.name)
+
+    # A publisher that died leaves a segment that is not marked as ready.
+    stale = shared_pairs._open_shared_memory(cache.name, create=True, size=1024)
+    pairs = cache.attach()
+    assert pairs.names == reference.names
+    assert np.allclose(pairs[0].get("distribution"), reference[0].get("distribution"))
+    del pairs
+    cache.detach()
+    stale.close()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=cache.name)
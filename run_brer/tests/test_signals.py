@@ -0,0 +1,60 @@
+"""Unit tests and regression for signal handling."""
+from run_brer.signals import StopSignalHandler, mdrun_stop_signal
+import os
+import signal
+import time
+
+
+class _Target:
+    def __init__(self):
+        self.requests = []
+
+    def request_stop(self, signum=None):
+        self.requests.append(signum)
+
+
+def test_stop_signal_handler():
+    """Signals are forwarded while the handler is active and the previous
+    handlers are restored afterwards."""
+    previous = signal.getsignal(signal.SIGUSR1)
+    target = _Target()
+    with StopSignalHandler(target) as handler:
+        os.kill(os.getpid(), signal.SIGUSR1)
+        os.kill(os.getpid(), signal.SIGTERM)
+    assert target.requests == [signal.SIGUSR1, signal.SIGTERM]
+    assert handler.received == signal.SIGTERM
+    assert signal.getsignal(signal.SIGUSR1) is previous
+
+
+def test_mdrun_stop_signal(tmpdir):
+    """The signal that stopped mdrun is read from its newest log.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    assert mdrun_stop_signal(str(tmpdir)) is None
+    with open("{}/md.log".format(tmpdir), "w") as fh:
+        fh.write("Step 100\n\nReceived the TERM signal, stopping within 100 steps\n\nWriting checkpoint\n")
+    assert mdrun_stop_signal(str(tmpdir)) == signal.SIGTERM
+
+    # mdrun names INT and TERM together, and logs a stop on the ranks that did not receive the signal.
+    for line in ("Received the INT/TERM signal, stopping within 100 steps",
+                 "Received the second INT/TERM signal, stopping within 100 steps",
+                 "Received the remote INT/TERM signal, stopping within 100 steps"):
+        with open("{}/md.log".format(tmpdir), "w") as fh:
+            fh.write("Step 100\n\n{}\n\nWriting checkpoint\n".format(line))
+        assert mdrun_stop_signal(str(tmpdir)) == signal.SIGTERM
+    with open("{}/md.log".format(tmpdir), "w") as fh:
+        fh.write("Received the remote USR1 signal, stopping within 100 steps\n")
+    assert mdrun_stop_signal(str(tmpdir)) == signal.SIGUSR1
+    with open("{}/md.log".format(tmpdir), "w") as fh:
+        fh.write("Received the FOO signal, stopping within 100 steps\n")
+    assert mdrun_stop_signal(str(tmpdir)) is True
+
+    # The continuation ran to completion.
+    time.sleep(0.01)
+    with open("{}/md.part0002.log".format(tmpdir), "w") as fh:
+        fh.write("Finished mdrun\n")
+    assert mdrun_stop_signal(str(tmpdir)) is None
@@ -0,0 +1,105 @@
+"""Unit tests and regression for scratch staging."""
+from run_brer.staging import PhaseStaging
+import os
+
+
+def _staging(tmpdir, **kwargs):
+    canonical = "{}/canonical".format(tmpdir)
+    os.makedirs(canonical)
+    with open("{}/state.cpt".format(canonical), "wb") as fh:
+        fh.write(b"checkpoint")
+    return PhaseStaging(canonical, root="{}/scratch".format(tmpdir), **kwargs)
+
+
+def test_stage_in(tmpdir):
+    """Inputs are copied to scratch and not synced back unchanged.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    staging = _staging(tmpdir)
+    staging.stage_in()
+    with open("{}/state.cpt".format(staging.scratch_dir), "rb") as fh:
+        assert fh.read() == b"checkpoint"
+    assert staging.sync() == 0
+
+
+def test_incremental_sync(tmpdir):
+    """Only new bytes of growing files and changed files are copied.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    staging = _staging(tmpdir)
+    staging.stage_in()
+    log = "{}/md.log".format(staging.scratch_dir)
+    with open(log, "wb") as fh:
+        fh.write(b"a" * 100)
+    os.makedirs("{}/plugins".format(staging.scratch_dir))
+    with open("{}/plugins/pair.log".format(staging.scratch_dir), "wb") as fh:
+        fh.write(b"pair")
+    assert staging.sync() == 104
+    assert staging.sync() == 0
+
+    # Appending copies only the new bytes.
+    with open(log, "ab") as fh:
+        fh.write(b"b" * 10)
+    assert staging.sync() == 10
+    with open("{}/md.log".format(staging.canonical_dir), "rb") as fh:
+        assert fh.read() == b"a" * 100 + b"b" * 10
+
+    # A file replaced by a new one (as mdrun does with checkpoints) is copied in full.
+    tmp = "{}/state.cpt.new".format(staging.scratch_dir)
+    with open(tmp, "wb") as fh:
+        fh.write(b"new checkpoint")
+    os.replace(tmp, "{}/state.cpt".format(staging.scratch_dir))
+    assert staging.sync() == len(b"new checkpoint")
+    with open("{}/state.cpt".format(staging.canonical_dir), "rb") as fh:
+        assert fh.read() == b"new checkpoint"
+    assert staging.bytes_synced == 104 + 10 + len(b"new checkpoint")
+
+
+def test_rewritten_in_place(tmpdir):
+    """A file rewritten in place, not only appended to, is copied in full.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    staging = _staging(tmpdir)
+    staging.stage_in()
+    log = "{}/md.log".format(staging.scratch_dir)
+    with open(log, "wb") as fh:
+        fh.write(b"a" * 100)
+    staging.sync()
+    with open(log, "r+b") as fh:
+        fh.write(b"c" * 120)
+    assert staging.sync() == 120
+    with open("{}/md.log".format(staging.canonical_dir), "rb") as fh:
+        assert fh.read() == b"c" * 120
+
+
+def test_barrier(tmpdir):
+    """The barrier leaves all output in the canonical directory.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    staging = _staging(tmpdir, interval=0.01)
+    with staging:
+        for i in range(20):
+            with open("{}/traj.xtc".format(staging.scratch_dir), "ab") as fh:
+                fh.write(bytes([i]) * 1000)
+    assert staging._thread is None
+    with open("{}/traj.xtc".format(staging.canonical_dir), "rb") as fh:
+        assert fh.read() == b"".join(bytes([i]) * 1000 for i in range(20))
+    staging.cleanup()
+    assert not os.path.exists(staging.scratch_dir)
+    assert os.path.exists("{}/state.cpt".format(staging.canonical_dir))
@@ -0,0 +1,300 @@
+"""Unit tests and regression for state stores."""
+from run_brer.pair_data import PairData
+from run_brer.run_data import RunData
+from run_brer.state_store import (EnsembleDatabase, JSONStateStore, JournalStateStore, SQLiteStateStore,
+                                  atomic_write_json, open_state_store)
+from multiprocessing import Pool
+import json
+import os
+import pytest
+import sqlite3
+
+
+def _run_data(raw_pair_data):
+    rd = RunData()
+    for name in raw_pair_data:
+        pd = PairData(name)
+        pd.set_from_dictionary(raw_pair_data[name])
+        rd.from_pair_data(pd)
+    return rd
+
+
+def test_atomic_write_json(tmpdir):
+    """Previous generations are kept and no temporary files are left behind.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    filename = "{}/state.json".format(tmpdir)
+    for i in range(4):
+        atomic_write_json({"version": i}, filename, generations=2)
+
+    assert json.load(open(filename)) == {"version": 3}
+    assert json.load(open("{}.1".format(filename))) == {"version": 2}
+    assert json.load(open("{}.2".format(filename))) == {"version": 1}
+    assert sorted(os.listdir(str(tmpdir))) == ["state.json", "state.json.1", "state.json.2"]
+
+
+def test_json_state_store(tmpdir, raw_pair_data):
+    """Writes are coalesced: the store only writes when the state changed.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    raw_pair_data : dict
+        raw pair data from conftest.py
+    """
+    store = JSONStateStore("{}/state.json".format(tmpdir))
+    assert not store.exists()
+
+    rd = _run_data(raw_pair_data)
+    assert rd.is_dirty()
+    assert store.save(rd)
+    assert not rd.is_dirty()
+    assert not store.save(rd)
+
+    name = list(raw_pair_data)[0]
+    rd.set(name=name, target=4.2)
+    rd.set(phase="convergence")
+    assert [change[:2] for change in rd.pop_changes()] == [(name, "target"), (None, "phase")]
+    assert not store.save(rd)
+    assert store.save(rd, force=True)
+
+    loaded = RunData()
+    store.load(loaded)
+    assert not loaded.is_dirty()
+    assert loaded.as_dictionary() == rd.as_dictionary()
+
+
+def test_journal_state_store(tmpdir, raw_pair_data):
+    """Changes are journaled, replayed on load and compacted into a snapshot
+    while keeping the history of targets and alphas.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    raw_pair_data : dict
+        raw pair data from conftest.py
+    """
+    snapshot = "{}/state.json".format(tmpdir)
+    store = JournalStateStore(snapshot, compact_every=3)
+    assert not store.exists()
+    assert store.journal == "{}/state.journal".format(tmpdir)
+
+    rd = _run_data(raw_pair_data)
+    name = list(raw_pair_data)[0]
+    assert store.save(rd)
+    assert not store.save(rd)
+    for iteration in range(4):
+        # The results of an iteration are saved with the move to the next one.
+        rd.set(name=name, target=float(iteration), alpha=10. * iteration)
+        rd.set(iteration=iteration + 1)
+        assert store.save(rd)
+
+    # Five saves with compaction every three: one segment, two lines in the journal.
+    assert os.path.exists("{}.1".format(store.journal))
+    assert json.load(open(snapshot))["general parameters"]["iteration"] == 2
+
+    loaded = RunData()
+    JournalStateStore(snapshot).load(loaded)
+    assert not loaded.is_dirty()
+    assert loaded.as_dictionary() == rd.as_dictionary()
+
+    targets = [(record["iteration"], record["phase"], record["value"]) for record in store.history(keys=("target",))
+               if record["name"] == name]
+    assert targets[-4:] == [(i, "training", float(i)) for i in range(4)]
+
+    # A line torn by a crash is ignored.
+    with open(store.journal, "a") as fh:
+        fh.write('{"changes": [[null, "iteration"')
+    loaded = RunData()
+    JournalStateStore(snapshot).load(loaded)
+    assert loaded.get("iteration") == 4
+
+
+def test_journal_torn_tail(tmpdir, raw_pair_data):
+    """Records saved after a crash tore the last line are replayed.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    raw_pair_data : dict
+        raw pair data from conftest.py
+    """
+    snapshot = "{}/state.json".format(tmpdir)
+    rd = _run_data(raw_pair_data)
+    rd.set(iteration=1)
+    JournalStateStore(snapshot).save(rd)
+    with open("{}/state.journal".format(tmpdir), "a") as fh:
+        fh.write('{"changes": [[null, "iteration"')
+
+    # The next launch loads the state and saves further changes.
+    rd = RunData()
+    store = JournalStateStore(snapshot)
+    store.load(rd)
+    assert rd.get("iteration") == 1
+    for iteration in (5, 6):
+        rd.set(iteration=iteration)
+        assert store.save(rd)
+
+    loaded = RunData()
+    JournalStateStore(snapshot).load(loaded)
+    assert loaded.get("iteration") == 6
+
+    # Saving first, without loading, also starts after the last complete record.
+    with open(store.journal, "a") as fh:
+        fh.write('{"time": 1')
+    rd.set(iteration=7)
+    assert JournalStateStore(snapshot).save(rd)
+    loaded = RunData()
+    JournalStateStore(snapshot).load(loaded)
+    assert loaded.get("iteration") == 7
+
+
+def test_journal_failed_write(tmpdir, raw_pair_data):
+    """Changes that could not be written are kept for the next save.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    raw_pair_data : dict
+        raw pair data from conftest.py
+    """
+    snapshot = "{}/state.json".format(tmpdir)
+    rd = _run_data(raw_pair_data)
+    store = JournalStateStore(snapshot, journal="{}/missing/state.journal".format(tmpdir))
+    rd.set(iteration=3)
+    with pytest.raises(OSError):
+        store.save(rd)
+    assert rd.is_dirty()
+
+    os.makedirs("{}/missing".format(tmpdir))
+    assert store.save(rd)
+    loaded = RunData()
+    JournalStateStore(snapshot, journal=store.journal).load(loaded)
+    assert loaded.get("iteration") == 3
+
+
+def test_open_state_store(tmpdir):
+    """The factory places the state under the member directory.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    """
+    store = open_state_store("journal", str(tmpdir), 2)
+    assert store.snapshot == "{}/mem_2/state.json".format(tmpdir)
+    assert isinstance(open_state_store("json", str(tmpdir), 2), JSONStateStore)
+    assert open_state_store("sqlite", str(tmpdir), 2).database.database == os.path.join(str(tmpdir), "state.db")
+    connection = open_state_store("sqlite", str(tmpdir), 2).database.connection
+    assert connection.execute("PRAGMA synchronous").fetchone()[0] == 2  # FULL
+    connection = open_state_store("sqlite", str(tmpdir), 3, journal_mode="wal").database.connection
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert connection.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    with pytest.raises(ValueError):
+        open_state_store("xml", str(tmpdir), 2)
+
+
+def _train_member(args):
+    database, ensemble_num, raw_pair_data = args
+    store = SQLiteStateStore(database, ensemble_num, timeout=30.)
+    rd = _run_data(raw_pair_data)
+    rd.set(ensemble_num=ensemble_num)
+    store.save(rd)
+    for iteration in range(5):
+        rd.set(iteration=iteration, phase="training")
+        store.save(rd)
+        # As in RunConfig.finish_phase, the results of a phase are saved with the move to the next one.
+        for name in raw_pair_data:
+            rd.set(name=name, target=float(iteration), alpha=float(ensemble_num))
+        rd.set(phase="convergence")
+        store.save(rd)
+    rd.set(phase="production")
+    store.save(rd)
+    return rd.as_dictionary()
+
+
+def test_sqlite_state_store(tmpdir, raw_pair_data):
+    """Concurrent members share one database; their states, status and
+    history can be queried and exported to the json layout.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    raw_pair_data : dict
+        raw pair data from conftest.py
+    """
+    database = "{}/state.db".format(tmpdir)
+    members = [1, 2, 3, 4]
+    with Pool(len(members)) as pool:
+        states = pool.map(_train_member, [(database, member, raw_pair_data) for member in members])
+
+    db = EnsembleDatabase(database)
+    assert db.connection.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    assert db.status() == {member: (4, "production") for member in members}
+    assert db.status(phase="training") == {}
+
+    name = list(raw_pair_data)[0]
+    alphas = db.history("alpha", pair=name)
+    assert len(alphas) == len(members) * 5
+    assert [row[1:] for row in db.history("target", ensemble_num=2, pair=name)][-5:] == \
+        [(i, name, "training", float(i)) for i in range(5)]
+
+    for member, state in zip(members, states):
+        loaded = RunData()
+        store = SQLiteStateStore(db, member)
+        assert store.exists()
+        store.load(loaded)
+        assert loaded.as_dictionary() == state
+    assert not SQLiteStateStore(db, 5).exists()
+
+    # Round trip through the json layout.
+    ensemble_dir = "{}/ensemble".format(tmpdir)
+    assert db.export_json(ensemble_dir) == members
+    assert json.load(open("{}/mem_3/state.json".format(ensemble_dir))) == states[2]
+    copy = EnsembleDatabase("{}/copy.db".format(tmpdir))
+    assert copy.import_json(ensemble_dir) == members
+    assert copy.get_state(3) == states[2]
+    assert copy.status() == db.status()
+
+
+def test_sqlite_failed_write(tmpdir, raw_pair_data, monkeypatch):
+    """Changes that could not be written to the database are kept for the
+    next save.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    raw_pair_data : dict
+        raw pair data from conftest.py
+    monkeypatch : pytest.MonkeyPatch
+        pytest monkeypatch fixture
+    """
+    db = EnsembleDatabase("{}/state.db".format(tmpdir))
+    store = SQLiteStateStore(db, 1)
+    rd = _run_data(raw_pair_data)
+    rd.set(ensemble_num=1)
+    assert store.save(rd, force=True)
+    rd.set(iteration=3)
+
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(db, "apply_changes", locked)
+    with pytest.raises(sqlite3.OperationalError):
+        store.save(rd)
+    assert rd.is_dirty()
+
+    monkeypatch.undo()
+    assert store.save(rd)
+    assert not rd.is_dirty()
+    assert db.get_state(1)["general parameters"]["iteration"] == 3
@@ -0,0 +1,72 @@
+"""Unit tests and regression for TargetSchedule class."""
+from run_brer.pair_data import MultiPair
+from run_brer.target_schedule import TargetSchedule
+import numpy as np
+import pytest
+
+
+def test_target_schedule(tmpdir, data_dir):
+    """Generate, save and reload a schedule; check that streams are
+    reproducible and do not depend on the size of the schedule.
+
+    Parameters
+    ----------
+    tmpdir : str
+        pytest temporary directory
+    data_dir : str
+        pytest data directory
+    """
+    mp = MultiPair()
+    mp.read_from_json("{}/pair_data.json".format(data_dir))
+
+    schedule = TargetSchedule.generate(mp, ensemble_nums=[1, 2, 3], num_iterations=4, seed=42)
+    assert schedule.targets.shape == (3, 4, len(mp.names))
+
+    smaller = TargetSchedule.generate(mp, ensemble_nums=[2], num_iterations=2, seed=42)
+    assert smaller.get_targets(2, 1) == schedule.get_targets(2, 1)
+    assert schedule.get_targets(1, 0) != schedule.get_targets(2, 0)
+
+    # A single lookup starts the stream of the member at the block of the iteration.
+    rng = TargetSchedule.stream(42, 3, 2, len(mp.names))
+    assert np.array_equal(mp.inverse_cdf(rng.random(len(mp.names))), schedule.targets[2, 2])
+
+    for name, target in schedule.get_targets(3, 3).items():
+        assert target in mp[mp.name_to_id(name)].get('bins')
+
+    filename = "{}/targets.npy".format(tmpdir)
+    schedule.save(filename)
+    loaded = TargetSchedule.load(filename)
+    assert isinstance(loaded.targets, np.memmap)
+    assert np.array_equal(loaded.targets, schedule.targets)
+    assert loaded.get_targets(1, 2) == schedule.get_targets(1, 2)
+
+    with pytest.raises(KeyError):
+        loaded.get_targets(4, 0)
+    with pytest.raises(IndexError):
+        loaded.get_targets(1, 4)
+
+
+def test_stratified_schedule(data_dir):
+    """Stratified assignment converges to the DEER distributions faster than
+    independent draws.
+
+    Parameters
+    ----------
+    data_dir : str
+        pytest data directory
+    """
+    mp = MultiPair()
+    mp.read_from_json("{}/pair_data.json".format(data_dir))
+
+    random = TargetSchedule.generate(mp, ensemble_nums=range(1, 33), num_iterations=5, seed=7)
+    stratified = TargetSchedule.generate(mp, ensemble_nums=range(1, 33), num_iterations=5, seed=7,
+                                         method='stratified')
+    assert stratified.targets.shape == random.targets.shape
+
+    random_error = random.histogram_error(mp)
+    stratified_error = stratified.histogram_error(mp)
+    assert random_error.shape == (5, len(mp.names))
+    assert np.all(stratified_error.mean(axis=1) < random_error.mean(axis=1))
+
+    with pytest.raises(ValueError):
+        TargetSchedule.generate(mp, ensemble_nums=[1], num_iterations=1, method="sobol")
@@ -46,12 +46,14 @@ setup(
 
     # Additional entries you may want simply uncomment the lines you want and fill in the data
     # url='http://www.my_package.com',  # Website
-    # install_requires=[],              # Required packages, pulls from pip if needed; do not use for Conda deployment
+    # numpy.random.SeedSequence (target schedules) needs numpy 1.17
+    install_requires=['numpy>=1.17'],
     # platforms=['Linux',
     #            'Mac OS-X',
     #            'Unix',
     #            'Windows'],            # Valid platforms your code works on, adjust to your flavor
-    # python_requires=">=3.5",          # Python version restrictions
+    # multiprocessing.shared_memory (shared pair data) needs Python 3.8
+    python_requires=">=3.8",
 
     # Manual control if final package is compressible or not, set False to prevent the .egg from being made
     # zip_safe=False,